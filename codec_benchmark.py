@@ -0,0 +1,64 @@
+"""
+Codec benchmark
+
+Re-encodes the postings of an existing index with every
+available codec and reports the compressed size and the
+encode/decode speed of each one, which helps to choose
+the --indexer.codec of a collection.
+
+python3 codec_benchmark.py pubmedSPIMIindex [--max_terms 50000]
+
+"""
+import argparse
+from compression import CODECS, get_codec, postings_to_streams
+from index import InvertedIndex
+from utils import Timer
+
+
+def load_streams(index, max_terms):
+    '''decodes the postings of (up to max_terms) tokens into their integer streams'''
+    streams = []
+    for n, token in enumerate(index.lexicon):
+        if max_terms and n == max_terms:
+            break
+        doc_gaps, freqs, position_gaps, _ = postings_to_streams(index.get_postings(token))
+        streams.extend([doc_gaps, freqs, position_gaps])
+
+    return streams
+
+
+def benchmark_codec(codec, streams):
+    timer = Timer()
+
+    timer.start()
+    encoded = [codec.encode(s) for s in streams]
+    encode_time = timer.stop()
+
+    timer.start()
+    for data in encoded:
+        codec.decode(data)
+    decode_time = timer.stop()
+
+    return sum([len(data) for data in encoded]), encode_time, decode_time
+
+
+def main(index_folder, codecs, max_terms):
+    index = InvertedIndex.load_from_disk(index_folder)
+    streams = load_streams(index, max_terms)
+    integers_n = sum([len(s) for s in streams])
+    print(f"{index_folder}: {integers_n} integers from {len(streams)//3} tokens (index codec: {index.manifest['codec']})\n")
+
+    print(f"{'codec':<12}{'size (MB)':>12}{'bits/int':>10}{'encode (Mint/s)':>18}{'decode (Mint/s)':>18}")
+    for name in codecs:
+        size, encode_time, decode_time = benchmark_codec(get_codec(name), streams)
+        print(f"{name:<12}{size*1e-6:>12.2f}{size*8/integers_n:>10.2f}{integers_n*1e-6/encode_time:>18.2f}{integers_n*1e-6/decode_time:>18.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the postings codecs on an existing index")
+    parser.add_argument("index_folder", type=str, help="Folder of the index to be used in the benchmark.")
+    parser.add_argument("--codecs", type=str, nargs="+", default=list(CODECS), choices=list(CODECS), help="Codecs to benchmark. (default=all).")
+    parser.add_argument("--max_terms", type=int, default=None, help="Only use the postings of the first max_terms tokens of the lexicon. (default=all).")
+    args = parser.parse_args()
+
+    main(args.index_folder, args.codecs, args.max_terms)
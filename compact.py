@@ -0,0 +1,86 @@
+"""
+Index compaction
+
+Writes a copy of an index without the postings of its deleted
+documents (see delete.py). The document frequencies and the average
+document length are recomputed over the remaining documents, and
+the tokens that only occurred in deleted documents are dropped.
+
+The docnos do not change, so the per-document files (pmids,
+lengths, norms, forward index, document store) and deleted.bin are
+copied as they are. The stored weights are kept as well: only a
+rebuild weighs the documents with the new statistics.
+
+python3 compact.py pubmedSPIMIindex pubmedSPIMIindex_compacted
+
+"""
+import argparse, os, json, pickle, shutil
+from index import InvertedIndex, kgram_index
+from utils import file_checksum
+
+
+def compact_index(index, output_folder):
+    '''writes the postings of the remaining documents to a single postings file and copies the other index files'''
+    os.makedirs(output_folder, exist_ok=True)
+    deleted = index.get_deleted()
+
+    lexicon = {}
+    offset = postings_n = dropped_n = 0
+    with open(f"{output_folder}/postings0.bin", "wb") as f:
+        for token, entry in index.lexicon.items():
+            postings = index.get_postings(token)
+            kept = {docno: d for docno, d in postings.items() if docno not in deleted}
+            postings_n += len(postings)
+            dropped_n += len(postings) - len(kept)
+            if not kept: # the token only occurred in deleted documents
+                continue
+
+            data = index.codec.encode_postings(kept)
+            f.write(data)
+            lexicon[token] = [len(kept), 0, offset, len(data), max([d["w"] for d in kept.values()])]
+            offset += len(data)
+
+    with open(f"{output_folder}/{index.manifest['lexicon']}", "wb") as f:
+        pickle.dump(lexicon, f)
+    files = [index.manifest["lexicon"], "postings0.bin"]
+
+    if index.manifest.get("kgrams"): # the term ids are positions in the sorted lexicon, which lost tokens
+        with open(f"{output_folder}/{index.manifest['kgrams']['file']}", "wb") as f:
+            pickle.dump(kgram_index(lexicon, index.manifest["kgrams"]["k"]), f)
+        files.append(index.manifest["kgrams"]["file"])
+
+    lengths = index.get_lengths()
+    documents_n = index.manifest["documents_n"] - len(deleted)
+    manifest = dict(index.manifest)
+    manifest["shards"] = ["postings0.bin"]
+    manifest["avdl"] = (sum(lengths) - sum([lengths[docno] for docno in deleted])) / documents_n if documents_n else 0
+    manifest["compaction"] = {"deleted_n": len(deleted), "postings_n": postings_n, "dropped_n": dropped_n}
+
+    for filename in index.manifest["checksums"]:
+        if filename not in files and filename not in index.manifest["shards"]:
+            shutil.copyfile(f"{index.path_to_folder}/{filename}", f"{output_folder}/{filename}")
+            files.append(filename)
+    if deleted: # the documents are still in the docno space, the searchers keep skipping them
+        shutil.copyfile(f"{index.path_to_folder}/deleted.bin", f"{output_folder}/deleted.bin")
+    manifest["checksums"] = {f: file_checksum(f"{output_folder}/{f}") for f in files}
+
+    with open(f"{output_folder}/manifest.json", "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    print(f"Dropped {dropped_n} of {postings_n} postings of {len(deleted)} deleted documents, {len(index.lexicon)-len(lexicon)} tokens lost all their postings")
+    return InvertedIndex.load_from_disk(output_folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a copy of an index without the postings of its deleted documents")
+    parser.add_argument("index_folder", type=str, help="Folder of the index to be compacted.")
+    parser.add_argument("output_folder", type=str, help="Folder where the compacted index will be written.")
+    args = parser.parse_args()
+
+    with open(f"{args.index_folder}/manifest.json") as f:
+        if "shard_folders" in json.load(f):
+            parser.error("sharded indexes can not be compacted, their collection statistics are shared by every shard; rebuild them instead")
+    if os.path.abspath(args.index_folder) == os.path.abspath(args.output_folder):
+        parser.error("the output folder must not be the index folder")
+
+    compact_index(InvertedIndex.load_from_disk(args.index_folder), args.output_folder)
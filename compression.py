@@ -0,0 +1,306 @@
+"""
+Compression module
+
+Holds the codecs used to encode the postings lists.
+
+Every codec compresses a list of non-negative integers, the postings
+of a token are split into three of these lists (document gaps,
+term frequencies and position gaps) plus the weights, which are
+always stored as raw doubles.
+
+"""
+import struct
+from array import array
+
+
+def get_codec(name):
+    """Initializes the codec registered under `name`.
+
+    Parameters
+    ----------
+    name : str
+        one of the keys of the `CODECS` dict
+
+    Returns
+        ----------
+        Codec
+            codec instance
+    """
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}', choose one of {list(CODECS)}")
+    return CODECS[name]()
+
+
+def postings_to_streams(postings):
+    '''splits the postings {docno: {'w': w, 'positions': [pos1,pos2]}} into doc gaps, frequencies, position gaps and weights'''
+    doc_gaps, freqs, position_gaps, weights = [], [], [], array('d')
+    prev_docno = 0
+    for docno in sorted(postings):
+        doc_gaps.append(docno - prev_docno)
+        prev_docno = docno
+
+        positions = postings[docno]["positions"]
+        freqs.append(len(positions))
+        prev_pos = 0
+        for pos in positions:
+            position_gaps.append(pos - prev_pos)
+            prev_pos = pos
+
+        weights.append(postings[docno]["w"])
+
+    return doc_gaps, freqs, position_gaps, weights
+
+
+def arrays_to_streams(docnos, freqs, positions):
+    '''doc gaps and position gaps of postings held as flat lists (sorted docnos, frequencies and the positions of every document in docno order)'''
+    doc_gaps = [b - a for a, b in zip([0] + docnos[:-1], docnos)]
+    previous = [0] + positions[:-1]
+    start = 0
+    for freq in freqs: # the positions of each document are gaps from 0
+        previous[start] = 0
+        start += freq
+    position_gaps = [b - a for a, b in zip(previous, positions)]
+    return doc_gaps, position_gaps
+
+
+def streams_to_postings(doc_gaps, freqs, position_gaps, weights):
+    '''inverse of postings_to_streams'''
+    postings = {}
+    docno = pos_ptr = 0
+    for doc_gap, freq, w in zip(doc_gaps, freqs, weights):
+        docno += doc_gap
+        positions = []
+        pos = 0
+        for gap in position_gaps[pos_ptr:pos_ptr+freq]:
+            pos += gap
+            positions.append(pos)
+        pos_ptr += freq
+        postings[docno] = {'w': w, 'positions': positions}
+
+    return postings
+
+
+class Codec:
+    """
+    Top-level Codec class
+
+    Sub-classes only need to implement the `encode` and
+    `decode` of a list of integers, the layout of the postings
+    is shared by every codec:
+
+    [len(doc gaps)][len(freqs)][len(position gaps)][doc gaps][freqs][position gaps][weights]
+
+    """
+    postings_header = struct.Struct("<III")
+
+    def encode(self, values):
+        raise NotImplementedError()
+
+    def decode(self, data):
+        raise NotImplementedError()
+
+    def encode_postings(self, postings):
+        return self.encode_streams(*postings_to_streams(postings))
+
+    def encode_streams(self, doc_gaps, freqs, position_gaps, weights):
+        streams = [self.encode(doc_gaps), self.encode(freqs), self.encode(position_gaps)]
+        return self.postings_header.pack(*[len(s) for s in streams]) + b"".join(streams) + weights.tobytes()
+
+    def decode_postings(self, data):
+        return streams_to_postings(*self.decode_streams(data))
+
+    def decode_streams(self, data):
+        data = memoryview(data)
+        lens = self.postings_header.unpack_from(data)
+        streams = []
+        ptr = self.postings_header.size
+        for l in lens:
+            streams.append(self.decode(data[ptr:ptr+l]))
+            ptr += l
+
+        weights = array('d')
+        weights.frombytes(data[ptr:])
+        return (*streams, weights)
+
+
+class RawCodec(Codec):
+    '''fixed width, 4 bytes per integer'''
+
+    def encode(self, values):
+        return array('I', values).tobytes()
+
+    def decode(self, data):
+        values = array('I')
+        values.frombytes(data)
+        return values.tolist()
+
+
+class VByteCodec(Codec):
+    '''variable-byte: 7 bits per byte, the high bit marks the last byte of each integer'''
+
+    def encode(self, values):
+        out = bytearray()
+        for v in values:
+            while v >= 128:
+                out.append(v & 127)
+                v >>= 7
+            out.append(v | 128)
+        return bytes(out)
+
+    def decode(self, data):
+        values = []
+        v = shift = 0
+        for byte in bytes(data):
+            if byte & 128:
+                values.append(v | ((byte & 127) << shift))
+                v = shift = 0
+            else:
+                v |= byte << shift
+                shift += 7
+        return values
+
+
+class EliasFanoCodec(Codec):
+    '''
+    Elias-Fano over the prefix sums of the values (which are gaps, so the prefix sums are monotone).
+    Each prefix sum is split into `low_bits` stored verbatim and the remaining high part
+    stored in unary, which takes at most 2 + log(U/n) bits per integer.
+    '''
+    header = struct.Struct("<IIB")
+
+    def encode(self, values):
+        n = len(values)
+        if n == 0:
+            return self.header.pack(0, 0, 0)
+
+        sums = []
+        total = 0
+        for v in values:
+            total += v
+            sums.append(total)
+
+        low_bits = max(0, (total // n).bit_length() - 1) # floor(log2(U/n))
+        mask = (1 << low_bits) - 1
+
+        high = bytearray(((total >> low_bits) + n) // 8 + 1)
+        for i, s in enumerate(sums):
+            pos = (s >> low_bits) + i
+            high[pos >> 3] |= 1 << (pos & 7)
+
+        low = b""
+        if low_bits:
+            low_str = "".join([format(s & mask, f"0{low_bits}b") for s in sums])
+            low = int(low_str, 2).to_bytes((n*low_bits + 7) // 8, "big")
+
+        return self.header.pack(n, len(high), low_bits) + bytes(high) + low
+
+    def decode(self, data):
+        n, high_len, low_bits = self.header.unpack_from(data)
+        if n == 0:
+            return []
+
+        ptr = self.header.size
+        high = bytes(data[ptr:ptr+high_len])
+        highs = []
+        i = 0
+        for byte_n, byte in enumerate(high):
+            while byte: # visit only the set bits
+                lowest = byte & -byte
+                highs.append((byte_n << 3) + lowest.bit_length() - 1 - i)
+                i += 1
+                byte ^= lowest
+
+        if low_bits:
+            low_str = format(int.from_bytes(data[ptr+high_len:], "big"), f"0{n*low_bits}b")
+            sums = [(h << low_bits) | int(low_str[j*low_bits:(j+1)*low_bits], 2) for j, h in enumerate(highs[:n])]
+        else:
+            sums = highs[:n]
+
+        values = []
+        prev = 0
+        for s in sums:
+            values.append(s - prev)
+            prev = s
+        return values
+
+
+class BitPackingCodec(Codec):
+    '''
+    Frame-of-reference bit-packing vectorized with NumPy. The values are split in frames of
+    128 integers and each frame is packed with the bit width of its largest value. Frames
+    with the same width are packed together, so the work is done by a few NumPy calls per list.
+    NumPy is imported by the methods, so it is only loaded by the indexes that use this codec.
+    '''
+    frame_size = 128
+    header = struct.Struct("<I")
+
+    def group_bits(self, widths, width, padding):
+        '''number of bits used by the frames packed with `width`, the zeros that pad the last frame are not stored'''
+        bits_n = int((widths == width).sum()) * self.frame_size * int(width)
+        if widths[-1] == width:
+            bits_n -= padding * int(width)
+        return bits_n
+
+    def encode(self, values):
+        import numpy as np
+        n = len(values)
+        if n == 0:
+            return self.header.pack(0)
+
+        frames_n = (n + self.frame_size - 1) // self.frame_size
+        frames = np.zeros(frames_n * self.frame_size, dtype=np.uint32)
+        frames[:n] = values
+        frames = frames.reshape(frames_n, self.frame_size)
+        padding = frames_n * self.frame_size - n
+
+        maxs = frames.max(axis=1)
+        widths = np.zeros(frames_n, dtype=np.uint8)
+        nonzero = maxs > 0
+        widths[nonzero] = np.floor(np.log2(maxs[nonzero])).astype(np.uint8) + 1
+
+        packed = []
+        for width in np.unique(widths):
+            if width == 0:
+                continue
+            group = frames[widths == width]
+            bits = (group[..., None] >> np.arange(width, dtype=np.uint32)) & 1
+            bits = bits.astype(np.uint8).ravel()[:self.group_bits(widths, width, padding)]
+            packed.append(np.packbits(bits, bitorder="little").tobytes())
+
+        return self.header.pack(n) + widths.tobytes() + b"".join(packed)
+
+    def decode(self, data):
+        import numpy as np
+        n, = self.header.unpack_from(data)
+        if n == 0:
+            return []
+
+        frames_n = (n + self.frame_size - 1) // self.frame_size
+        padding = frames_n * self.frame_size - n
+        ptr = self.header.size
+        widths = np.frombuffer(data, dtype=np.uint8, count=frames_n, offset=ptr)
+        ptr += frames_n
+        buffer = np.frombuffer(data, dtype=np.uint8, offset=ptr)
+
+        frames = np.zeros((frames_n, self.frame_size), dtype=np.uint32)
+        for width in np.unique(widths):
+            if width == 0:
+                continue
+            selected = widths == width
+            bits_n = self.group_bits(widths, width, padding)
+            bytes_n = (bits_n + 7) // 8
+            bits = np.zeros(int(selected.sum()) * self.frame_size * int(width), dtype=np.uint32)
+            bits[:bits_n] = np.unpackbits(buffer[:bytes_n], count=bits_n, bitorder="little")
+            buffer = buffer[bytes_n:]
+            bits = bits.reshape(-1, self.frame_size, int(width))
+            frames[selected] = (bits << np.arange(width, dtype=np.uint32)).sum(axis=2, dtype=np.uint32)
+
+        return frames.ravel()[:n].tolist()
+
+
+CODECS = {
+    "raw": RawCodec,
+    "vbyte": VByteCodec,
+    "eliasfano": EliasFanoCodec,
+    "bitpacking": BitPackingCodec,
+}
@@ -10,10 +10,9 @@ based on the operation mode.
 """
 import time
 
-from tokenizers import dynamically_init_tokenizer, PubMedTokenizer
+# the index and searcher modules are imported by the mode that needs them, which keeps the startup short
+from tokenizers import dynamically_init_tokenizer
 from reader import dynamically_init_reader
-from index import dynamically_init_indexer, BaseIndex
-from searcher import dynamically_init_searcher
 
 def add_more_options_to_indexer(indexer_parser, indexer_settings_parser, indexer_doc_parser):
     """Add more options to the main program argparser.
@@ -51,7 +50,148 @@ def add_more_options_to_indexer(indexer_parser, indexer_settings_parser, indexer
     indexer_doc_parser.add_argument('--indexer.ranking_schema', 
                             type=str, 
                             default="tfidf",
-                            help='Choose indexer ranking schema. (default=tfidf).')
+                            choices=["tfidf", "bm25", "tf"],
+                            help='Choose indexer ranking schema. tfidf and bm25 store the weights in the postings, tf stores the raw term frequencies so that any bm25 or tf-idf parameters can be chosen at query time. (default=tfidf).')
+
+    indexer_settings_parser.add_argument('--indexer.codec', 
+                            type=str, 
+                            default="vbyte",
+                            choices=["raw", "vbyte", "eliasfano", "bitpacking"],
+                            help='Codec used to compress the postings lists. (default=vbyte).')
+
+    indexer_settings_parser.add_argument('--indexer.forward_index', 
+                            action="store_true",
+                            help='Also writes a forward index (the tokens and term frequencies of each document), needed by the query expansion of the searcher.')
+
+    indexer_settings_parser.add_argument('--indexer.docstore', 
+                            action="store_true",
+                            help='Also stores the titles and abstracts in compressed blocks, so the searcher can show them in the results.')
+
+    indexer_settings_parser.add_argument('--indexer.fields', 
+                            action="store_true",
+                            help='Also stores the number of title tokens of each document, so the searcher can tell the title and abstract term frequencies apart in the postings (ranking.bm25f). The title is tokenized on its own, use with --indexer.ranking_schema tf.')
+
+    indexer_settings_parser.add_argument('--indexer.champions_r', 
+                            type=int, 
+                            default=0,
+                            help='Also writes a first index tier with the r postings of highest weight of each token, used by --searcher.tiered. 0 disables it (default=0).')
+
+    indexer_settings_parser.add_argument('--indexer.shards', 
+                            type=int, 
+                            default=2,
+                            help='Number of document partitions built in parallel by the ShardedIndexer (--indexer.class ShardedIndexer). (default=2).')
+
+    indexer_settings_parser.add_argument('--indexer.kgrams', 
+                            type=int, 
+                            default=0,
+                            help='Also writes a k-gram index of the lexicon with this k, used by the infix and suffix wildcard queries (*virus). Prefix queries (immuno*) do not need it. 0 disables it (default=0).')
+
+    indexer_settings_parser.add_argument('--indexer.run_compression', 
+                            action="store_true",
+                            help='Compresses the temporary blocks with zlib, less disk I/O for slower indexing and merging. Useful on slow disks.')
+
+    indexer_settings_parser.add_argument('--indexer.max_fan_in', 
+                            type=int, 
+                            default=None,
+                            help='Maximum number of temporary blocks merged at once by each merge process, more blocks are merged in several levels. (default=from the memory threshold and the open files limit).')
+
+    indexer_settings_parser.add_argument('--indexer.merge_workers', 
+                            type=int, 
+                            default=None,
+                            help='Number of processes that merge the temporary blocks, each one merges a range of tokens. (default=number of cores).')
+
+    indexer_parser.add_argument('--resume', 
+                            action="store_true",
+                            help='Continues an interrupted build from the last checkpoint in <index_output_folder> (written after each temporary block and merge level) instead of starting from scratch.')
+
+    indexer_parser.add_argument('--profile', 
+                            action="store_true",
+                            help='Runs the index build under cProfile and saves the profile to <index_output_folder>/profile.prof.')
+
+def add_more_options_to_searcher(searcher_parser, searcher_modes_parser):
+    """Add more options to the searcher mode of the main 
+    program argparser, it works in the same way as the
+    `add_more_options_to_indexer` function.
+
+    Parameters
+    ----------
+    searcher_parser : ArgumentParser
+        This is the base argparser used during the searcher
+        mode. The options added under the `searcher` group 
+        are sent to the ranking class.
+    searcher_modes_parser : argparse._SubParsersAction
+        Holds the mutual exclusive ranking modes (ranking.bm25,
+        ranking.tfidf), new ranking modes should be added here.
+
+    """
+    bm25f_mode_parser = searcher_modes_parser.add_parser('ranking.bm25f', help='Uses BM25F over the title and abstract fields, needs an index built with --indexer.fields and --indexer.ranking_schema tf')
+    bm25f_mode_parser.add_argument("--ranking.bm25f.class", type=str, default="BM25FRanking")
+    bm25f_mode_parser.add_argument("--ranking.bm25f.k1", type=float, default=1.2)
+    bm25f_mode_parser.add_argument("--ranking.bm25f.weights", type=float, nargs=2, default=[3.0, 1.0],
+                                   help='Weight of a title and of an abstract occurrence (default=3 1).')
+    bm25f_mode_parser.add_argument("--ranking.bm25f.b", type=float, nargs=2, default=[0.5, 0.75],
+                                   help='Length normalization of the title and of the abstract (default=0.5 0.75).')
+
+    sweep_mode_parser = searcher_modes_parser.add_parser('ranking.sweep', help='Evaluates a grid of bm25 and tf-idf settings in a single pass over the questions, needs an index built with --indexer.ranking_schema tf')
+    sweep_mode_parser.add_argument("--ranking.sweep.class", type=str, default="SweepRanking")
+    sweep_mode_parser.add_argument("--ranking.sweep.k1", type=float, nargs="*", default=[0.6, 0.9, 1.2, 1.5, 1.8, 2.1],
+                                   help='bm25 k1 values of the grid (default=0.6 0.9 1.2 1.5 1.8 2.1).')
+    sweep_mode_parser.add_argument("--ranking.sweep.b", type=float, nargs="*", default=[0.25, 0.5, 0.75, 1.0],
+                                   help='bm25 b values of the grid (default=0.25 0.5 0.75 1.0).')
+    sweep_mode_parser.add_argument("--ranking.sweep.smart", type=str, nargs="*", default=["lnc.ltc"],
+                                   help='SMART notations of the tf-idf settings (default=lnc.ltc).')
+
+    searcher_settings_parser = searcher_parser.add_argument_group('Searcher settings', 'This settings are related to how the queries are processed.')
+
+    searcher_settings_parser.add_argument('--searcher.max_accumulators', 
+                                type=int, 
+                                default=100000,
+                                help='Maximum number of documents scored per query, bounds the memory used by each query, 0 means unlimited (default=100000).')
+
+    searcher_settings_parser.add_argument('--searcher.accumulator_strategy', 
+                                type=str, 
+                                default="continue",
+                                choices=["quit", "continue"],
+                                help='What to do when the accumulators limit is reached: stop processing the query (quit) or only keep updating the existing accumulators (continue). (default=continue).')
+
+    searcher_settings_parser.add_argument('--searcher.prefetch_threads', 
+                                type=int, 
+                                default=4,
+                                help='Number of threads that read the postings of the query terms in the background, while the ones already read are scored. 0 disables prefetching (default=4).')
+
+    searcher_settings_parser.add_argument('--searcher.tiered', 
+                                action="store_true",
+                                help='Answers the queries from the champion lists (--indexer.champions_r) and only reads the full postings when they give less than top_k documents. Faster but approximate.')
+
+    searcher_settings_parser.add_argument('--searcher.max_expansions', 
+                                type=int, 
+                                default=50,
+                                help='Maximum number of tokens a wildcard query term (immuno*, *virus) is expanded to, the ones with the highest df are kept (default=50).')
+
+    searcher_settings_parser.add_argument('--searcher.trace', 
+                                type=str, 
+                                default=None,
+                                help='Writes a JSON record of each query to this file (stage timings, bytes read, postings touched, accumulators, cache hits) and prints a latency histogram at the end. (default=no tracing).')
+
+    searcher_settings_parser.add_argument('--searcher.time_budget_ms', 
+                                type=float, 
+                                default=None,
+                                help='Time budget of each query in milliseconds. When it runs out the scoring stops and the best top_k found so far is returned, marked as approximate. (default=no budget).')
+
+    searcher_settings_parser.add_argument('--searcher.rm3.fb_docs', 
+                                type=int, 
+                                default=0,
+                                help='Number of top documents used to expand the query with RM3 pseudo-relevance feedback, requires an index built with --indexer.forward_index. 0 disables the expansion (default=0).')
+
+    searcher_settings_parser.add_argument('--searcher.rm3.fb_terms', 
+                                type=int, 
+                                default=10,
+                                help='Number of expansion terms added by RM3 (default=10).')
+
+    searcher_settings_parser.add_argument('--searcher.rm3.original_query_weight', 
+                                type=float, 
+                                default=0.5,
+                                help='Weight of the original query when interpolated with the RM3 feedback model (default=0.5).')
 
 def engine_logic(args):
     """
@@ -76,7 +216,9 @@ def engine_logic(args):
                       args.index_output_folder,
                       args.indexer,
                       args.reader,
-                      args.tk)
+                      args.tk,
+                      args.profile,
+                      args.resume)
         
     elif args.mode == "searcher":
         ## TO BE DONE
@@ -87,7 +229,8 @@ def engine_logic(args):
                        args.top_k,
                        args.reader,
                        args.tk,
-                       args.ranking)
+                       args.ranking,
+                       args.searcher)
         
     else:
         # this should be ensured by the argparser
@@ -98,7 +241,9 @@ def indexer_logic(path_to_collection,
                   index_output_folder, 
                   indexer_args, 
                   reader_args, 
-                  tk_args):
+                  tk_args,
+                  profile=False,
+                  resume=False):
     """
     Entrypoint for the main indexer logic. Here we start by
     dynamically loading the main modules (reader, tokenizer,
@@ -123,16 +268,27 @@ def indexer_logic(path_to_collection,
     tokenizer = dynamically_init_tokenizer(**tk_args.get_kwargs())
     
     # init indexer
+    from index import dynamically_init_indexer
     indexer = dynamically_init_indexer(**indexer_args.get_kwargs())
     
     # execute the indexer logic
-    indexer.build_index(reader, tokenizer, index_output_folder)
+    if profile:
+        import cProfile, pstats
+        profiler = cProfile.Profile()
+        profiler.runcall(indexer.build_index, reader, tokenizer, index_output_folder, resume)
+    else:
+        indexer.build_index(reader, tokenizer, index_output_folder, resume)
     
     # get the final index
     index = indexer.get_index()
     
     # print some statistics about the produced index
     indexer.print_statistics(index_output_folder)
+
+    if profile:
+        profiler.dump_stats(f"{index_output_folder}/profile.prof")
+        print(f"\nPROFILE (saved to {index_output_folder}/profile.prof):")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
     
     
     
@@ -142,7 +298,8 @@ def searcher_logic(index_folder,
                    top_k,
                    reader_args,
                    tk_args,
-                   ranking_args):
+                   ranking_args,
+                   searcher_args):
 
 
     reader = dynamically_init_reader(path_to_questions=path_to_questions,
@@ -150,10 +307,20 @@ def searcher_logic(index_folder,
     
     
 
-    ranker = dynamically_init_searcher(**ranking_args.get_kwargs())
+    from index import load_index, ShardedIndex
+    from searcher import dynamically_init_searcher, ShardCoordinator
+
+    searcher_kwargs = {**ranking_args.get_kwargs(), **searcher_args.get_kwargs()}
+    ranker = dynamically_init_searcher(**searcher_kwargs)
 
     # load the index from disk
-    index = BaseIndex.load_from_disk(index_folder)
+    index = load_index(index_folder)
+    if isinstance(index, ShardedIndex): # the shards are searched by worker processes
+        ranker.coordinator = ShardCoordinator(index, searcher_kwargs)
+
+    ranking_schema = index.get_ranking_schema()
+    if ranking_schema and ranking_schema != "tf" and not ranker.__class__.__name__.lower().startswith(ranking_schema):
+        print(f"WARNING: the index weights were computed for {ranking_schema}, but {ranker.__class__.__name__} is being used")
 
     stored_tokenizer_kwargs = index.get_tokenizer_kwargs()
     if stored_tokenizer_kwargs:
@@ -165,9 +332,7 @@ def searcher_logic(index_folder,
         # the tokenizer was not saved in the index so lets use the one defined in the CLI (and use the default values if not defined)
         tk_kwargs = tk_args.get_kwargs()
 
-    # o esqueleto está a dar problemas com isto, por isso vou comentar
-    #tokenizer = dynamically_init_tokenizer(**tk_kwargs)
-    tokenizer = PubMedTokenizer(minL=3, stopwords_path="stopw.txt", stemmer=None, case_folding=True, allow_numbers=False)
+    tokenizer = dynamically_init_tokenizer(**tk_kwargs)
 
     #ranker.batch_search(index, reader, tokenizer, output_file, top_k=top_k)
-    ranker.search(tokenizer, index_folder, top_k, reader)
+    ranker.search(tokenizer, index, top_k, reader)
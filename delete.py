@@ -0,0 +1,36 @@
+"""
+Document deletion
+
+Marks documents of an index as deleted without re-indexing them
+(retracted or replaced articles). Their docnos are recorded in the
+deleted.bin file of the index folder, the searchers skip them and
+N only counts the remaining documents. Their postings are dropped
+by compact.py or by the next build of the index in the same folder.
+
+python3 delete.py pubmedSPIMIindex 31452345 31452346
+python3 delete.py pubmedSPIMIindex --pmids_file retracted.txt
+
+"""
+import argparse
+from index import load_index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deletes documents from an index, without re-indexing")
+    parser.add_argument("index_folder", type=str, help="Folder of the index (a single or a sharded index).")
+    parser.add_argument("pmids", type=int, nargs="*", help="Pmids of the documents to delete.")
+    parser.add_argument("--pmids_file", type=str, default=None, help="File with one pmid per line to delete. (default=none).")
+    args = parser.parse_args()
+
+    pmids = set(args.pmids)
+    if args.pmids_file:
+        with open(args.pmids_file) as f:
+            pmids.update([int(line) for line in f if line.strip()])
+    if not pmids:
+        parser.error("no pmids to delete")
+
+    index = load_index(args.index_folder)
+    not_found = index.delete_documents(pmids)
+    print(f"Deleted {len(pmids) - len(not_found)} documents from {args.index_folder}")
+    if not_found:
+        print(f"WARNING: {len(not_found)} pmids are not in the index: {sorted(not_found)[:10]}")
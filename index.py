@@ -9,9 +9,16 @@ and the index managment.
 
 """
 
-import pickle, os, glob, time, sys, shutil
+import pickle, os, glob, time, sys, shutil, json, struct, zlib, heapq, itertools, re
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
 from math import log10, sqrt
-from utils import dynamically_init_class, Timer, Block, malloc_trim, extract_data_from_index
+from array import array
+from compression import get_codec, arrays_to_streams
+from reader import ShardReader
+from utils import dynamically_init_class, Timer, StageTimer, ResourceMonitor, malloc_trim, extract_data_from_index, file_checksum
 
 
 def dynamically_init_indexer(**kwargs):
@@ -53,7 +60,7 @@ class Indexer:
     def get_index(self):
         return self._index
     
-    def build_index(self, reader, tokenizer, index_output_folder):
+    def build_index(self, reader, tokenizer, index_output_folder, resume=False):
         """
         Holds the logic for the indexing algorithm.
         
@@ -69,6 +76,9 @@ class Indexer:
         index_output_folder: str
             the folder where the resulting index or indexes should
             be stored, with some additional information.
+        resume: bool
+            continue an interrupted build from the last checkpoint
+            saved in index_output_folder, if there is one.
             
         """
         raise NotImplementedError()
@@ -86,6 +96,16 @@ class SPIMIIndexer(Indexer):
                  memory_threshold,
                  tfidf,
                  ranking_schema,
+                 codec="vbyte",
+                 forward_index=False,
+                 docstore=False,
+                 champions_r=0,
+                 defer_bm25=False,
+                 merge_workers=None,
+                 kgrams=0,
+                 run_compression=False,
+                 max_fan_in=None,
+                 fields=False,
                  **kwargs):
         # lets suppose that the SPIMIIindex uses the inverted index, so
         # it initializes this type of index
@@ -95,9 +115,33 @@ class SPIMIIndexer(Indexer):
         self.ranking_schema = ranking_schema
         self.k1 = kwargs.get("bm25")["k1"]
         self.b = kwargs.get("bm25")["b"]
+        self.codec_name = codec
+        self.codec = get_codec(codec)
+        self.forward_index = forward_index
+        self.forward_writer = None
+        self.docstore = docstore
+        self.docstore_writer = None
+        self.champions_r = champions_r
+        self.defer_bm25 = defer_bm25 and ranking_schema == "bm25" # the sharded indexer computes the weights once the collection statistics are known
+        self.merge_workers = merge_workers or os.cpu_count()
+        self.kgrams = kgrams
+        self.run_compression = run_compression # zlib compressed blocks, for slow disks
+        self.max_fan_in = max_fan_in # runs merged at once by each merge process, None: from the memory budget and the file descriptor limit
+        self.fields = fields # the title tokens come first, their count per document gives the title tf from the positions
+        self.block_offsets = [] # sparse token offsets of each block
+        self.runs = [] # run files to be merged, the blocks or the runs of the last merge level
+        self.merge_level = 0
+        self.checkpoint = {} # last checkpoint.json written
+        self.sparse_step = 64
+        # memory of the inversion buffers: each token has a tuple of 4 arrays (plus its dict entry and string), each posting a docno, a weight, a tf and its positions
+        self.term_overhead = sys.getsizeof((0, 0, 0, 0)) + 4*sys.getsizeof(array('I')) + 100
+        self.posting_bytes = 4 + 8 + 4
+        self.buffer_bytes = 0
         self.statistics = {"merging_time": 0, "temp_index_segments_n": 0}
         self.logarithm = {} # store pre-calculated logarithms to fetch them later
         self.timer = Timer()
+        self.stages = StageTimer() # per-stage timings (read, parse, tokenize, invert, dump, merge, weights)
+        self.monitor = None
 
 # ------------------------ determines memory threshold ----------------------- #
         available_mem = int(os.popen('free -m').readlines()[1].split()[-1])
@@ -107,139 +151,476 @@ class SPIMIIndexer(Indexer):
         self.memory_threshold = min(memory_threshold*0.7, available_mem*1e6*0.7)
 # ---------------------------------------------------------------------------- #
 
-        print("init SPIMIIndexer|", f"{posting_threshold=}, {memory_threshold=}")
+        print("init SPIMIIndexer|", f"{posting_threshold=}, {memory_threshold=}, {codec=}, {forward_index=}, {docstore=}, {champions_r=}, {merge_workers=}, {kgrams=}, {run_compression=}, {max_fan_in=}, {fields=}")
         if kwargs:
             print(f"{self.__class__.__name__} also caught the following additional arguments {kwargs}")
 
 
-    def build_index(self, reader, tokenizer, index_output_folder): 
+    def build_index(self, reader, tokenizer, index_output_folder, resume=False, deleted_pmids=None): 
+        '''deleted_pmids: documents that are not indexed, by default the ones deleted from the index being rebuilt'''
         print("Indexing some documents...")
+        self.monitor = ResourceMonitor()
         self.timer.start() 
-        block_n = dl_sum = 0
+        block_n = dl_sum = doc_n = 0
+        self.postings_files = []
+        self.block_offsets = []
+        self.runs = []
+        self.merge_level = 0
+        self.doc_ids = array('I') # docno -> pmid, postings use dense docnos since their gaps compress much better than pmids
         index =  {} # {token : df}
-        postings = {} # {token : # {pmid1: {'w': norm_w1, 'positions': [pos1,pos2]}, pmid2: {'w': norm_w2, 'positions': [pos1,pos2]}}}
-        dl_lens = {} # used to store document lengths for bm25
-
-        if os.path.exists(index_output_folder): # make a new dir to save temporary blocks as well as final index
-            shutil.rmtree(index_output_folder)
-        os.makedirs(index_output_folder)
-
+        postings = {} # {token : (docnos, weights, tfs, positions)} arrays, the positions of every docno one after the other
+        self.buffer_bytes = 0 # memory used by the postings buffers
+        dl_lens = array('I') # used to store document lengths for bm25 (indexed by docno)
+        norms = array('d') # lnc cosine norm of each docno, only for the tf schema
+        title_lens = array('I') # number of title tokens of each docno, only with fields
+
+        settings = self.checkpoint_settings(reader, tokenizer)
+        checkpoint = self.load_checkpoint(index_output_folder, settings) if resume else None
+        if checkpoint is None:
+            if deleted_pmids is None:
+                deleted_pmids = read_deleted_pmids(index_output_folder) # the documents deleted from the previous index stay deleted
+            if os.path.exists(index_output_folder): # make a new dir to save temporary blocks as well as final index
+                shutil.rmtree(index_output_folder)
+            os.makedirs(index_output_folder)
+            self.checkpoint = {"settings": settings, "phase": "indexing", "documents_n": 0, "dl_sum": 0, "reader_offset": None,
+                               "deleted_pmids": deleted_pmids, "skipped_n": 0}
+        else: # the documents of the blocks already written are skipped
+            doc_n, dl_sum = checkpoint["documents_n"], checkpoint["dl_sum"]
+            block_n = len(self.runs)
+            counts = {"documents": doc_n, "lengths": doc_n, "norms": doc_n if self.ranking_schema == "tf" else 0, "title_lengths": doc_n if self.fields else 0}
+            for values, name in ((self.doc_ids, "documents"), (dl_lens, "lengths"), (norms, "norms"), (title_lens, "title_lengths")):
+                values.extend(self.load_checkpoint_array(index_output_folder, name, values.typecode, counts[name]))
+            self.statistics["temp_index_segments_n"] = checkpoint["blocks_n"]
+            print(f"Resuming the {checkpoint['phase']} phase after {doc_n} documents and {checkpoint['blocks_n']} blocks")
+
+        if self.forward_index:
+            self.forward_writer = ForwardIndexWriter(self.codec, index_output_folder)
+        if self.docstore:
+            self.docstore_writer = DocumentStoreWriter(index_output_folder)
+
+        deleted_pmids = set(self.checkpoint["deleted_pmids"])
+        if deleted_pmids:
+            print(f"Skipping the {len(deleted_pmids)} documents that were deleted from the previous index")
         i = 0
-        reader_gen = reader.read()
+        reader_gen = self.timed_read(reader, checkpoint)
         for doc in reader_gen:
+            if deleted_pmids and int(doc["pmid"]) in deleted_pmids:
+                self.checkpoint["skipped_n"] += 1 # the resumed build skips them again when it can not seek
+                continue
             i+=1
+            docno = doc_n
+            doc_n+=1 # unlike i, this counter is not reset when a block is dumped
+            self.doc_ids.append(int(doc["pmid"]))
             text = doc["title"]+" "+doc["abstract"]
-            tokens = tokenizer.tokenize(text)
 
+            if self.docstore_writer:
+                self.stages.start("docstore")
+                self.docstore_writer.add_document(doc)
+                self.stages.stop("docstore")
+            self.stages.start("tokenize")
+            if self.fields: # same tokens, but the title ones are counted
+                tokens = tokenizer.tokenize(doc["title"])
+                title_lens.append(len(tokens))
+                tokens += tokenizer.tokenize(doc["abstract"])
+            else:
+                tokens = tokenizer.tokenize(text)
+            self.stages.stop("tokenize")
+
+            if self.forward_writer:
+                self.stages.start("forward")
+                self.forward_writer.add_document(tokens)
+                self.stages.stop("forward")
+
+            self.stages.start("invert")
+            doc_positions = {} # token -> its positions in this document
             for count, t in enumerate(tokens):
-                pmid = int(doc["pmid"])
-
-                if t not in index:
-                    index[t] = 1
-
-                if t not in postings:
-                    postings[t] = {pmid: {'w': 1, 'positions': [count]}}
+                if t in doc_positions:
+                    doc_positions[t].append(count)
                 else:
-                    if pmid in postings[t]:
-                        postings[t][pmid]['w'] += 1 # increment tf
-                        postings[t][pmid]['positions'].append(count)
-                    else:
-                        postings[t][pmid] = {'w': 1, 'positions': [count]}
-
-                        if t in index:
-                            index[t] += 1 # increment df
-
-            if self.ranking_schema == "bm25":
-                l = len(tokens)
-                dl_sum += l
-                dl_lens[pmid] = l
-            else: # if the chosen ranking schema is tf-idf (default schema)
-                postings = self.calc_norm_tfidf_weights(pmid, tokens, postings) # now that we have the tf of each token, we can calculate the tfidf weights for each token in this doc
-
-            postings, i, block_n = self.dump_if_threshold_reached(index, postings, i, block_n, index_output_folder)
+                    doc_positions[t] = [count]
+            self.stages.stop("invert")
+
+            weights = None # the raw tfs, for the tf and bm25 schemas
+            if self.ranking_schema == "tf": # raw tfs are stored, the searcher computes the weights
+                norms.append(sqrt(sum([(1 + self.log(len(p)))**2 for p in doc_positions.values()])) or 1)
+            elif self.ranking_schema != "bm25": # if the chosen ranking schema is tf-idf (default schema)
+                self.stages.start("weights")
+                weights = self.calc_norm_tfidf_weights(doc_positions) # now that we have the tf of each token, we can calculate the tfidf weights for each token in this doc
+                self.stages.stop("weights")
+
+            self.stages.start("invert")
+            for t, positions in doc_positions.items():
+                if t not in postings:
+                    postings[t] = (array('I'), array('d'), array('I'), array('I')) # docnos, weights, tfs and the positions of every docno
+                    self.buffer_bytes += self.term_overhead
+                    index[t] = 0
+                index[t] += 1 # increment df
+                buffers = postings[t]
+                buffers[0].append(docno)
+                buffers[1].append(weights[t] if weights else len(positions))
+                buffers[2].append(len(positions))
+                buffers[3].extend(positions)
+                self.buffer_bytes += self.posting_bytes + 4*len(positions)
+            self.stages.stop("invert")
+
+            l = len(tokens)
+            dl_sum += l
+            dl_lens.append(l)
+
+            postings, i, dumped_n = self.dump_if_threshold_reached(index, postings, i, block_n, index_output_folder)
+            if dumped_n != block_n: # every document read so far is in a block
+                block_n = dumped_n
+                self.write_checkpoint(index_output_folder, "indexing", doc_n, dl_sum, getattr(reader, "offset", None), [self.doc_ids, dl_lens, norms, title_lens])
 
 
         # ---------------------- Save index and postings to disk --------------------- #
 
-        sorted_postings = dict(sorted(postings.items(), key=lambda x: x[0]))
         self.statistics["total_indexing_time"] = self.timer.stop()
+        self.statistics["deleted_documents_skipped"] = self.checkpoint["skipped_n"]
 
         merge = block_n # False if block_n==0 else True
         if merge: # if postings were dumped because of memory constraints, we first need to merge the postings
-            self.dump_block(sorted_postings, block_n, index_output_folder) # dump current/last block
-            self.timer.start()
+            if postings: # the last block may be empty if the threshold was reached on the last document
+                self.dump_block(postings, block_n, index_output_folder) # dump current/last block
+                block_n += 1
+            if self.checkpoint["phase"] == "indexing":
+                self.statistics["temp_index_segments_n"] = block_n
+                self.write_checkpoint(index_output_folder, "merge", doc_n, dl_sum, getattr(reader, "offset", None), [self.doc_ids, dl_lens, norms, title_lens])
+            self.monitor.sample()
+            self.stages.start("merge")
             index = self.merge_blocks(index, index_output_folder)
-            self.statistics["merging_time"] = self.timer.stop()
+            self.statistics["merging_time"] = self.stages.stop("merge")
         
+        if not merge:
+            self.postings_files.append("postings0.bin")
+            entries = write_arrays_file(self.codec, {t: postings[t] for t in sorted(postings)}, f"./{index_output_folder}/postings0.bin") # save postings to disk
+            for t, (df, offset, length, max_w) in entries.items():
+                index[t] = [df, 0, offset, length, max_w]
+
+        avdl = dl_sum / doc_n if doc_n else 0
+        if self.ranking_schema == "bm25" and not self.defer_bm25: # if bm25 schema is selected, calc bm25 weights
+            self.stages.start("weights")
+            self.calc_bm25_weights(doc_n, avdl, dl_lens, index, index_output_folder)
+            self.stages.stop("weights")
+
+        if self.champions_r and not self.defer_bm25: # the champions depend on the final weights
+            self.stages.start("champions")
+            self.write_champions(index, index_output_folder)
+            self.stages.stop("champions")
+
+        # the lexicon is written last since the postings writers fill in the location of each token
         sorted_index = dict(sorted(index.items(), key=lambda x: x[0]))
         self.write_to_disk(sorted_index, "index", "", index_output_folder) # save index to disk
+        if self.kgrams:
+            self.stages.start("kgrams")
+            self.write_kgram_index(sorted_index, index_output_folder)
+            self.stages.stop("kgrams")
         self.statistics["vocabulary_size"] = len(index)
 
-        if not merge:
-            self.write_to_disk(sorted_postings, "postings", 0, index_output_folder) # save postings to disk
-
-        if self.ranking_schema == "bm25": # if bm25 schema is selected, calc bm25 weights
-            avdl = dl_sum / i
-            self.calc_bm25_weights(i, avdl, dl_lens, index, index_output_folder)
-
-        with open("document_N.txt", "w") as f:
-            f.write(str(i))
+        with open(f"./{index_output_folder}/documents.bin", "wb") as f:
+            self.doc_ids.tofile(f)
+        with open(f"./{index_output_folder}/lengths.bin", "wb") as f:
+            dl_lens.tofile(f)
+        if self.ranking_schema == "tf":
+            with open(f"./{index_output_folder}/norms_lnc.bin", "wb") as f:
+                norms.tofile(f)
+        fields = None
+        if self.fields:
+            with open(f"./{index_output_folder}/title_lengths.bin", "wb") as f:
+                title_lens.tofile(f)
+            title_sum = sum(title_lens)
+            fields = {"names": ["title", "abstract"], "title_lengths": "title_lengths.bin", # the abstract lengths are the rest of each document
+                      "avg_lengths": [title_sum / doc_n, (dl_sum - title_sum) / doc_n] if doc_n else [0, 0]}
+
+        if self.forward_writer:
+            self.forward_writer.close()
+        if self.docstore_writer:
+            self.docstore_writer.close()
+
+        manifest = self.write_manifest(tokenizer, doc_n, avdl, index_output_folder, fields)
+        self.delete_temp_index_blocks(index_output_folder) # kept until the index is complete, a resumed build merges them again
+        self._index = InvertedIndex(index_output_folder, manifest, sorted_index, self.doc_ids)
+
+    # ------------------------------- checkpoints ------------------------------- #
+
+    def checkpoint_settings(self, reader, tokenizer):
+        '''settings that must not change between a build and its resumption'''
+        return {"collection": getattr(reader, "path_to_collection", None), "tokenizer": tokenizer.get_kwargs(), "ranking_schema": self.ranking_schema,
+                "tfidf": self.tfidf, "posting_threshold": self.posting_threshold, "run_compression": self.run_compression, "sparse_step": self.sparse_step,
+                "fields": self.fields}
+
+    def write_checkpoint(self, index_output_folder, phase, doc_n, dl_sum, reader_offset, arrays):
+        '''
+        Writes checkpoint.json, after each block dump and each merge level. The per-document arrays (pmids, lengths
+        and norms) only grow, so the values added since the previous checkpoint are appended to checkpoint_<name>.bin.
+        The json is replaced atomically, a crash leaves the previous checkpoint
+        '''
+        for values, name in zip(arrays, ["documents", "lengths", "norms", "title_lengths"]):
+            with open(f"./{index_output_folder}/checkpoint_{name}.bin", "ab") as f:
+                values[self.checkpoint["documents_n"]:].tofile(f)
+
+        if self.checkpoint["phase"] == "indexing":
+            self.checkpoint["blocks_n"] = len(self.runs)
+        self.checkpoint.update(phase=phase, documents_n=doc_n, dl_sum=dl_sum, reader_offset=reader_offset,
+                               runs=self.runs, block_offsets=self.block_offsets, merge_level=self.merge_level)
+        with open(f"./{index_output_folder}/checkpoint.json.tmp", "w") as f:
+            json.dump(self.checkpoint, f)
+        os.replace(f"./{index_output_folder}/checkpoint.json.tmp", f"./{index_output_folder}/checkpoint.json")
+
+    def load_checkpoint(self, index_output_folder, settings):
+        '''restores the runs of the last checkpoint of an interrupted build, None if the build has to start from scratch'''
+        path = f"./{index_output_folder}/checkpoint.json"
+        if not os.path.exists(path):
+            print(f"WARNING: there is no checkpoint in {index_output_folder}, the index is built from scratch")
+            return None
+        if self.forward_index or self.docstore:
+            print("WARNING: builds with a forward index or a document store can not be resumed, the index is built from scratch")
+            return None
 
-        self._index = index
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint["settings"] != json.loads(json.dumps(settings)):
+            print(f"WARNING: the checkpoint was written with other settings ({checkpoint['settings']}), the index is built from scratch")
+            return None
 
-    def merge_blocks(self, index, index_output_folder):
-        '''The priority token is the next token to be inserted in the merged index (chosen by its alphabetic order)'''
-        postings = {} # {token : # {pmid1: {'w': norm_w1, 'positions': [pos1,pos2]}, pmid2: {'w': norm_w2, 'positions': [pos1,pos2]}}}
-        ptr = 0
-        block_paths = glob.glob(f"./{index_output_folder}/block*.pkl")
-        blocks_reader = [open(b, "rb") for b in block_paths] # read all blocks simultaneously
-        blocks = [pickle.load(b) for b in blocks_reader] # advance read buffer by one for each block and store the read elements
-        tokens = [b.token for b in blocks] # this list is used to perform a min() comparison between the elements of the blocks to choose the next element to be merged
+        self.checkpoint = checkpoint
+        self.runs = checkpoint["runs"]
+        self.block_offsets = [[tuple(o) for o in offsets] for offsets in checkpoint["block_offsets"]]
+        self.merge_level = checkpoint["merge_level"]
+        for filename in os.listdir(index_output_folder): # blocks and runs written after the checkpoint
+            if filename.endswith(".run") and filename not in self.runs:
+                os.remove(f"{index_output_folder}/{filename}")
+        return checkpoint
+
+    def load_checkpoint_array(self, index_output_folder, name, typecode, n):
+        '''first n values of checkpoint_<name>.bin, the file is truncated to them so the next checkpoint appends after them'''
+        values = array(typecode)
+        with open(f"./{index_output_folder}/checkpoint_{name}.bin", "r+b") as f:
+            values.fromfile(f, n)
+            f.truncate(n * values.itemsize)
+        return values
+
+    def write_manifest(self, tokenizer, doc_n, avdl, index_output_folder, fields=None):
+        '''writes manifest.json, which holds everything the searcher needs to open this index'''
+        ranking = {"schema": self.ranking_schema}
+        files = ["index.pkl", "documents.bin", "lengths.bin"] + self.postings_files
+        if fields:
+            files.append(fields["title_lengths"])
+        if self.ranking_schema == "bm25":
+            ranking.update(k1=self.k1, b=self.b)
+        elif self.ranking_schema == "tf": # any bm25 or tf-idf parameters can be used at query time
+            files.append("norms_lnc.bin")
+        else:
+            ranking.update(smart=self.tfidf["smart"])
+        forward_index = None
+        if self.forward_writer:
+            forward_index = dict(zip(["vectors", "offsets", "vocabulary"], ForwardIndexWriter.files))
+            files += ForwardIndexWriter.files
+
+        champions = None
+        if self.champions_r and not self.defer_bm25:
+            champions = self.champions_manifest()
+            files += ["champions.bin", "champions.pkl"]
+
+        kgrams = None
+        if self.kgrams:
+            kgrams = {"file": "kgrams.pkl", "k": self.kgrams}
+            files.append("kgrams.pkl")
+
+        docstore = None
+        if self.docstore_writer:
+            docstore = {"blocks": DocumentStoreWriter.files[0], "offsets": DocumentStoreWriter.files[1], "block_docs": self.docstore_writer.block_docs}
+            files += DocumentStoreWriter.files
+
+        manifest = {
+            "documents_n": doc_n,
+            "avdl": avdl,
+            "tokenizer": tokenizer.get_kwargs(),
+            "ranking": ranking,
+            "codec": self.codec_name,
+            "lexicon": "index.pkl",
+            "documents": "documents.bin",
+            "lengths": "lengths.bin", # number of tokens of each docno
+            "shards": self.postings_files, # position i holds the postings file of file pointer i
+            "forward_index": forward_index,
+            "docstore": docstore,
+            "champions": champions,
+            "kgrams": kgrams,
+            "fields": fields,
+            "checksums": {f: file_checksum(f"{index_output_folder}/{f}") for f in files}
+        }
+
+        with open(f"./{index_output_folder}/manifest.json", "w") as f:
+            json.dump(manifest, f, indent=4)
+        return manifest
+
+    def write_kgram_index(self, sorted_index, index_output_folder):
+        '''writes kgrams.pkl {k-gram: [term ids]}, the term ids are the positions of the tokens in the sorted lexicon and $ marks the token boundaries'''
+        self.write_to_disk(kgram_index(sorted_index, self.kgrams), "kgrams", "", index_output_folder)
+
+    def champions_manifest(self):
+        return {"postings": "champions.bin", "lexicon": "champions.pkl", "r": self.champions_r}
+
+    def apply_global_bm25(self, index_output_folder, N, avdl, df):
+        '''computes the bm25 weights of an index built with defer_bm25, using the N, avdl and df {token: df} of the whole collection'''
+        with open(f"./{index_output_folder}/manifest.json") as f:
+            manifest = json.load(f)
+        with open(f"./{index_output_folder}/{manifest['lexicon']}", "rb") as f:
+            lexicon = pickle.load(f)
+        dl_lens = array('I')
+        with open(f"./{index_output_folder}/{manifest['lengths']}", "rb") as f:
+            dl_lens.fromfile(f, manifest["documents_n"])
+
+        self.postings_files = manifest["shards"]
+        global_lexicon = {t: [df[t]] + entry[1:] for t, entry in lexicon.items()}
+        self.calc_bm25_weights(N, avdl, dl_lens, global_lexicon, index_output_folder)
+        lexicon = {t: [lexicon[t][0]] + entry[1:] for t, entry in global_lexicon.items()} # the lexicon keeps the local df
+
+        files = list(manifest["checksums"])
+        if self.champions_r:
+            self.write_champions(lexicon, index_output_folder)
+            manifest["champions"] = self.champions_manifest()
+            files += ["champions.bin", "champions.pkl"]
+        self.write_to_disk(lexicon, "index", "", index_output_folder)
+
+        manifest["checksums"] = {f: file_checksum(f"{index_output_folder}/{f}") for f in files}
+        with open(f"./{index_output_folder}/manifest.json", "w") as f:
+            json.dump(manifest, f, indent=4)
+
+    def timed_read(self, reader, checkpoint=None):
+        '''
+        iterates the reader documents, timing the read/decompress and the json parse stages separately. A resumed
+        build starts after the documents of the checkpoint, seeking to the reader offset if the reader has one
+        '''
+        if checkpoint and checkpoint["phase"] != "indexing": # every document was read
+            return
+        skip = checkpoint["documents_n"] + checkpoint["skipped_n"] if checkpoint else 0
+        if not hasattr(reader, "read_lines"): # the reader does not expose its raw lines, so both stages are timed together
+            docs = reader.read()
+            parse = lambda doc: doc
+        elif skip and checkpoint["reader_offset"] is not None:
+            docs = reader.read_lines(checkpoint["reader_offset"])
+            parse = reader.parse
+            skip = 0
+        else:
+            docs = reader.read_lines()
+            parse = reader.parse
+        if skip: # the reader can not seek, the documents of the checkpoint are read again but not parsed
+            docs = itertools.islice(docs, skip, None)
 
         while True:
-            # dump postings to disk if memory threshold is met. The second condition is explained in the function definition
-            while sys.getsizeof(postings)*2 < self.memory_threshold or self.check_duplicates_in_list(tokens):
-                if len(tokens) == 0:
-                    self.write_to_disk(postings, "postings", ptr, index_output_folder)
-                    self.delete_temp_index_blocks(index_output_folder)
-                    return index
-
-                # Get block number where priority token is located through the min() function (min() has O(n) complexity)
-                min_block = tokens.index(min(tokens))
-                priority_token = tokens[min_block] # get priority token from block
-                index = self.update_index_fp(index, priority_token, ptr)
-
-                if priority_token in postings:
-                    postings[priority_token] = {**postings[priority_token], **blocks[min_block].postings} # merge the two postings lists
-                else:
-                    postings[priority_token] = blocks[min_block].postings
-
-                # iterate/read next dictionary from the min_block
-                new_block = self.read_next_dict_from_block(blocks_reader, min_block)
-
-                #update blocks and tokens lists
-                if new_block != None:
-                    blocks[min_block] = new_block
-                    tokens[min_block] = new_block.token
-                else:
-                    del blocks[min_block]
-                    del tokens[min_block]
+            self.stages.start("read")
+            line = next(docs, None)
+            self.stages.stop("read")
+            if line is None:
+                return
 
-            # after reaching memory limit, dump postings to disk
-            # we cannot dump current priority token's postings yet since there is still one left in the list
-            temp_postings = postings[priority_token]
-            del postings[priority_token] # delete it before dumping so it doesn't get dumped twice
+            self.stages.start("parse")
+            doc = parse(line)
+            self.stages.stop("parse")
+            yield doc
 
-            self.write_to_disk(postings, "postings", ptr, index_output_folder)
+    def merge_blocks(self, index, index_output_folder):
+        '''
+        Merges the blocks split by token ranges: each range of every block is merged by its own worker process
+        into its own postings files, so the merge time scales with the number of cores. The lexicon records
+        which range file (file pointer) holds each token.
+        '''
+        self.statistics["merge_levels"] = []
+        self.merge_levels(index_output_folder)
+        block_paths = [f"./{index_output_folder}/{run}" for run in self.runs]
+
+        timer = Timer()
+        timer.start()
+        ranges = self.merge_ranges()
+        workers = min(self.merge_workers, len(ranges))
+        args = [(block_paths, self.block_offsets, lo, hi, range_n, index_output_folder, self.codec_name, self.memory_threshold / workers, self.term_overhead, self.run_compression)
+                for range_n, (lo, hi) in enumerate(ranges)]
+
+        input_bytes = sum([os.path.getsize(p) for p in block_paths])
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(merge_range, *zip(*args)))
+        else:
+            results = [merge_range(*a) for a in args]
+        self.statistics["merge_levels"].append({"runs": len(block_paths), "output_files": sum([len(r) for r in results]),
+                                                "input_bytes": input_bytes, "time": timer.stop()})
+
+        for range_files in results: # ranges are in token order, so the file pointers are too
+            for filename, entries in range_files:
+                fp = len(self.postings_files)
+                self.postings_files.append(filename)
+                for t, (df, offset, length, max_w) in entries.items():
+                    index[t] = [df, fp, offset, length, max_w]
+
+        self.statistics["merge_ranges_n"] = len(ranges)
+        return index
 
-            postings =  {priority_token:temp_postings} # delete all except current priority token
-            ptr+=1
-            index[priority_token][1] = ptr # update current priority token's file pointer
-            malloc_trim() # free memory on linux
+    def fan_in(self):
+        '''
+        maximum number of runs opened at once by each merge process: each open run holds a read buffer of
+        RunWriter.buffer_size bytes out of the memory budget of the process, and the merge processes share
+        the file descriptor limit
+        '''
+        if self.max_fan_in:
+            return max(2, self.max_fan_in)
+        by_memory = int(self.memory_threshold / self.merge_workers / RunWriter.buffer_size)
+        by_descriptors = (max_open_files() - 64) // self.merge_workers # some descriptors are left for the postings files and the libraries
+        return max(2, min(by_memory, by_descriptors))
+
+    def merge_levels(self, index_output_folder):
+        '''
+        Merges the runs in groups of fan_in runs until at most fan_in runs are left, which the range merge reads at
+        once. The number of levels is the smallest that brings the runs under the fan-in. Each level writes its
+        runs to run<level>_<n>.run, saves a checkpoint and deletes the runs it read
+        '''
+        fan_in = self.fan_in()
+        levels = 0
+        runs_n = len(self.runs)
+        while runs_n > fan_in:
+            runs_n = -(-runs_n // fan_in) # ceil
+            levels += 1
+        self.statistics["merge_fan_in"] = fan_in
+        print(f"Merging {len(self.runs)} runs with a fan-in of {fan_in} in {levels + 1} level(s)")
+
+        timer = Timer()
+        for _ in range(levels):
+            timer.start()
+            run_paths = [f"./{index_output_folder}/{run}" for run in self.runs]
+            groups = [run_paths[n:n+fan_in] for n in range(0, len(run_paths), fan_in)] # consecutive runs, so the docnos stay in order
+            outputs = [f"run{self.merge_level}_{n}.run" for n in range(len(groups))]
+            output_paths = [f"./{index_output_folder}/{run}" for run in outputs]
+            input_bytes = sum([os.path.getsize(p) for p in run_paths])
+            args = [(group, path, self.run_compression, self.sparse_step) for group, path in zip(groups, output_paths)]
+
+            workers = min(self.merge_workers, len(groups))
+            if workers > 1:
+                with ProcessPoolExecutor(workers) as pool:
+                    self.block_offsets = list(pool.map(merge_runs, *zip(*args)))
+            else:
+                self.block_offsets = [merge_runs(*a) for a in args]
+
+            self.runs = outputs
+            self.merge_level += 1
+            checkpoint = self.checkpoint
+            self.write_checkpoint(index_output_folder, "merge", checkpoint["documents_n"], checkpoint["dl_sum"], checkpoint["reader_offset"], [])
+            for path in run_paths:
+                os.remove(path)
+            self.statistics["merge_levels"].append({"runs": sum([len(g) for g in groups]), "output_files": len(output_paths),
+                                                    "input_bytes": input_bytes, "time": timer.stop()})
+
+    def merge_ranges(self):
+        '''splits the tokens in merge_workers ranges [lo, hi) of similar size, using the sparse offsets of the blocks as a sample of the tokens'''
+        sample = sorted([token for offsets in self.block_offsets for token, _ in offsets])
+        boundaries = sorted(set([sample[len(sample) * n // self.merge_workers] for n in range(1, self.merge_workers)]))
+        return list(zip([None] + boundaries, boundaries + [None])) # None: unbounded
 
     def print_statistics(self, index_output_folder):
         files = glob.glob(f"./{index_output_folder}/*")
         total_size = sum([os.path.getsize(f) for f in files])
+        self.statistics["index_size_bytes"] = total_size
+        self.statistics["stages"] = self.stages.totals
+        self.statistics.update(self.monitor.get_statistics())
 
         print("\n\nSTATISTICS:")
         print(f'Total indexing time: {self.statistics["total_indexing_time"]:.2f}s')
@@ -247,63 +628,55 @@ class SPIMIIndexer(Indexer):
         print(f'Number of temporary index segments written to disk: {self.statistics["temp_index_segments_n"]}')
         print(f'Total index size on disk: {(total_size*1e-6):.1f} MB')
         print(f'Vocabulary size: {self.statistics["vocabulary_size"]}')
+        print(f'Peak resident memory: {(self.statistics["peak_rss_bytes"]*1e-6):.1f} MB')
+        if self.statistics["bytes_read"] is not None:
+            print(f'Disk I/O: {(self.statistics["bytes_read"]*1e-6):.1f} MB read, {(self.statistics["bytes_written"]*1e-6):.1f} MB written')
+        for level, stats in enumerate(self.statistics.get("merge_levels", [])):
+            print(f'Merge level {level}: {stats["runs"]} runs ({(stats["input_bytes"]*1e-6):.1f} MB) -> {stats["output_files"]} files in {stats["time"]:.2f}s')
+        print("Time per stage:")
+        for stage, elapsed in self.stages.totals.items():
+            print(f'    {stage:<10} {elapsed:.2f}s')
+
+        with open(f"./{index_output_folder}/statistics.json", "w") as f: # machine-readable version of the statistics above
+            json.dump(self.statistics, f, indent=4)
 
     def dump_if_threshold_reached(self, index, postings, i, block_n, index_output_folder):
-        ''' dump data to a temporary block.pkl file in disk if memory threshold or postings threshold is reached'''
-        used_mem = sys.getsizeof(postings)# in bytes
-        if i == self.posting_threshold or used_mem*2 > self.memory_threshold:
-            sorted_postings = dict(sorted(postings.items(), key=lambda x: x[0]))
-            self.dump_block(sorted_postings, block_n, index_output_folder)
+        ''' dump data to a temporary block.run file in disk if memory threshold or postings threshold is reached'''
+        used_mem = self.buffer_bytes # in bytes
+        if i == self.posting_threshold or used_mem > self.memory_threshold:
+            self.monitor.sample()
+            self.dump_block(postings, block_n, index_output_folder)
 
             block_n += 1
             postings = {}
+            self.buffer_bytes = 0
             i = 0
             malloc_trim() # free memory on linux
 
         return postings, i, block_n
 
     def dump_block(self, postings, ptr, index_output_folder):
-        ''' dump Blocks to a temporary block.pkl file in disk'''
-        with open(f"./{index_output_folder}/block{ptr}.pkl", "wb") as f:
-            for k,v in postings.items():
-                block = Block(token=k, postings=v)
-                pickle.dump(block, f)
-
-    def read_next_dict_from_block(self, blocks_reader, n):
-        '''iterates the blocks_reader buffer by one block'''
-        try:
-            return pickle.load(blocks_reader[n]) # advance read buffer by one for selected block
-        except EOFError:
-            return None
-    
+        ''' dump the postings to a temporary block.run file in disk, in token order (only the tokens are sorted, the postings are not copied)'''
+        self.stages.start("dump")
+        with RunWriter(f"./{index_output_folder}/block{ptr}.run", self.sparse_step, self.run_compression) as run:
+            for token in sorted(postings):
+                run.add_arrays(token, *postings[token])
+        self.runs.append(f"block{ptr}.run")
+        self.block_offsets.append(run.offsets)
+        self.stages.stop("dump")
+
     def write_to_disk(self, data, type, filepointer, index_output_folder):
-        '''writes index.pkl or posting(s).pkl files to disk'''
+        '''writes index.pkl file to disk'''
         with open(f"./{index_output_folder}/{type}{filepointer}.pkl", "wb") as f:
             pickle.dump(data, f)
 
-    def check_duplicates_in_list(self, lst):
-        '''We cannot dump index before we merge the postings for the same token from all the blocks'''
-        '''Therefore, first we need to verify if all postings for a token were merged'''
-        '''(which means there can't be duplicate tokens in the list of tokens)'''
-        return len(lst) != len(set(lst))
-
     def delete_temp_index_blocks(self, index_output_folder):
-        '''deletes all temporary block.pkl files'''
-        block_paths = glob.glob(f"./{index_output_folder}/block*.pkl")
-        self.statistics["temp_index_segments_n"] = len(block_paths)
+        '''deletes all temporary block.run files, the runs of the merge levels and the checkpoint'''
+        block_paths = glob.glob(f"./{index_output_folder}/*.run") + glob.glob(f"./{index_output_folder}/checkpoint*")
 
         for f in block_paths:
             os.remove(f)
 
-    def update_index_fp(self, index, t, ptr):
-        if isinstance(index[t], int):
-            df = index[t]
-            index[t] = [df, ptr] # add pointer to index
-        else:
-            index[t][1] = ptr # update pointer
-
-        return index
-
     def log(self, n):
         if n not in self.logarithm:
             self.logarithm[n] = log10(n)
@@ -316,37 +689,458 @@ class SPIMIIndexer(Indexer):
         
         return w
 
-    def calc_norm_tfidf_weights(self, pmid, tokens, postings):
-        '''Calculate normalized token weights'''
+    def calc_norm_tfidf_weights(self, doc_positions):
+        '''Calculate normalized token weights of a document {token: positions}'''
+        weights = {}
         w_sum = 0
-        for t in tokens:
-            w = self.calc_tfidf_weight(tf=postings[t][pmid]["w"])
-            postings[t][pmid]["w"] = w
+        for t, positions in doc_positions.items():
+            w = self.calc_tfidf_weight(tf=len(positions))
+            weights[t] = w
             w_sum += w**2
 
         denominator = sqrt(w_sum)
 
-        for t in tokens: # after calculating sqrt(w_sum) we can store the normalized weight
-            postings[t][pmid]["w"] /= denominator
+        for t in weights: # after calculating sqrt(w_sum) we can store the normalized weight
+            weights[t] /= denominator
 
-        return postings
+        return weights
 
     def calc_bm25_weights(self, N, avdl, dl_lens, index, index_output_folder):
-        postings_paths = glob.glob(f"./{index_output_folder}/postings*.pkl")
+        '''replaces the tfs of the postings by their bm25 weights, one token at a time so a single postings list is decoded in memory'''
+        tokens_per_file = [[] for _ in self.postings_files]
+        for token, entry in index.items():
+            tokens_per_file[entry[1]].append(token)
+
+        for fp, filename in enumerate(self.postings_files):
+            path = f"./{index_output_folder}/{filename}"
+            tokens_per_file[fp].sort(key=lambda t: index[t][2]) # keep the order in which the tokens were written
+            offset = 0
+            with open(path, "rb") as f, open(f"{path}.tmp", "wb") as out:
+                for token in tokens_per_file[fp]: # calc and store score
+                    df, _, token_offset, length, _ = index[token]
+                    f.seek(token_offset)
+                    postings = self.codec.decode_postings(f.read(length))
+                    for docno, dictionary in postings.items():
+                        tf = dictionary["w"]
+                        dl = dl_lens[docno]
+                        dictionary["w"] = log10(N/df) * ((self.k1+1)*tf) / (self.k1*((1-self.b)+self.b*dl/avdl)+tf)
+
+                    data = self.codec.encode_postings(postings)
+                    out.write(data)
+                    index[token] = [df, fp, offset, len(data), max([d["w"] for d in postings.values()])]
+                    offset += len(data)
+            os.replace(f"{path}.tmp", path)
+
+
+    def write_champions(self, index, index_output_folder):
+        '''
+        Writes the first tier of the index: the champion list of each token, its champions_r postings with the
+        highest weights. Tokens with df <= champions_r are not written since their champion list is the full list.
+        '''
+        champions = {} # {token : [offset, length]}
+        offset = 0
+        with open(f"./{index_output_folder}/champions.bin", "wb") as out:
+            for fp, filename in enumerate(self.postings_files):
+                with open(f"./{index_output_folder}/{filename}", "rb") as f:
+                    tokens = [t for t, entry in index.items() if entry[1] == fp and entry[0] > self.champions_r]
+                    for token in sorted(tokens, key=lambda t: index[t][2]):
+                        _, _, token_offset, length, _ = index[token]
+                        f.seek(token_offset)
+                        postings = self.codec.decode_postings(f.read(length))
+                        top = sorted(postings.items(), key=lambda item: item[1]["w"], reverse=True)[:self.champions_r]
+                        encoded = self.codec.encode_postings(dict(top))
+                        out.write(encoded)
+                        champions[token] = [offset, len(encoded)]
+                        offset += len(encoded)
+
+        self.write_to_disk(champions, "champions", "", index_output_folder)
+
+
+def get_kgrams(text, k):
+    return [text[i:i+k] for i in range(len(text)-k+1)]
+
+
+def kgram_index(tokens, k):
+    '''{k-gram: [term ids]} of the tokens, the term ids are their positions in sorted order'''
+    kgrams = {}
+    for term_id, t in enumerate(sorted(tokens)):
+        for gram in set(get_kgrams(f"${t}$", k)):
+            kgrams.setdefault(gram, array('I')).append(term_id)
+    return kgrams
+
+
+def write_postings_file(codec, postings, path):
+    '''encodes the postings {token: {docno: {'w': w, 'positions': [...]}}} into one file, returns {token: [df, offset, length, max weight]}'''
+    entries = {}
+    offset = 0
+    with open(path, "wb") as f:
+        for t, p in postings.items():
+            data = codec.encode_postings(p)
+            f.write(data)
+            max_w = max([d["w"] for d in p.values()]) # upper bound of the score contribution, used to skip query terms
+            entries[t] = [len(p), offset, len(data), max_w]
+            offset += len(data)
+    return entries
+
+
+def concat_runs(token_runs):
+    '''concatenates the (token, (docnos, weights, freqs, positions)) of a token in several runs, the runs hold increasing docnos so they are concatenated in run order'''
+    docnos, weights, freqs, positions = array('I'), array('d'), array('I'), array('I')
+    for _, arrays in token_runs:
+        for values, run_values in zip((docnos, weights, freqs, positions), arrays):
+            values.extend(run_values)
+    return docnos, weights, freqs, positions
+
+
+def merge_runs(run_paths, output_path, compressed, step):
+    '''merges whole run files into a single run file, returns its sparse offsets. Runs in a merge worker process'''
+    runs = heapq.merge(*[RunWriter.read(path, 0, compressed) for path in run_paths], key=lambda r: r[0])
+    with RunWriter(output_path, step, compressed) as out:
+        for token, token_runs in itertools.groupby(runs, key=lambda r: r[0]):
+            out.add_arrays(token, *concat_runs(token_runs))
+    return out.offsets
+
+
+def max_open_files():
+    '''soft limit of open file descriptors of the process'''
+    try:
+        import resource
+    except ImportError: # windows, the C runtime limit
+        return 512
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def write_arrays_file(codec, postings, path):
+    '''same as write_postings_file, for the merged postings {token: (docnos, weights, freqs, positions)} of the run files'''
+    entries = {}
+    offset = 0
+    with open(path, "wb") as f:
+        for t, (docnos, weights, freqs, positions) in postings.items():
+            freqs = freqs.tolist()
+            doc_gaps, position_gaps = arrays_to_streams(docnos.tolist(), freqs, positions.tolist())
+            data = codec.encode_streams(doc_gaps, freqs, position_gaps, weights)
+            f.write(data)
+            entries[t] = [len(docnos), offset, len(data), max(weights)]
+            offset += len(data)
+    return entries
+
+
+def read_block_range(path, offsets, lo, hi, compressed=False):
+    '''yields the (token, (docnos, weights, freqs, positions)) of a block file with lo <= token < hi (None: unbounded), starting at the closest sparse offset'''
+    start = 0
+    if lo is not None:
+        n = bisect_right([token for token, _ in offsets], lo) - 1
+        start = offsets[max(n, 0)][1]
+
+    for token, arrays in RunWriter.read(path, start, compressed):
+        if hi is not None and token >= hi:
+            return
+        if lo is None or token >= lo:
+            yield token, arrays
+
+
+def merge_range(block_paths, block_offsets, lo, hi, range_n, index_output_folder, codec_name, memory_threshold, term_overhead, compressed=False):
+    '''
+    Merges the tokens lo <= token < hi of every block into postings<range_n>_<n>.bin files, a new file
+    is started when the memory threshold is reached (the buffer is charged like the inversion buffers,
+    term_overhead per token plus the bytes of its arrays). Runs in a merge worker process.
+    Returns [(filename, {token: [df, offset, length, max weight]})]
+    '''
+    codec = get_codec(codec_name)
+    blocks = heapq.merge(*[read_block_range(path, offsets, lo, hi, compressed) for path, offsets in zip(block_paths, block_offsets)], key=lambda b: b[0])
+
+    files = []
+    postings = {}
+    buffer_bytes = 0
+    for token, token_blocks in itertools.groupby(blocks, key=lambda b: b[0]): # the blocks of a token are complete, it can be dumped after it
+        postings[token] = concat_runs(token_blocks)
+        buffer_bytes += term_overhead + sum([len(values) * values.itemsize for values in postings[token]])
+
+        if buffer_bytes >= memory_threshold:
+            filename = f"postings{range_n}_{len(files)}.bin"
+            files.append((filename, write_arrays_file(codec, postings, f"./{index_output_folder}/{filename}")))
+            postings = {}
+            buffer_bytes = 0
+            malloc_trim() # free memory on linux
+
+    if postings:
+        filename = f"postings{range_n}_{len(files)}.bin"
+        files.append((filename, write_arrays_file(codec, postings, f"./{index_output_folder}/{filename}")))
+    return files
+
+
+class ShardedIndexer(Indexer):
+    """
+    Splits the collection in document partitions (shards) and builds
+    each one with a SPIMIIndexer in its own process. Every shard is a
+    regular index folder with its own lexicon, postings and local
+    statistics, global_stats.pkl holds the collection-wide N, avdl and
+    df so the shards score their documents consistently.
+
+    """
+    def __init__(self, 
+                 shards=2,
+                 memory_threshold=None,
+                 **kwargs):
+        super().__init__(ShardedIndex(), **kwargs)
+        self.shards = shards
+        # the shards are built at the same time, so they share the available memory
+        import psutil
+        available_mem = psutil.virtual_memory().available
+        self.shard_kwargs = dict(kwargs, memory_threshold=min(memory_threshold or 2**64, available_mem) // shards)
+        self.statistics = {}
+        self.timer = Timer()
+        print("init ShardedIndexer|", f"{shards=}")
+
+    def build_index(self, reader, tokenizer, index_output_folder, resume=False):
+        if resume:
+            print("WARNING: sharded builds can not be resumed, the index is built from scratch")
+        print(f"Indexing the collection in {self.shards} shards...")
+        self.timer.start()
+        deleted_pmids = read_deleted_pmids(index_output_folder) # every shard skips them, the documents of a shard can change
+        if os.path.exists(index_output_folder):
+            shutil.rmtree(index_output_folder)
+        os.makedirs(index_output_folder)
+
+        shard_folders = [f"shard{n}" for n in range(self.shards)]
+        with ProcessPoolExecutor(self.shards) as pool:
+            # readers that can be split give each shard a contiguous slice, otherwise every shard reads the whole collection and keeps every shards-th document
+            readers = reader.split(self.shards) if hasattr(reader, "split") else [ShardReader(reader, n, self.shards) for n in range(self.shards)]
+            futures = [pool.submit(build_shard, shard_reader, tokenizer, f"{index_output_folder}/{folder}", self.shard_kwargs, deleted_pmids)
+                       for shard_reader, folder in zip(readers, shard_folders)]
+            manifests = [future.result() for future in futures]
+            self.statistics["shards_indexing_time"] = self.timer.stop()
+
+            # ---------------------- collection-wide statistics --------------------- #
+            N = sum([m["documents_n"] for m in manifests])
+            avdl = sum([m["avdl"] * m["documents_n"] for m in manifests]) / N if N else 0
+            df = Counter()
+            for folder, manifest in zip(shard_folders, manifests):
+                with open(f"./{index_output_folder}/{folder}/{manifest['lexicon']}", "rb") as f:
+                    df.update({t: entry[0] for t, entry in pickle.load(f).items()})
+            global_stats = {"documents_n": N, "avdl": avdl, "df": dict(df)}
+            self.write_to_disk(global_stats, "global_stats", index_output_folder)
+
+            if manifests[0]["ranking"]["schema"] == "bm25": # the bm25 weights depend on the global statistics
+                list(pool.map(apply_shard_bm25, [f"{index_output_folder}/{folder}" for folder in shard_folders],
+                              [self.shard_kwargs]*self.shards, [N]*self.shards, [avdl]*self.shards, [global_stats["df"]]*self.shards))
+
+        manifest = {
+            "documents_n": N,
+            "avdl": avdl,
+            "tokenizer": manifests[0]["tokenizer"],
+            "ranking": manifests[0]["ranking"],
+            "codec": manifests[0]["codec"],
+            "global_stats": "global_stats.pkl",
+            "shard_folders": shard_folders,
+        }
+        with open(f"./{index_output_folder}/manifest.json", "w") as f:
+            json.dump(manifest, f, indent=4)
+
+        self.statistics["total_indexing_time"] = self.timer.stop()
+        self.statistics["vocabulary_size"] = len(df)
+        self.statistics["shard_documents_n"] = [m["documents_n"] for m in manifests]
+        self._index = ShardedIndex.load_from_disk(index_output_folder)
+
+    def write_to_disk(self, data, name, index_output_folder):
+        with open(f"./{index_output_folder}/{name}.pkl", "wb") as f:
+            pickle.dump(data, f)
+
+    def print_statistics(self, index_output_folder):
+        files = glob.glob(f"./{index_output_folder}/**/*", recursive=True)
+        self.statistics["index_size_bytes"] = sum([os.path.getsize(f) for f in files if os.path.isfile(f)])
 
-        for f in postings_paths:
-            with open(f, "rb") as p: # open
-                postings = pickle.load(p)
+        print("\n\nSTATISTICS:")
+        print(f'Total indexing time: {self.statistics["total_indexing_time"]:.2f}s (shards: {self.statistics["shards_indexing_time"]:.2f}s)')
+        print(f'Documents per shard: {self.statistics["shard_documents_n"]}')
+        print(f'Total index size on disk: {(self.statistics["index_size_bytes"]*1e-6):.1f} MB')
+        print(f'Vocabulary size: {self.statistics["vocabulary_size"]}')
+        print(f'The statistics of each shard are in {index_output_folder}/shard*/statistics.json')
+
+        with open(f"./{index_output_folder}/statistics.json", "w") as f:
+            json.dump(self.statistics, f, indent=4)
+
+
+def build_shard(reader, tokenizer, shard_folder, indexer_kwargs, deleted_pmids):
+    '''builds one shard, runs in a worker process of the ShardedIndexer'''
+    indexer = SPIMIIndexer(**indexer_kwargs, defer_bm25=True)
+    indexer.build_index(reader, tokenizer, shard_folder, deleted_pmids=deleted_pmids)
+    indexer.print_statistics(shard_folder)
+    return indexer.get_index().manifest
 
-            for token, v in postings.items(): # calc and store score
-                df, _ = extract_data_from_index(token, index, index_output_folder)
-                for pmid, dictionary in v.items():
-                    tf = dictionary["w"]
-                    dl = dl_lens[pmid]
-                    postings[token][pmid]["w"] = log10(N/df) * ((self.k1+1)*tf) / (self.k1*((1-self.b)+self.b*dl/avdl)+tf)
 
-            with open(f, "wb") as f: # save
-                pickle.dump(postings, f)
+def apply_shard_bm25(shard_folder, indexer_kwargs, N, avdl, df):
+    indexer = SPIMIIndexer(**indexer_kwargs, defer_bm25=True)
+    indexer.apply_global_bm25(shard_folder, N, avdl, df)
+
+
+class ForwardIndexWriter:
+    """
+    Writes the forward index during the indexing pass: for each docno,
+    the ids of its tokens and their term frequencies, encoded with the
+    index codec. forward_offsets.bin holds where the vector of each docno
+    starts and vocabulary.pkl maps the token ids back to tokens.
+
+    """
+    files = ["forward.bin", "forward_offsets.bin", "vocabulary.pkl"]
+    record_header = struct.Struct("<I")
+
+    def __init__(self, codec, index_output_folder):
+        self.codec = codec
+        self.index_output_folder = index_output_folder
+        self.term_ids = {} # token -> id, by order of appearance
+        self.offsets = array('Q', [0])
+        self.vectors = open(f"./{index_output_folder}/{self.files[0]}", "wb", buffering=2**20)
+
+    def add_document(self, tokens):
+        tfs = Counter([self.term_ids.setdefault(t, len(self.term_ids)) for t in tokens])
+        ids = sorted(tfs)
+        gaps = [b - a for a, b in zip([0] + ids, ids)]
+
+        ids_data = self.codec.encode(gaps)
+        record = self.record_header.pack(len(ids_data)) + ids_data + self.codec.encode([tfs[i] for i in ids])
+        self.vectors.write(record)
+        self.offsets.append(self.offsets[-1] + len(record))
+
+    def close(self):
+        self.vectors.close()
+        with open(f"./{self.index_output_folder}/{self.files[1]}", "wb") as f:
+            self.offsets.tofile(f)
+        with open(f"./{self.index_output_folder}/{self.files[2]}", "wb") as f:
+            pickle.dump(list(self.term_ids), f) # dicts keep the insertion order, so position i holds token i
+
+
+class DocumentStoreWriter:
+    """
+    Writes the titles and abstracts in zlib compressed blocks of
+    block_docs documents. Since the docnos are sequential, the block
+    of a document is docno // block_docs, so the offsets table only
+    needs one entry per block.
+
+    """
+    files = ["docstore.bin", "docstore_offsets.bin"]
+
+    def __init__(self, index_output_folder, block_docs=16):
+        self.index_output_folder = index_output_folder
+        self.block_docs = block_docs
+        self.block = []
+        self.offsets = array('Q', [0])
+        self.blocks = open(f"./{index_output_folder}/{self.files[0]}", "wb", buffering=2**20)
+
+    def add_document(self, doc):
+        self.block.append([doc["title"], doc["abstract"]])
+        if len(self.block) == self.block_docs:
+            self.dump_block()
+
+    def dump_block(self):
+        data = zlib.compress(json.dumps(self.block).encode("utf-8"))
+        self.blocks.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+        self.block = []
+
+    def close(self):
+        if self.block:
+            self.dump_block()
+        self.blocks.close()
+        with open(f"./{self.index_output_folder}/{self.files[1]}", "wb") as f:
+            self.offsets.tofile(f)
+
+
+class RunWriter:
+    """
+    Writes a sorted run (temporary block) of the SPIMI indexer. Each
+    token is a length-prefixed binary record with the docnos, term
+    weights and positions of its postings as packed arrays:
+
+    [len(token)][len(record)][token][df][docnos][weights][freqs][positions]
+
+    The records are grouped in frames of `step` tokens, each prefixed
+    by its length and optionally zlib compressed. The frame offsets
+    are the sparse (token, offset) pairs that let the merge workers
+    seek to their token range, and the frames are the unit of I/O.
+
+    """
+    record_header = struct.Struct("<HI")
+    frame_header = struct.Struct("<I")
+    buffer_size = 2**20
+
+    def __init__(self, path, step=64, compressed=False):
+        self.file = open(path, "wb", buffering=self.buffer_size)
+        self.step = step
+        self.compressed = compressed
+        self.frame = bytearray()
+        self.frame_n = 0 # records in the current frame
+        self.offsets = [] # [(first token of the frame, frame offset)]
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_arrays(self, token, docnos, weights, freqs, positions):
+        '''adds the postings of the next token as arrays, the positions of every document in docno order'''
+        if self.frame_n == 0:
+            self.offsets.append((token, self.offset))
+
+        record = b"".join([struct.pack("<I", len(docnos)), docnos.tobytes(), weights.tobytes(), freqs.tobytes(), positions.tobytes()])
+
+        token = token.encode("utf-8")
+        self.frame += self.record_header.pack(len(token), len(record))
+        self.frame += token
+        self.frame += record
+        self.frame_n += 1
+        if self.frame_n == self.step:
+            self.flush_frame()
+
+    def flush_frame(self):
+        data = zlib.compress(self.frame, 1) if self.compressed else self.frame
+        self.file.write(self.frame_header.pack(len(data)))
+        self.file.write(data)
+        self.offset += self.frame_header.size + len(data)
+        self.frame = bytearray()
+        self.frame_n = 0
+
+    def close(self):
+        if self.frame_n:
+            self.flush_frame()
+        self.file.close()
+
+    @classmethod
+    def read(cls, path, start=0, compressed=False):
+        '''yields the (token, (docnos, weights, freqs, positions)) of a run file from the frame at start, see decode_record'''
+        with open(path, "rb", buffering=cls.buffer_size) as f:
+            f.seek(start)
+            while True:
+                header = f.read(cls.frame_header.size)
+                if not header:
+                    return
+                frame = f.read(cls.frame_header.unpack(header)[0])
+                if compressed:
+                    frame = zlib.decompress(frame)
+
+                view = memoryview(frame)
+                pos = 0
+                while pos < len(frame):
+                    token_len, record_len = cls.record_header.unpack_from(frame, pos)
+                    pos += cls.record_header.size
+                    token = str(view[pos:pos+token_len], "utf-8")
+                    pos += token_len
+                    yield token, cls.decode_record(view[pos:pos+record_len])
+                    pos += record_len
+
+    @staticmethod
+    def decode_record(data):
+        '''the docnos, weights, freqs and positions arrays of a record'''
+        df = struct.unpack_from("<I", data)[0]
+        docnos, weights, freqs, positions = array('I'), array('d'), array('I'), array('I')
+        pos = 4
+        for values, n in ((docnos, df), (weights, df), (freqs, df)):
+            values.frombytes(data[pos:pos+n*values.itemsize])
+            pos += n*values.itemsize
+        positions.frombytes(data[pos:])
+        return docnos, weights, freqs, positions
 
 
 class BaseIndex:
@@ -396,14 +1190,574 @@ class BaseIndex:
         return cls()
 
 class InvertedIndex(BaseIndex):
-    
-    # make an efficient implementation of an inverted index
-        
+    """
+    Index manager that represents an index folder on disk.
+
+    Everything that is needed to open the index (document count,
+    tokenizer, ranking schema and postings files) is read from the
+    manifest.json, so no filesystem scans are performed while searching.
+    Only the lexicon is held in memory, the postings are loaded on demand.
+
+    """
+    def __init__(self, path_to_folder=None, manifest=None, lexicon=None, doc_ids=None):
+        super().__init__()
+        self.path_to_folder = path_to_folder
+        self.manifest = manifest if manifest is not None else {}
+        self.lexicon = lexicon if lexicon is not None else {} # {token : [df, filepointer, offset, length, max weight]}
+        self.doc_ids = doc_ids if doc_ids is not None else array('I') # docno -> pmid
+        self.codec = get_codec(self.manifest.get("codec", "vbyte"))
+        self.postings_readers = {} # filepointer -> open postings file
+        self.forward_offsets = None
+        self.vocabulary = None
+        self.lengths = None
+        self.norms = {} # SMART scheme -> norm of each docno, tf schema only
+        self.global_stats = None # {'documents_n': N, 'avdl': avdl, 'df': {token: df}} of the whole collection, if this is a shard
+        self.champions = None # {token : [offset, length]} of the first tier, loaded on the first tiered query
+        self.champions_reader = None
+        self.docstore_offsets = None
+        self.docstore_cache = OrderedDict() # block number -> decompressed block, result pages often share blocks, least recently used first
+        self.cache_lock = Lock() # the searcher reads postings and documents from several threads
+        self.cache_stats = Counter() # hits and misses of the caches above, reported by the query traces
+        self.sorted_terms = None # lexicon tokens in order, for the wildcard expansions
+        self.kgrams = None
+        self.virtual_terms = OrderedDict() # wildcard pattern -> {'df': df, 'max_w': max weight, 'postings': merged postings, 'terms': expansions}, least recently used first
+        self.virtual_terms_lock = Lock()
+        self.max_virtual_terms = 64 # patterns kept, so repeated (and concurrent) wildcard queries reuse the merged postings
+        self.deleted = None # docnos of the deleted documents, loaded from deleted.bin on first use
+        self.field_lengths = None
+
+    @property
+    def N(self):
+        if self.global_stats: # the ShardedIndex already took the deleted documents of every shard out
+            return self.global_stats["documents_n"]
+        return self.manifest["documents_n"] - len(self.get_deleted())
+
+    @property
+    def avdl(self):
+        return (self.global_stats or self.manifest)["avdl"]
+
+    def get_tokenizer_kwargs(self):
+        return dict(self.manifest.get("tokenizer", {}))
+
+    def get_ranking_schema(self):
+        return self.manifest.get("ranking", {}).get("schema")
+
+    def __contains__(self, token):
+        return token in self.lexicon
+
+    def __len__(self):
+        return len(self.lexicon)
+
+    def get_df(self, token):
+        '''document frequency of a token, at most N: the df of the deleted documents is only taken out by a compaction'''
+        if self.global_stats:
+            df = self.global_stats["df"][token]
+        else:
+            df, _ = extract_data_from_index(token, self.lexicon)
+        return min(df, self.N) # a stale df over N would give a negative idf
+
+    def get_max_weight(self, token):
+        return self.lexicon[token][4]
+
+    def get_pmid(self, docno):
+        return self.doc_ids[docno]
+
+    def read_postings(self, token):
+        '''reads the encoded postings of a token with a single positional read (safe to call from several threads)'''
+        _, fp, offset, length, _ = self.lexicon[token]
+        reader = self.postings_readers.get(fp)
+        if reader is None:
+            with self.cache_lock: # opened once, even if several threads miss it at the same time
+                if fp not in self.postings_readers:
+                    self.cache_stats["postings_fd_misses"] += 1
+                    self.postings_readers[fp] = os.open(f"{self.path_to_folder}/{self.manifest['shards'][fp]}", os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                reader = self.postings_readers[fp]
+
+        if hasattr(os, "pread"):
+            return os.pread(reader, length, offset)
+
+        with open(f"{self.path_to_folder}/{self.manifest['shards'][fp]}", "rb") as f: # no pread on windows
+            f.seek(offset)
+            return f.read(length)
+
+    def get_postings(self, token):
+        '''returns the postings of a token {docno: {'w': w, 'positions': [pos1,pos2]}}'''
+        return self.codec.decode_postings(self.read_postings(token))
+
+    # ---------------------------- wildcard queries ---------------------------- #
+
+    def expand_wildcard(self, pattern, max_expansions):
+        '''
+        Tokens of the lexicon that match a pattern with * wildcards, at most max_expansions (the ones with the highest df).
+        Prefixes (immuno*) are a range scan over the sorted lexicon, the other patterns are looked up in the k-gram
+        index (if the index has one) and the candidates are checked against the pattern.
+        '''
+        if self.sorted_terms is None:
+            self.sorted_terms = sorted(self.lexicon)
+
+        prefix = pattern.split("*")[0]
+        start = bisect_left(self.sorted_terms, prefix)
+        end = bisect_left(self.sorted_terms, prefix + "\U0010ffff") # every token that starts with the prefix is in [start, end)
+        if pattern == prefix + "*":
+            matches = self.sorted_terms[start:end]
+        else:
+            candidates = self.kgram_candidates(pattern)
+            if candidates is None: # no k-grams to narrow it, scan the prefix range (the whole lexicon if there is no prefix)
+                candidates = range(start, end)
+            regex = re.compile(".*".join([re.escape(part) for part in pattern.split("*")]))
+            matches = [self.sorted_terms[i] for i in candidates if regex.fullmatch(self.sorted_terms[i])]
+
+        return sorted(matches, key=lambda t: -self.lexicon[t][0])[:max_expansions]
+
+    def kgram_candidates(self, pattern):
+        '''ids of the tokens that have every k-gram of the pattern, None if there is no k-gram index or the pattern has no k-grams'''
+        if not self.manifest.get("kgrams"):
+            return None
+        if self.kgrams is None:
+            with open(f"{self.path_to_folder}/{self.manifest['kgrams']['file']}", "rb") as f:
+                self.kgrams = pickle.load(f)
+
+        k = self.manifest["kgrams"]["k"]
+        grams = [g for part in f"${pattern}$".split("*") for g in get_kgrams(part, k)]
+        if not grams:
+            return None
+
+        lists = sorted([self.kgrams.get(g, array('I')) for g in grams], key=len) # intersect starting by the shortest list
+        candidates = set(lists[0])
+        for term_ids in lists[1:]:
+            candidates.intersection_update(term_ids)
+        return sorted(candidates)
+
+    def get_virtual_term(self, pattern):
+        '''the cached virtual term of a pattern (None if there is none), which becomes the most recently used'''
+        with self.virtual_terms_lock:
+            virtual = self.virtual_terms.get(pattern)
+            if virtual:
+                self.virtual_terms.move_to_end(pattern)
+            return virtual
+
+    def add_virtual_term(self, pattern, terms):
+        '''
+        merges the postings of the expansions of a pattern into a single virtual term, so the pattern is scored
+        once per document. The weights of a document are added for the tf schema (tf of the pattern), otherwise
+        the highest weight is kept. The virtual term is cached (the least recently used one is evicted if the
+        cache is full) and returned, the queries score it through their own QueryIndex
+        '''
+        merged = {}
+        combine = (lambda a, b: a + b) if self.stores_tf() else max
+        for t in terms:
+            for docno, dictionary in self.get_postings(t).items():
+                if docno in merged:
+                    merged[docno]["w"] = combine(merged[docno]["w"], dictionary["w"])
+                    merged[docno]["positions"] = sorted(merged[docno]["positions"] + dictionary["positions"])
+                else:
+                    merged[docno] = dictionary
+
+        virtual = {"df": len(merged), "max_w": max([d["w"] for d in merged.values()]), "postings": merged, "terms": terms}
+        with self.virtual_terms_lock:
+            self.virtual_terms[pattern] = virtual
+            self.virtual_terms.move_to_end(pattern)
+            while len(self.virtual_terms) > self.max_virtual_terms:
+                self.virtual_terms.popitem(last=False)
+        return virtual
+
+    # -------------------------------- deletions ------------------------------- #
+
+    def get_deleted(self):
+        '''docnos of the deleted documents, the searchers skip them when scoring'''
+        if self.deleted is None:
+            self.deleted = set(read_deleted(self.path_to_folder)) if self.path_to_folder else set()
+        return self.deleted
+
+    def delete_documents(self, pmids):
+        '''
+        Marks the documents of the pmids as deleted, without rewriting the postings: their docnos are added to
+        deleted.bin. N counts the remaining documents at once, the df and avdl are only updated when the index
+        is compacted (compact.py) or rebuilt, which also drop the postings. Returns the pmids that were not found
+        '''
+        pmids = set(pmids)
+        found = set()
+        deleted = self.get_deleted()
+        for docno, pmid in enumerate(self.doc_ids):
+            if pmid in pmids:
+                deleted.add(docno)
+                found.add(pmid)
+        write_deleted(self.path_to_folder, deleted)
+        return pmids - found
+
+    def has_champions(self):
+        return bool(self.manifest.get("champions"))
+
+    def load_champions(self):
+        '''loads the first tier lexicon, the champion lists stay on disk'''
+        files = self.manifest["champions"]
+        with open(f"{self.path_to_folder}/{files['lexicon']}", "rb") as f:
+            self.champions = pickle.load(f)
+        self.champions_reader = os.open(f"{self.path_to_folder}/{files['postings']}", os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    def read_champion_postings(self, token):
+        '''reads the encoded first tier postings of a token with a single positional read'''
+        files = self.manifest["champions"]
+        if self.champions is None:
+            with self.cache_lock:
+                if self.champions is None:
+                    self.load_champions()
+
+        if token not in self.champions: # df <= r, the champion list is the full postings list
+            return self.read_postings(token)
+
+        offset, length = self.champions[token]
+        if hasattr(os, "pread"):
+            return os.pread(self.champions_reader, length, offset)
+
+        with open(f"{self.path_to_folder}/{files['postings']}", "rb") as f: # no pread on windows
+            f.seek(offset)
+            return f.read(length)
+
+    def get_champion_postings(self, token):
+        '''returns the postings of the first tier, the champions_r documents of the token with the highest weights'''
+        return self.codec.decode_postings(self.read_champion_postings(token))
+
+    def has_forward_index(self):
+        return bool(self.manifest.get("forward_index"))
+
+    def load_forward_index(self):
+        '''loads the vector offsets and the vocabulary of the forward index, the vectors stay on disk'''
+        files = self.manifest["forward_index"]
+        self.forward_offsets = array('Q')
+        with open(f"{self.path_to_folder}/{files['offsets']}", "rb") as f:
+            self.forward_offsets.fromfile(f, self.manifest["documents_n"] + 1) # every docno, N leaves the deleted (and other shards) documents out
+        with open(f"{self.path_to_folder}/{files['vocabulary']}", "rb") as f:
+            self.vocabulary = pickle.load(f)
+        self.forward_vectors = os.open(f"{self.path_to_folder}/{files['vectors']}", os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    def get_term_vector(self, docno):
+        '''returns {token: tf} of a document, read from the forward index with a single read'''
+        if self.forward_offsets is None:
+            self.load_forward_index()
+
+        offset = self.forward_offsets[docno]
+        length = self.forward_offsets[docno+1] - offset
+        if hasattr(os, "pread"):
+            data = os.pread(self.forward_vectors, length, offset)
+        else:
+            with open(f"{self.path_to_folder}/{self.manifest['forward_index']['vectors']}", "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+
+        data = memoryview(data)
+        ids_len, = ForwardIndexWriter.record_header.unpack_from(data)
+        ptr = ForwardIndexWriter.record_header.size
+        gaps = self.codec.decode(data[ptr:ptr+ids_len])
+        tfs = self.codec.decode(data[ptr+ids_len:])
+
+        vector = {}
+        term_id = 0
+        for gap, tf in zip(gaps, tfs):
+            term_id += gap
+            vector[self.vocabulary[term_id]] = tf
+        return vector
+
+    def has_docstore(self):
+        return bool(self.manifest.get("docstore"))
+
+    def get_document(self, docno):
+        '''returns {'title': title, 'abstract': abstract} of a document, read from the document store with a single read'''
+        files = self.manifest["docstore"]
+        block_n, position = divmod(docno, files["block_docs"])
+        with self.cache_lock:
+            if self.docstore_offsets is None:
+                offsets = array('Q')
+                with open(f"{self.path_to_folder}/{files['offsets']}", "rb") as f:
+                    offsets.frombytes(f.read())
+                self.docstore_offsets = offsets
+            block = self.docstore_cache.get(block_n)
+            self.cache_stats["docstore_hits" if block is not None else "docstore_misses"] += 1
+            if block is not None:
+                self.docstore_cache.move_to_end(block_n)
+
+        if block is None: # read and decompressed outside the lock, the other threads keep using the cache
+            with open(f"{self.path_to_folder}/{files['blocks']}", "rb") as f:
+                f.seek(self.docstore_offsets[block_n])
+                data = f.read(self.docstore_offsets[block_n+1] - self.docstore_offsets[block_n])
+            block = json.loads(zlib.decompress(data))
+            with self.cache_lock:
+                self.docstore_cache[block_n] = block
+                while len(self.docstore_cache) > 64:
+                    self.docstore_cache.popitem(last=False)
+
+        title, abstract = block[position]
+        return {"title": title, "abstract": abstract}
+
+    def stores_tf(self):
+        '''True if the postings hold raw term frequencies (tf schema) instead of precomputed weights'''
+        return self.get_ranking_schema() == "tf"
+
+    def has_fields(self):
+        return bool(self.manifest.get("fields"))
+
+    def get_field_lengths(self):
+        '''(title lengths, abstract lengths) of each docno, for an index built with fields'''
+        if self.field_lengths is None:
+            titles = array('I')
+            with open(f"{self.path_to_folder}/{self.manifest['fields']['title_lengths']}", "rb") as f:
+                titles.fromfile(f, self.manifest["documents_n"])
+            self.field_lengths = (titles, array('I', [dl - title for dl, title in zip(self.get_lengths(), titles)]))
+        return self.field_lengths
+
+    def get_lengths(self):
+        '''number of tokens of each docno'''
+        if self.lengths is None:
+            self.lengths = array('I')
+            with open(f"{self.path_to_folder}/{self.manifest['lengths']}", "rb") as f:
+                self.lengths.fromfile(f, self.manifest["documents_n"])
+        return self.lengths
+
+    def load_norms(self, scheme):
+        '''document norms of a SMART scheme (e.g. lnc), None if they were never computed for this index'''
+        path = f"{self.path_to_folder}/norms_{scheme}.bin"
+        if scheme not in self.norms and os.path.exists(path):
+            self.norms[scheme] = array('d')
+            with open(path, "rb") as f:
+                self.norms[scheme].fromfile(f, self.manifest["documents_n"])
+        return self.norms.get(scheme)
+
+    def save_norms(self, scheme, norms):
+        '''keeps the norms computed by a searcher next to the index, so the next runs can load them'''
+        self.norms[scheme] = norms
+        try:
+            with open(f"{self.path_to_folder}/norms_{scheme}.bin", "wb") as f:
+                norms.tofile(f)
+        except OSError: # read-only index folder, the norms are just not cached
+            pass
+
+    def set_global_stats(self, global_stats):
+        '''makes N, avdl and the df of this index (a shard) refer to the whole collection'''
+        self.global_stats = global_stats
+
+    def verify(self):
+        '''checks every index file against the checksums stored in the manifest'''
+        for filename, checksum in self.manifest["checksums"].items():
+            if file_checksum(f"{self.path_to_folder}/{filename}") != checksum:
+                raise RuntimeError(f"{self.path_to_folder}/{filename} does not match the checksum stored in the manifest, the index may be corrupted")
+
     @classmethod
-    def load_from_disk(cls, path_to_folder:str):
-        raise NotImplementedError()
+    def load_from_disk(cls, path_to_folder:str, verify=False):
+        manifest_path = f"{path_to_folder}/manifest.json"
+        if not os.path.exists(manifest_path):
+            raise FileNotFoundError(f"{manifest_path} not found, the index was built by an older version of the indexer and must be rebuilt")
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        with open(f"{path_to_folder}/{manifest['lexicon']}", "rb") as f:
+            lexicon = pickle.load(f)
+
+        doc_ids = array('I')
+        with open(f"{path_to_folder}/{manifest['documents']}", "rb") as f:
+            doc_ids.fromfile(f, manifest["documents_n"])
+
+        index = cls(path_to_folder, manifest, lexicon, doc_ids)
+        if verify:
+            index.verify()
+        return index
     
     def print_statistics(self):
         print("Print some stats about this index.. This should be implemented by the base classes")
-    
-    
\ No newline at end of file
+
+
+class QueryIndex:
+    """
+    The index as seen by a single query: its wildcard patterns are virtual
+    terms (pattern -> virtual term of InvertedIndex.add_virtual_term) that
+    the query holds itself, so the eviction of the index cache can not
+    remove them while the query is scored. Everything else is looked up in
+    the index.
+    """
+    def __init__(self, index, virtual_terms):
+        self.index = index
+        self.virtual_terms = virtual_terms
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def __contains__(self, token):
+        return token in self.virtual_terms or token in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_df(self, token):
+        virtual = self.virtual_terms.get(token)
+        if virtual:
+            return min(virtual["df"], self.index.N)
+        return self.index.get_df(token)
+
+    def get_max_weight(self, token):
+        virtual = self.virtual_terms.get(token)
+        if virtual:
+            return virtual["max_w"]
+        return self.index.get_max_weight(token)
+
+    def get_postings(self, token):
+        virtual = self.virtual_terms.get(token)
+        if virtual:
+            return virtual["postings"]
+        return self.index.get_postings(token)
+
+    def get_champion_postings(self, token):
+        virtual = self.virtual_terms.get(token)
+        if virtual: # a virtual term has no champion list, its postings are already in memory
+            return virtual["postings"]
+        return self.index.get_champion_postings(token)
+
+
+class ShardedIndex(BaseIndex):
+    """
+    Index folder written by the ShardedIndexer. It only holds the
+    collection-wide statistics and the docno -> pmid map of each shard,
+    the shards themselves are searched by the workers of a ShardCoordinator.
+    The documents are identified by (shard, docno).
+
+    """
+    def __init__(self, path_to_folder=None, manifest=None, global_stats=None, doc_ids=None):
+        super().__init__()
+        self.path_to_folder = path_to_folder
+        self.manifest = manifest if manifest is not None else {}
+        self.global_stats = global_stats if global_stats is not None else {"df": {}}
+        self.doc_ids = doc_ids if doc_ids is not None else [] # shard -> docno -> pmid
+        self.shard_manifests = []
+        self.shards = {} # shard -> InvertedIndex, only opened to read their documents
+
+    @property
+    def N(self):
+        return self.global_stats["documents_n"]
+
+    @property
+    def avdl(self):
+        return self.global_stats["avdl"]
+
+    def get_shard_folders(self):
+        return [f"{self.path_to_folder}/{folder}" for folder in self.manifest["shard_folders"]]
+
+    def get_tokenizer_kwargs(self):
+        return dict(self.manifest.get("tokenizer", {}))
+
+    def get_ranking_schema(self):
+        return self.manifest.get("ranking", {}).get("schema")
+
+    def __contains__(self, token):
+        return token in self.global_stats["df"]
+
+    def __len__(self):
+        return len(self.global_stats["df"])
+
+    def get_df(self, token):
+        return min(self.global_stats["df"][token], self.N) # the deleted documents are only taken out of the df by a rebuild
+
+    def get_pmid(self, docno):
+        shard, shard_docno = docno
+        return self.doc_ids[shard][shard_docno]
+
+    def get_shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = InvertedIndex.load_from_disk(self.get_shard_folders()[shard])
+        return self.shards[shard]
+
+    def delete_documents(self, pmids):
+        '''deletes the pmids from the shards that hold them, returns the pmids that were not found'''
+        pmids = set(pmids)
+        for shard in range(len(self.doc_ids)):
+            if pmids & set(self.doc_ids[shard]):
+                pmids = self.get_shard(shard).delete_documents(pmids)
+        return pmids
+
+    def has_forward_index(self):
+        return False # the query expansion would need the term vectors of every shard
+
+    def has_champions(self):
+        return all([bool(m.get("champions")) for m in self.shard_manifests])
+
+    def load_champions(self):
+        pass # each worker loads the champion lists of its shard
+
+    def has_docstore(self):
+        return all([bool(m.get("docstore")) for m in self.shard_manifests])
+
+    def has_fields(self):
+        return all([bool(m.get("fields")) for m in self.shard_manifests])
+
+    def get_document(self, docno):
+        shard, shard_docno = docno
+        return self.get_shard(shard).get_document(shard_docno)
+
+    @classmethod
+    def load_from_disk(cls, path_to_folder:str, verify=False):
+        with open(f"{path_to_folder}/manifest.json") as f:
+            manifest = json.load(f)
+        with open(f"{path_to_folder}/{manifest['global_stats']}", "rb") as f:
+            global_stats = pickle.load(f)
+
+        doc_ids, shard_manifests = [], []
+        for folder in manifest["shard_folders"]:
+            with open(f"{path_to_folder}/{folder}/manifest.json") as f:
+                shard_manifests.append(json.load(f))
+            shard_doc_ids = array('I')
+            with open(f"{path_to_folder}/{folder}/{shard_manifests[-1]['documents']}", "rb") as f:
+                shard_doc_ids.fromfile(f, shard_manifests[-1]["documents_n"])
+            doc_ids.append(shard_doc_ids)
+
+        global_stats["documents_n"] -= sum([len(read_deleted(folder)) for folder in [f"{path_to_folder}/{f}" for f in manifest["shard_folders"]]])
+        index = cls(path_to_folder, manifest, global_stats, doc_ids)
+        index.shard_manifests = shard_manifests
+        if verify:
+            for folder in index.get_shard_folders():
+                InvertedIndex.load_from_disk(folder, verify=True)
+        return index
+
+
+def read_deleted(path_to_folder):
+    '''sorted docnos of deleted.bin, empty if no document of the index was deleted'''
+    deleted = array('I')
+    if os.path.exists(f"{path_to_folder}/deleted.bin"):
+        with open(f"{path_to_folder}/deleted.bin", "rb") as f:
+            deleted.frombytes(f.read())
+    return deleted
+
+
+def write_deleted(path_to_folder, docnos):
+    '''
+    replaces deleted.bin with the sorted docnos, atomically. It is not in the manifest checksums since it
+    changes after the index is built
+    '''
+    with open(f"{path_to_folder}/deleted.bin.tmp", "wb") as f:
+        array('I', sorted(docnos)).tofile(f)
+    os.replace(f"{path_to_folder}/deleted.bin.tmp", f"{path_to_folder}/deleted.bin")
+
+
+def read_deleted_pmids(path_to_folder):
+    '''pmids of the documents deleted from the index in a folder, of every shard of a sharded index (read before a rebuild overwrites it)'''
+    if not os.path.exists(f"{path_to_folder}/manifest.json"):
+        return []
+    with open(f"{path_to_folder}/manifest.json") as f:
+        manifest = json.load(f)
+    if "shard_folders" in manifest:
+        return sorted({pmid for folder in manifest["shard_folders"] for pmid in read_deleted_pmids(f"{path_to_folder}/{folder}")})
+
+    deleted = read_deleted(path_to_folder)
+    if not deleted:
+        return []
+    doc_ids = array('I')
+    with open(f"{path_to_folder}/{manifest['documents']}", "rb") as f:
+        doc_ids.fromfile(f, manifest["documents_n"])
+    return sorted({doc_ids[docno] for docno in deleted})
+
+
+def load_index(path_to_folder:str, verify=False):
+    '''opens an index folder, either a single InvertedIndex or a ShardedIndex'''
+    manifest_path = f"{path_to_folder}/manifest.json"
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if "shard_folders" in json.load(f):
+                return ShardedIndex.load_from_disk(path_to_folder, verify)
+    return InvertedIndex.load_from_disk(path_to_folder, verify)
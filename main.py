@@ -13,7 +13,7 @@ was performed, yet].
 """
 
 import argparse
-from core import engine_logic, add_more_options_to_indexer
+from core import engine_logic, add_more_options_to_indexer, add_more_options_to_searcher
 
 class Params:
     """
@@ -320,6 +320,9 @@ if __name__ == "__main__":
     tfidf_mode_parser = searcher_modes_parser.add_parser('ranking.tfidf', help='Uses the TFIDF as the searching method')
     tfidf_mode_parser.add_argument("--ranking.tfidf.class", type=str, default="TFIDFRanking")
     tfidf_mode_parser.add_argument("--ranking.tfidf.smart", type=str, default="lnc.ltc")
+
+    add_more_options_to_searcher(searcher_parser, searcher_modes_parser)
+
     # CLI parsing
     #args = parser.parse_args()
     args = grouping_args(parser.parse_args())
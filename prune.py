@@ -0,0 +1,238 @@
+"""
+Static index pruning
+
+Writes a smaller variant of an existing index without the
+postings that are unlikely to reach the top results of a query:
+
+ - term: each postings list keeps the (1 - ratio) fraction of its
+         documents with the highest weights (at least --min_postings)
+ - document: each document keeps the (1 - ratio) fraction of its
+         tokens with the highest weights (at least --min_postings)
+
+The tf schema stores raw term frequencies, which tie a lot, so its
+postings are ranked by the document weight of the query time ranker
+(bm25, or tf-idf with --smart) instead. The kept postings still hold
+the raw term frequencies. The document method compares the tokens of
+a document by their score as a one-token query (query weight times
+document weight), since the document weights leave the idf out.
+
+The document frequencies, the document lengths and every other
+index file are kept, so the ranking of the remaining postings does
+not change. The champion lists and the k-gram index are written
+again from the remaining postings and tokens, and the deleted
+documents (deleted.bin) stay deleted. With --questions the full and the pruned indexes are
+compared in size, query latency and effectiveness.
+
+python3 prune.py pubmedSPIMIindex pubmedSPIMIindex_pruned --method term --ratio 0.5 --questions questions.jsonl
+
+"""
+import argparse, os, json, pickle, shutil
+from statistics import mean
+from index import InvertedIndex, kgram_index
+from reader import QuestionsReader
+from searcher import dynamically_init_searcher, calculate_precision_and_recall
+from tokenizers import dynamically_init_tokenizer
+from utils import Timer, file_checksum
+
+
+def impact_function(index, ranker, token, query_weighted=False):
+    '''
+    weight of a posting of token used to rank it, the stored weight or the document weight of the ranker for a tf schema
+    index. If query_weighted it is multiplied by the query weight of the token alone, to compare different tokens
+    '''
+    weigh = ranker.doc_weighting(index, [token])[token][0] if index.stores_tf() else lambda docno, d: d["w"]
+    if not query_weighted:
+        return weigh
+    if hasattr(ranker, "calc_tfidf_weight"): # before the cosine normalization, which would make any single token weight 1
+        query_weight = ranker.calc_tfidf_weight(1, index.N, index.get_df(token))
+    else:
+        query_weight = ranker.calc_query_weights(index, [token])[token]
+    return lambda docno, d: query_weight * weigh(docno, d)
+
+
+def term_thresholds(index, ranker, ratio, min_postings):
+    '''weight that a posting must reach to be kept, per token'''
+    thresholds = {}
+    for token in index.lexicon:
+        impact = impact_function(index, ranker, token)
+        weights = sorted([impact(docno, d) for docno, d in index.get_postings(token).items()], reverse=True)
+        keep = max(min_postings, round(len(weights) * (1 - ratio)))
+        thresholds[token] = weights[min(keep, len(weights)) - 1]
+    return thresholds
+
+
+def document_thresholds(index, ranker, ratio, min_postings):
+    '''weight that a posting must reach to be kept, per document'''
+    doc_weights = {}
+    for token in index.lexicon:
+        impact = impact_function(index, ranker, token, query_weighted=True)
+        for docno, d in index.get_postings(token).items():
+            doc_weights.setdefault(docno, []).append(impact(docno, d))
+
+    thresholds = {}
+    for docno, weights in doc_weights.items():
+        weights.sort(reverse=True)
+        keep = max(min_postings, round(len(weights) * (1 - ratio)))
+        thresholds[docno] = weights[min(keep, len(weights)) - 1]
+    return thresholds
+
+
+def prune_index(index, output_folder, method, ratio, min_postings, smart=None):
+    '''
+    writes the pruned postings to a single postings file and copies the remaining index files. The champion lists
+    and the k-gram index depend on the postings and on the tokens that are left, so they are written again.
+    The postings of a tf schema index are ranked with the document weights of init_ranker(index, smart)
+    '''
+    if os.path.abspath(index.path_to_folder) == os.path.abspath(output_folder): # the postings would be overwritten while they are read
+        raise ValueError("the output folder must not be the index folder")
+    os.makedirs(output_folder, exist_ok=True)
+    ranker = init_ranker(index, smart)
+    thresholds = (term_thresholds if method == "term" else document_thresholds)(index, ranker, ratio, min_postings)
+
+    champions_manifest = index.manifest.get("champions")
+    champions = {} # {token : [offset, length]}
+    champions_file = open(f"{output_folder}/{champions_manifest['postings']}", "wb") if champions_manifest else None
+    champions_offset = 0
+
+    lexicon = {}
+    offset = postings_n = pruned_n = 0
+    with open(f"{output_folder}/postings0.bin", "wb") as f:
+        for token, entry in index.lexicon.items():
+            postings = index.get_postings(token)
+            impact = impact_function(index, ranker, token, query_weighted=method == "document")
+            if method == "term":
+                kept = {docno: d for docno, d in postings.items() if impact(docno, d) >= thresholds[token]}
+            else:
+                kept = {docno: d for docno, d in postings.items() if impact(docno, d) >= thresholds[docno]}
+
+            postings_n += len(postings)
+            pruned_n += len(postings) - len(kept)
+            if not kept: # every document dropped this token
+                continue
+
+            data = index.codec.encode_postings(kept)
+            f.write(data)
+            lexicon[token] = [entry[0], 0, offset, len(data), max([d["w"] for d in kept.values()])] # the original df is kept for the idf
+            offset += len(data)
+
+            if champions_file and len(kept) > champions_manifest["r"]: # a shorter list is its own champion list
+                top = sorted(kept.items(), key=lambda item: item[1]["w"], reverse=True)[:champions_manifest["r"]]
+                encoded = index.codec.encode_postings(dict(top))
+                champions_file.write(encoded)
+                champions[token] = [champions_offset, len(encoded)]
+                champions_offset += len(encoded)
+
+    with open(f"{output_folder}/{index.manifest['lexicon']}", "wb") as f:
+        pickle.dump(lexicon, f)
+    files = [index.manifest["lexicon"], "postings0.bin"]
+
+    if champions_file:
+        champions_file.close()
+        with open(f"{output_folder}/{champions_manifest['lexicon']}", "wb") as f:
+            pickle.dump(champions, f)
+        files += [champions_manifest["postings"], champions_manifest["lexicon"]]
+
+    if index.manifest.get("kgrams"): # the term ids are positions in the sorted lexicon, which can lose tokens
+        with open(f"{output_folder}/{index.manifest['kgrams']['file']}", "wb") as f:
+            pickle.dump(kgram_index(lexicon, index.manifest["kgrams"]["k"]), f)
+        files.append(index.manifest["kgrams"]["file"])
+
+    manifest = dict(index.manifest)
+    manifest["shards"] = ["postings0.bin"]
+    manifest["pruning"] = {"method": method, "ratio": ratio, "min_postings": min_postings, "postings_n": postings_n, "pruned_n": pruned_n}
+
+    for filename in index.manifest["checksums"]:
+        if filename not in files and filename not in index.manifest["shards"]:
+            shutil.copyfile(f"{index.path_to_folder}/{filename}", f"{output_folder}/{filename}")
+            files.append(filename)
+    if index.get_deleted(): # the pruned postings still hold the deleted documents, the searchers keep skipping them
+        shutil.copyfile(f"{index.path_to_folder}/deleted.bin", f"{output_folder}/deleted.bin")
+    manifest["checksums"] = {f: file_checksum(f"{output_folder}/{f}") for f in files}
+
+    with open(f"{output_folder}/manifest.json", "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    print(f"Pruned {pruned_n} of {postings_n} postings ({pruned_n/postings_n:.1%}), {len(index.lexicon)-len(lexicon)} tokens lost all their postings")
+    return InvertedIndex.load_from_disk(output_folder)
+
+
+def init_ranker(index, smart=None):
+    '''
+    ranker that matches the weights stored in the index. The tf schema stores raw term frequencies, so the
+    ranker is chosen at query time as in the searcher: tf-idf with the smart notation if given, otherwise bm25
+    with the searcher defaults
+    '''
+    ranking = dict(index.manifest["ranking"])
+    schema = ranking.pop("schema")
+    if schema == "tf":
+        ranking = {"class": "TFIDFRanking", "smart": smart} if smart else {"class": "BM25Ranking", "k1": 1.2, "b": 0.75}
+        return dynamically_init_searcher(**ranking)
+    return dynamically_init_searcher(**{"class": "BM25Ranking" if schema == "bm25" else "TFIDFRanking"}, **ranking)
+
+
+def postings_size(index):
+    return sum([os.path.getsize(f"{index.path_to_folder}/{f}") for f in index.manifest["shards"]])
+
+
+def evaluate(index, questions, top_k, smart=None):
+    '''runs every question against the index, returns the ranked pmids of each question and the mean latency, P@10 and AP@10'''
+    ranker = init_ranker(index, smart)
+    tokenizer = dynamically_init_tokenizer(**index.get_tokenizer_kwargs())
+    timer = Timer()
+    rankings, latencies, precisions, average_precisions = [], [], [], []
+    for question in questions:
+        timer.start()
+        tokens = [t for t in tokenizer.tokenize(question["query_text"]) if t in index]
+        results = ranker.rank(index, tokens, top_k)
+        latencies.append(timer.stop())
+
+        results = [(index.get_pmid(docno), doc_data) for docno, doc_data in results]
+        rankings.append([pmid for pmid, _ in results])
+        if results and question.get("documents_pmid"):
+            precision, _, average_precision = calculate_precision_and_recall(results, question["documents_pmid"], k=min(10, len(results)))
+            precisions.append(precision)
+            average_precisions.append(average_precision)
+
+    return rankings, {"size (MB)": postings_size(index)*1e-6,
+                      "latency (ms)": mean(latencies)*1e3,
+                      "P@10": mean(precisions) if precisions else 0,
+                      "AP@10": mean(average_precisions) if average_precisions else 0}
+
+
+def compare(full_index, pruned_index, path_to_questions, top_k, smart=None):
+    questions = list(QuestionsReader(path_to_questions).read())
+    for index in [full_index, pruned_index]: # warm up the page cache so the first index is not penalized
+        evaluate(index, questions, top_k, smart)
+    full_rankings, full_stats = evaluate(full_index, questions, top_k, smart)
+    pruned_rankings, pruned_stats = evaluate(pruned_index, questions, top_k, smart)
+
+    # fraction of the full index top_k that the pruned index still returns
+    overlaps = [len(set(f) & set(p))/len(f) for f, p in zip(full_rankings, pruned_rankings) if f]
+
+    print(f"\n{'':<14}{'full':>12}{'pruned':>12}")
+    for stat in full_stats:
+        print(f"{stat:<14}{full_stats[stat]:>12.3f}{pruned_stats[stat]:>12.3f}")
+    print(f"{f'top-{top_k} overlap':<14}{'':>12}{mean(overlaps) if overlaps else 0:>12.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a statically pruned copy of an index")
+    parser.add_argument("index_folder", type=str, help="Folder of the index to be pruned.")
+    parser.add_argument("output_folder", type=str, help="Folder where the pruned index will be written.")
+    parser.add_argument("--method", type=str, default="term", choices=["term", "document"], help="Pruning criterion, per postings list or per document. (default=term).")
+    parser.add_argument("--ratio", type=float, default=0.5, help="Fraction of the postings of each token/document to be removed. (default=0.5).")
+    parser.add_argument("--min_postings", type=int, default=10, help="Postings of each token/document that are never removed. (default=10).")
+    parser.add_argument("--questions", type=str, default=None, help="Questions file used to compare the full and the pruned index. (default=no comparison).")
+    parser.add_argument("--top_k", type=int, default=10, help="Number of results per question used in the comparison. (default=10).")
+    parser.add_argument("--smart", type=str, default=None, help="SMART notation of the tf-idf ranker whose document weights rank the postings of a tf schema index, also used in the comparison. (default=bm25 with k1=1.2 and b=0.75).")
+    args = parser.parse_args()
+
+    if not 0 <= args.ratio < 1:
+        parser.error("--ratio must be in [0, 1)")
+    if os.path.abspath(args.index_folder) == os.path.abspath(args.output_folder):
+        parser.error("the output folder must not be the index folder")
+
+    full_index = InvertedIndex.load_from_disk(args.index_folder)
+    pruned_index = prune_index(full_index, args.output_folder, args.method, args.ratio, args.min_postings, args.smart)
+    if args.questions:
+        compare(full_index, pruned_index, args.questions, args.top_k, args.smart)
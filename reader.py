@@ -8,7 +8,8 @@ Holds the code/logic addressing the Reader class
 and how to read text from a specific data format.
 
 """
-import gzip, json
+import gzip, json, os, glob, zlib
+from bisect import bisect_right
 from utils import dynamically_init_class
 
 def dynamically_init_reader(**kwargs):
@@ -52,20 +53,214 @@ class Reader:
         
     
 class PubMedReader(Reader):
-    
+    """
+    Reads a JSONL collection, one document per line. The collection
+    can be a file (plain or gzip), a directory or a glob pattern of
+    collection shards, read in name order as a single stream.
+
+    Offsets are positions in this (decompressed) stream. A reader can
+    be split into readers of disjoint, contiguous byte ranges, each one
+    reads the lines that start in its range. Plain files are seeked
+    directly, gzip files start decompressing at the closest access
+    point (see `gzip_access_points`). The access points (and the
+    decompressed sizes) are only computed when a range has to be
+    located, a whole read just decompresses the files in order.
+
+    """
     def __init__(self, 
                  path_to_collection:str,
+                 start:int=0,
+                 end:int=None,
                  **kwargs):
         super().__init__(path_to_collection, **kwargs)
-        print("init PubMedReader|", f"{self.path_to_collection=}")
+        self.files = collection_files(path_to_collection)
+        self.gzip_files = {f for f in self.files if is_gzip(f)}
+        self.access_points = {} # gzip file -> its access points, computed on first use
+        self._file_starts = None
+        self.start = start
+        self.end = end # None: the end of the stream
+        self.offset = start # offset of the next line, lets an interrupted index build resume from it
+        print("init PubMedReader|", f"{self.path_to_collection=}", f"files={len(self.files)}", f"{start=}", f"end={self.end}")
         if kwargs:
             print(f"{self.__class__.__name__} also caught the following additional arguments {kwargs}")
 
     def read(self):
-        with gzip.open(self.path_to_collection, 'r') as collection:
-            for doc in collection:
-                doc = json.loads(doc.decode('utf-8'))
-                yield { k : v for k, v in doc.items() if k in ['title', 'abstract', 'pmid'] }
+        for line in self.read_lines():
+            yield self.parse(line)
+
+    @property
+    def file_starts(self):
+        '''offset of each file in the stream and the size of the stream, the gzip files need their access points'''
+        if self._file_starts is None:
+            self._file_starts = [0]
+            for f in self.files:
+                self._file_starts.append(self._file_starts[-1] + (self.get_access_points(f)["size"] if f in self.gzip_files else os.path.getsize(f)))
+        return self._file_starts
+
+    def get_access_points(self, path):
+        if path not in self.access_points:
+            self.access_points[path] = gzip_access_points(path)
+        return self.access_points[path]
+
+    def split(self, n):
+        '''n readers of disjoint, contiguous ranges of this reader, with about the same number of bytes'''
+        end = self.file_starts[-1] if self.end is None else self.end
+        bounds = [self.start + (end - self.start) * k // n for k in range(n + 1)]
+        readers = [PubMedReader(self.path_to_collection, start, end) for start, end in zip(bounds, bounds[1:])]
+        for reader in readers:
+            reader.access_points = self.access_points # computed once
+        return readers
+
+    def read_lines(self, offset=0):
+        '''yields the raw (decompressed) lines that start in [max(offset, start), end), one document per line'''
+        pos = max(offset, self.start)
+        # the file sizes are only needed to find the file of the first line or the end of the range
+        sized = self.end is not None or (pos > 0 and len(self.files) > 1)
+        first = bisect_right(self.file_starts, pos) - 1 if sized else 0
+        for n in range(first, len(self.files)):
+            if sized and self.file_starts[n] >= (self.end if self.end is not None else self.file_starts[-1]):
+                return
+            local = pos - self.file_starts[n] if sized else pos if n == 0 else 0 # unsized, the previous files were read whole
+            with self.open_at(self.files[n], max(local - 1, 0)) as f:
+                if local > 0: # the line that holds local-1 belongs to the previous range (or is the previous line if local-1 is its newline)
+                    pos += len(f.readline()) - 1
+                while self.end is None or pos < self.end:
+                    line = f.readline()
+                    if not line:
+                        break
+                    pos += len(line)
+                    self.offset = pos
+                    if line.strip():
+                        yield line
+            if sized:
+                pos = self.file_starts[n + 1]
+
+    def open_at(self, path, offset):
+        '''
+        binary file object of a collection file, positioned at a decompressed offset. Without access points (computed
+        or cached) a gzip file is decompressed from the start, which costs less than the pass that computes them
+        '''
+        if path not in self.gzip_files:
+            f = open(path, "rb")
+            f.seek(offset)
+            return f
+
+        access_points = self.access_points.get(path) or read_access_points(path)
+        points = access_points["points"] if access_points else [(0, 0)]
+        compressed, decompressed = points[bisect_right([d for _, d in points], offset) - 1]
+        raw = open(path, "rb")
+        raw.seek(compressed)
+        f = gzip.GzipFile(fileobj=raw, mode="rb")
+        f.myfileobj = raw # closed with the GzipFile
+        f.seek(offset - decompressed) # only decompresses from the access point
+        return f
+
+    def parse(self, line):
+        '''converts a raw line into a document'''
+        doc = json.loads(line.decode('utf-8'))
+        return { k : v for k, v in doc.items() if k in ['title', 'abstract', 'pmid'] }
+
+def collection_files(path):
+    '''the files of a collection: a file, the files of a directory or the files matched by a glob pattern, in name order'''
+    if os.path.isdir(path):
+        files = [os.path.join(path, f) for f in os.listdir(path)]
+    elif os.path.exists(path):
+        return [path]
+    else:
+        files = glob.glob(path)
+    files = sorted([f for f in files if os.path.isfile(f) and not f.endswith(".access.json")]) # not the cached access points
+    if not files:
+        raise FileNotFoundError(f"No collection files match {path}")
+    return files
+
+
+def is_gzip(path):
+    with open(path, "rb") as f:
+        return f.read(2) == b"\x1f\x8b"
+
+
+def gzip_access_points(path, spacing=2**24):
+    '''
+    Access points of a gzip file, where decompression can start: {"size": decompressed size, "points": [(compressed
+    offset, decompressed offset)]}. Decompression can only start at the beginning of a gzip member, so the points are
+    the members that start at least spacing bytes after the previous point. Multi-member files (bgzip, pigz -i or
+    concatenated gzip files) can be split anywhere, a single-member file only has the point at 0 and its readers
+    decompress from the start. Computed with one pass over the file and cached in <path>.access.json
+    '''
+    access_points = read_access_points(path, spacing)
+    if access_points:
+        return access_points
+
+    points = [(0, 0)]
+    size = 0
+    decompressor = zlib.decompressobj(31)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(2**20)
+            if not chunk:
+                break
+            offset = f.tell() - len(chunk) # compressed offset of the chunk
+            while chunk:
+                if decompressor.eof: # a new member starts at the chunk
+                    decompressor = zlib.decompressobj(31)
+                    if not chunk.strip(b"\x00"): # trailing zeros are padding, not a member
+                        break
+                    if size - points[-1][1] >= spacing:
+                        points.append((offset, size))
+                size += len(decompressor.decompress(chunk))
+                if not decompressor.eof:
+                    break
+                chunk = decompressor.unused_data
+                offset = f.tell() - len(chunk)
+
+    access_points = {"size": size, "spacing": spacing, "points": points}
+    try:
+        with open(f"{path}.access.json", "w") as f:
+            json.dump(access_points, f)
+    except OSError: # read-only collection, the points are computed again next time
+        pass
+    return access_points
+
+
+def read_access_points(path, spacing=2**24):
+    '''the access points of a gzip file cached in <path>.access.json, None if there are none or they are stale'''
+    cache = f"{path}.access.json"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        with open(cache) as f:
+            access_points = json.load(f)
+        if access_points["spacing"] == spacing:
+            return access_points
+    return None
+
+
+class ShardReader(Reader):
+    """
+    Reads one document partition of another reader, the documents
+    n where n % shards == shard. Only the lines of this partition
+    are parsed, the other ones are just skipped.
+
+    """
+    def __init__(self, 
+                 reader,
+                 shard:int,
+                 shards:int):
+        super().__init__(reader.path_to_collection)
+        self.reader = reader
+        self.shard = shard
+        self.shards = shards
+
+    def read(self):
+        for line in self.read_lines():
+            yield self.parse(line)
+
+    def read_lines(self):
+        lines = self.reader.read_lines() if hasattr(self.reader, "read_lines") else self.reader.read()
+        for n, line in enumerate(lines):
+            if n % self.shards == self.shard:
+                yield line
+
+    def parse(self, line):
+        return self.reader.parse(line) if hasattr(self.reader, "parse") else line
 
 class QuestionsReader(Reader):
     def __init__(self, 
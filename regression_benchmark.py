@@ -0,0 +1,135 @@
+"""
+Performance regression benchmark
+
+Builds an index of a collection and searches its questions, as new
+processes of the CLI, and measures:
+
+ - indexing throughput: documents per second of wall time
+ - peak resident memory of the indexer and size of the index
+ - query latency: p50 and p95 of the --searcher.trace records
+
+The median of --runs runs is compared against a stored baseline and
+a metric regresses if it is worse by more than --tolerance. The exit
+code is 1 if any metric regressed, so the benchmark can be used as a
+check. With --save_baseline the results become the new baseline.
+The synthetic collections of synthetic_collection.py make it
+reproducible on machines without the PubMed dumps:
+
+python3 synthetic_collection.py collections --documents 20000
+python3 regression_benchmark.py collections/pubmed_synthetic_20000.jsonl.gz collections/questions_synthetic_20000.jsonl --baseline baseline.json --save_baseline
+python3 regression_benchmark.py collections/pubmed_synthetic_20000.jsonl.gz collections/questions_synthetic_20000.jsonl --baseline baseline.json
+
+"""
+import argparse, os, sys, json, shlex, subprocess, tempfile
+from statistics import median
+from utils import Timer
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(REPO, "main.py")
+
+# metric -> True if higher is better
+METRICS = {"indexing_docs_per_s": True, "indexing_peak_rss_mb": False, "index_mb": False, "query_p50_ms": False, "query_p95_ms": False}
+
+
+def run(command, cwd):
+    '''wall time of command, with no terminal attached'''
+    timer = Timer()
+    timer.start()
+    subprocess.run(command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True, env=dict(os.environ, PYTHONPATH=REPO))
+    return timer.stop()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def measure(collection, questions, indexer_args, ranking, searcher_args, work_dir):
+    '''metrics of one index build and one search of every question (after a warm-up search)'''
+    # the processes run in work_dir since the indexer writes to a folder relative to the working directory
+    wall_time = run([sys.executable, MAIN, "indexer", os.path.abspath(collection), "index"] + indexer_args, work_dir)
+    with open(f"{work_dir}/index/manifest.json") as f:
+        documents_n = json.load(f)["documents_n"]
+    with open(f"{work_dir}/index/statistics.json") as f:
+        statistics = json.load(f)
+
+    search = [sys.executable, MAIN, "searcher", "index", os.path.abspath(questions), os.devnull, "--searcher.trace", "trace.jsonl"] + searcher_args + [f"ranking.{ranking}"]
+    run(search, work_dir) # warm-up, the postings are in the page cache for the measured search
+    run(search, work_dir)
+    with open(f"{work_dir}/trace.jsonl") as f:
+        latencies = [json.loads(line)["latency_ms"] for line in f]
+
+    return {"indexing_docs_per_s": documents_n / wall_time,
+            "indexing_peak_rss_mb": statistics.get("peak_rss_bytes", 0) * 1e-6, # the sharded indexer does not monitor its workers
+            "index_mb": statistics["index_size_bytes"] * 1e-6,
+            "query_p50_ms": percentile(latencies, 0.5),
+            "query_p95_ms": percentile(latencies, 0.95)}
+
+
+def compare(metrics, baseline, tolerance):
+    '''prints the metrics next to the baseline ones, returns the names of the metrics that regressed'''
+    regressions = []
+    print(f"\n{'metric':<24}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, higher_is_better in METRICS.items():
+        current = metrics[name]
+        if name not in baseline:
+            print(f"{name:<24}{'-':>12}{current:>12.2f}")
+            continue
+        change = (current - baseline[name]) / baseline[name] if baseline[name] else 0
+        worse = -change if higher_is_better else change
+        status = "REGRESSION" if worse > tolerance else "improved" if worse < -tolerance else ""
+        if status == "REGRESSION":
+            regressions.append(name)
+        print(f"{name:<24}{baseline[name]:>12.2f}{current:>12.2f}{change:>+10.1%}  {status}")
+    return regressions
+
+
+def main(args):
+    settings = {"collection": os.path.basename(args.collection), "questions": os.path.basename(args.questions),
+                "indexer_args": args.indexer_args, "ranking": args.ranking, "searcher_args": args.searcher_args}
+    runs = []
+    for n in range(args.runs):
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+            runs.append(measure(args.collection, args.questions, shlex.split(args.indexer_args), args.ranking, shlex.split(args.searcher_args), work_dir))
+        print(f"run {n+1}/{args.runs}: " + ", ".join([f"{name} {value:.2f}" for name, value in runs[-1].items()]))
+    metrics = {name: median([r[name] for r in runs]) for name in METRICS}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored["settings"] != settings:
+            print(f"WARNING: the baseline was measured with other settings ({stored['settings']}), the comparison may not be meaningful")
+        baseline = stored["metrics"]
+    elif not args.save_baseline:
+        print(f"WARNING: there is no baseline in {args.baseline}, run with --save_baseline to store one")
+
+    regressions = compare(metrics, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"settings": settings, "metrics": metrics}, f, indent=4)
+        print(f"\nSaved the baseline to {args.baseline}")
+        return 0
+    if regressions:
+        print(f"\nFAIL: {', '.join(regressions)} regressed by more than {args.tolerance:.0%}")
+        return 1
+    print(f"\nOK: no metric regressed by more than {args.tolerance:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the indexer and searcher performance and compares it against a baseline")
+    parser.add_argument("collection", type=str, help="Collection to be indexed (see synthetic_collection.py).")
+    parser.add_argument("questions", type=str, help="Questions to be searched.")
+    parser.add_argument("--baseline", type=str, default="baseline.json", help="File with the baseline metrics. (default=baseline.json).")
+    parser.add_argument("--save_baseline", action="store_true", help="Stores the results as the new baseline instead of failing on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change of a metric that is reported as a regression. (default=0.2).")
+    parser.add_argument("--runs", type=int, default=3, help="Number of runs, the median of each metric is used. (default=3).")
+    parser.add_argument("--indexer_args", type=str, default="--indexer.ranking_schema bm25", help="Options of the indexer. (default='--indexer.ranking_schema bm25').")
+    parser.add_argument("--ranking", type=str, default="bm25", help="Ranking mode of the searcher (ranking.<name>). (default=bm25).")
+    parser.add_argument("--searcher_args", type=str, default="", help="Options of the searcher. (default=none).")
+    parser.add_argument("--work_dir", type=str, default=None, help="Folder of the temporary indexes. (default=system temporary folder).")
+    args = parser.parse_args()
+
+    sys.exit(main(args))
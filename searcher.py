@@ -1,5 +1,15 @@
-import pickle, os, itertools, math
-from utils import dynamically_init_class, extract_data_from_index
+import os, sys, re, json, math, heapq
+from itertools import islice
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from timeit import default_timer as timer
+from multiprocessing import Process, Pipe
+from array import array
+from utils import dynamically_init_class, Timer
+from index import QueryIndex
 from math import sqrt, log10
 
 
@@ -25,8 +35,218 @@ def dynamically_init_searcher(**kwargs):
 
 class BaseSearcher:
 
-    def search(self, index, query_tokens, top_k):
-        pass
+    def __init__(self, max_accumulators=None, accumulator_strategy="continue", prefetch_threads=0, rm3=None, tiered=False, max_expansions=50, trace=None, time_budget_ms=None, **kwargs):
+        super().__init__()
+        if max_accumulators is not None and max_accumulators < 0:
+            raise ValueError("max_accumulators must not be negative")
+        self.max_accumulators = max_accumulators or None # 0 means unlimited
+        self.accumulator_strategy = accumulator_strategy
+        self.executor = ThreadPoolExecutor(prefetch_threads) if prefetch_threads else None # postings prefetching
+        self.prefetch_threads = prefetch_threads # postings lists read ahead of the scoring, at most
+        self.rm3 = rm3 if rm3 and rm3["fb_docs"] else None
+        self.tiered = tiered
+        self.max_expansions = max_expansions # tokens a wildcard pattern can expand to
+        self.trace = trace # file where a QueryTrace record of each query is written, None disables tracing
+        self.time_budget_ms = time_budget_ms # per query, None for no budget
+        self.in_flight = {} # (query text, top_k, budget) -> Future of the execution that is answering it
+        self.in_flight_lock = Lock()
+        self.coalesced_n = 0 # queries answered by another execution of the same query
+        self.coordinator = None # ShardCoordinator, when searching a sharded index
+        self.unused_kwargs = kwargs # the sub-classes report these as not caught
+
+    def search(self, tokenizer, index, top_k, reader):
+        if self.rm3 and not index.has_forward_index():
+            print("WARNING: the index has no forward index (--indexer.forward_index), the RM3 query expansion is disabled")
+            self.rm3 = None
+
+        if self.tiered:
+            if index.has_champions():
+                index.load_champions() # before the prefetch threads start reading
+            else:
+                print("WARNING: the index has no champion lists (--indexer.champions_r), every query uses the full postings")
+                self.tiered = False
+
+        trace_file = open(self.trace, "w") if self.trace else None
+        latencies = []
+        for question in reader.read():
+            print(question)
+            trace = QueryTrace(question.get("query_id"), index) if trace_file else None
+            deadline = Deadline(self.time_budget_ms) if self.time_budget_ms else None
+            with QueryTrace.stage(trace, "tokenize"):
+                tokens, expansions, query_index = self.tokenize_query(tokenizer, index, question["query_text"])
+            ranked_results = self.rank(query_index, tokens, top_k, trace=trace, deadline=deadline)
+
+            if self.rm3 and deadline and deadline.expired():
+                deadline.cut() # no time left for the expanded query
+            elif self.rm3:
+                with QueryTrace.stage(trace, "expansion"):
+                    tokens, query_weights = self.expand_query(query_index, tokens, ranked_results)
+                ranked_results = self.rank(query_index, tokens, top_k, query_weights, trace, deadline)
+
+            if trace:
+                latencies.append(trace.stop(len(ranked_results)))
+                trace.record["approximate"] = bool(deadline and deadline.approximate)
+            if deadline and deadline.approximate:
+                print(f"(approximate: the {self.time_budget_ms} ms time budget ran out)")
+
+            docnos = [docno for docno, _ in ranked_results]
+            ranked_results = [(index.get_pmid(docno), doc_data) for docno, doc_data in ranked_results]
+            precision, recall, average_precision = calculate_precision_and_recall(ranked_results, question["documents_pmid"], k = min(10, len(ranked_results))) # approximate results can have less
+            f_measure = calculate_fmeasure(precision, recall)
+            print(f'\nPrecision -> {precision}')
+            print(f'Recall -> {recall}')
+            print(f'Avg-Precision -> {average_precision}')
+            print(f'F-Measure -> {f_measure}\n')
+            snippet = None
+            if index.has_docstore():
+                query_tokens = set(tokens) | expansions
+                snippet = lambda n: make_snippet(index.get_document(docnos[n]), tokenizer, query_tokens)
+            display_results(ranked_results, snippet)
+            if trace: # after the snippets, so their docstore reads are counted
+                trace_file.write(json.dumps(trace.finish()) + "\n")
+
+        if trace_file:
+            trace_file.close()
+            print(f"\nLatency histogram ({len(latencies)} queries, traces in {self.trace}):")
+            print(latency_histogram(latencies))
+
+        if self.coordinator:
+            self.coordinator.close()
+
+    def tokenize_query(self, tokenizer, index, text):
+        '''
+        query tokens that are in the index, the tokens that its wildcard patterns (immuno*, *virus) expanded to and
+        the index the query is ranked with. Each pattern becomes a single virtual term, with the merged postings of
+        its expansions, that the returned QueryIndex holds for the query
+        '''
+        text, patterns = split_wildcards(text)
+        tokens = [t for t in tokenizer.tokenize(text) if t in index]
+        expansions = set()
+        if not patterns:
+            return tokens, expansions, index
+        if not hasattr(index, "expand_wildcard"):
+            print(f"WARNING: wildcard queries are not supported by {index.__class__.__name__}, ignoring {patterns}")
+            return tokens, expansions, index
+
+        virtual_terms = {}
+        for pattern in patterns:
+            if getattr(tokenizer, "case_folding", False):
+                pattern = pattern.lower()
+            virtual = index.get_virtual_term(pattern)
+            if not virtual:
+                terms = index.expand_wildcard(pattern, self.max_expansions)
+                virtual = index.add_virtual_term(pattern, terms) if terms else None
+            if virtual:
+                virtual_terms[pattern] = virtual
+                tokens.append(pattern)
+                expansions.update(virtual["terms"])
+        return tokens, expansions, QueryIndex(index, virtual_terms)
+
+    def query(self, index, tokenizer, text, top_k, time_budget_ms=None):
+        '''
+        Answers a single query, can be called from several threads (serving). Returns (top_k (docno, doc_data), approximate),
+        approximate is True if the time budget ran out before the scoring finished. Identical concurrent queries (same text,
+        top_k and budget) share a single execution: the ones that arrive while it runs wait for its results, so the
+        returned lists are shared and must not be modified.
+        '''
+        key = (text, top_k, time_budget_ms)
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            running = future is not None
+            if running:
+                self.coalesced_n += 1
+            else:
+                future = self.in_flight[key] = Future()
+        if running:
+            return future.result()
+
+        try:
+            deadline = Deadline(time_budget_ms) if time_budget_ms else None
+            tokens, _, query_index = self.tokenize_query(tokenizer, index, text)
+            results = self.rank(query_index, tokens, top_k, deadline=deadline)
+            future.set_result((results, bool(deadline and deadline.approximate)))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+        return future.result()
+
+    def calc_query_weights(self, index, tokens):
+        """
+        Weights of the query tokens, this should be
+        implemented by specific ranking sub-classes.
+        """
+        raise NotImplementedError()
+
+    def doc_weighting(self, index, terms):
+        """
+        Document side of the ranking function for indexes that store raw
+        term frequencies (tf schema), this should be implemented by
+        specific ranking sub-classes.
+
+        Returns {term: (weight(docno, posting), upper bound of the weight)},
+        posting is {'w': tf, 'positions': [...]}
+        """
+        raise NotImplementedError()
+
+    def rank(self, index, tokens, top_k, query_weights=None, trace=None, deadline=None):
+        '''
+        returns the top_k (docno, doc_data) of a tokenized query. In tiered mode the query is first answered
+        from the champion lists and only falls back to the full postings if these give less than top_k documents
+        (and the deadline has not expired). A Deadline is marked approximate if it stopped the scoring
+        '''
+        with QueryTrace.stage(trace, "lexicon"):
+            if query_weights is None:
+                query_weights = self.calc_query_weights(index, tokens)
+        if self.coordinator: # the weights were computed with the global statistics, the shards only score their documents
+            if trace:
+                trace.omit("bytes_read") # the postings are read by the shard workers
+            with QueryTrace.stage(trace, "shards"):
+                return self.coordinator.rank(tokens, query_weights, top_k, deadline)
+        with QueryTrace.stage(trace, "lexicon"):
+            weighting = self.doc_weighting(index, set(tokens)) if index.stores_tf() else None
+        if self.tiered:
+            results = ranked_retrieval(index, tokens, query_weights, top_k, self.max_accumulators, self.accumulator_strategy, self.executor, index.get_champion_postings, weighting, trace, deadline, self.prefetch_threads)
+            if len(results) >= top_k:
+                return results
+            if deadline and deadline.expired(): # no time left for the full postings
+                deadline.cut()
+                return results
+        return ranked_retrieval(index, tokens, query_weights, top_k, self.max_accumulators, self.accumulator_strategy, self.executor, weighting=weighting, trace=trace, deadline=deadline, prefetch_window=self.prefetch_threads)
+
+    def expand_query(self, index, tokens, ranked_results):
+        '''
+        RM3 pseudo-relevance feedback. The relevance model P(t|R) is estimated from the term vectors of the
+        top fb_docs documents (read from the forward index), each weighted by its normalized score. The top
+        fb_terms terms are interpolated with the original query and the ranker weights of each term are
+        scaled by the resulting probability. The query is not expanded if the feedback documents have no score
+        (every query term has idf 0) or no terms.
+        '''
+        feedback = ranked_results[:self.rm3["fb_docs"]]
+        scores_sum = sum([doc_data["score"] for _, doc_data in feedback])
+        if scores_sum <= 0 or not tokens:
+            return tokens, self.calc_query_weights(index, tokens)
+        relevance_model = Counter()
+        for docno, doc_data in feedback:
+            vector = index.get_term_vector(docno)
+            dl = sum(vector.values())
+            for t, tf in vector.items():
+                relevance_model[t] += tf/dl * doc_data["score"]/scores_sum
+
+        expansion = dict(relevance_model.most_common(self.rm3["fb_terms"]))
+        expansion_sum = sum(expansion.values())
+        if expansion_sum <= 0:
+            return tokens, self.calc_query_weights(index, tokens)
+
+        original_weight = self.rm3["original_query_weight"]
+        query_model = {t: original_weight * tokens.count(t)/len(tokens) for t in tokens}
+        for t, p in expansion.items():
+            query_model[t] = query_model.get(t, 0) + (1-original_weight) * p/expansion_sum
+
+        expanded_tokens = list(query_model)
+        base_weights = self.calc_query_weights(index, expanded_tokens)
+        return expanded_tokens, {t: base_weights[t] * p for t, p in query_model.items()}
 
     def batch_search(self, index, reader, tokenizer, output_file, top_k=1000):
         print("searching...")
@@ -44,62 +264,98 @@ class TFIDFRanking(BaseSearcher):
         super().__init__(**kwargs)
         self.smart = smart
         self.logarithm = {} # store pre-calculated logarithms to fetch them later
+        self.norms = {} # (index folder, SMART document scheme) -> (norm of each docno, min norm)
 
         print("init TFIDFRanking|", f"{smart=}")
-        if kwargs:
-            print(f"{self.__class__.__name__} also caught the following additional arguments {kwargs}")
-
-    def search(self, tokenizer, index_folder, top_k, reader):
-        with open("document_N.txt", "r") as f:
-            N = int(f.readline())
-        index = load_from_disk(index_folder, filename="index.pkl")
-
-        for question in reader.read():
-            print(question)
-            tokens = [t for t in tokenizer.tokenize(question["query_text"]) if t in index]
-            query_weights = self.calc_normalized_weights(N, tokens, index, index_folder)
-            ranked_results = ranked_retrieval(index, tokens, query_weights, top_k, index_folder)
-            precision, recall, average_precision = calculate_precision_and_recall(ranked_results, question["documents_pmid"], k = 10)
-            f_measure = calculate_fmeasure(precision, recall)
-            print(f'\nPrecision -> {precision}')
-            print(f'Recall -> {recall}')
-            print(f'Avg-Precision -> {average_precision}')
-            print(f'F-Measure -> {f_measure}\n')
-            display_results(ranked_results)
+        if self.unused_kwargs:
+            print(f"{self.__class__.__name__} also caught the following additional arguments {self.unused_kwargs}")
 
+    def calc_query_weights(self, index, tokens):
+        return self.calc_normalized_weights(index.N, tokens, index)
 
     def log(self, n):
         if n not in self.logarithm:
             self.logarithm[n] = log10(n)
         return self.logarithm[n]
 
-    def calc_tfidf_weight(self, tf, N, df):
-        if self.smart == "lnc.ltc":
-            l = 1 + self.log(tf)
-            t = self.log(N/df)
-        elif self.smart == "lnc.npc":
-            l = tf
+    def doc_weighting(self, index, terms):
+        '''document weights of the SMART document scheme (the part before the dot), tf in n/l/b, df in n/t/p and normalization in n/c'''
+        scheme = self.smart.split(".")[0]
+        tf_weight = self.tf_weight_function(scheme[0])
+        norms, min_norm = self.get_norms(index, scheme)
+
+        weighting = {}
+        for t in terms:
+            idf = self.idf_weight(scheme[1], index.N, index.get_df(t))
+            weigh = lambda docno, posting, idf=idf: tf_weight(posting["w"]) * idf / norms[docno]
+            weighting[t] = (weigh, tf_weight(index.get_max_weight(t)) * idf / min_norm)
+        return weighting
+
+    def tf_weight_function(self, letter):
+        if letter == "l":
+            return lambda tf: 1 + self.log(tf)
+        if letter == "b":
+            return lambda tf: 1
+        return lambda tf: tf
+
+    def get_norms(self, index, scheme):
+        '''norm of each document for a SMART document scheme, computed once per index and scheme'''
+        key = (index.path_to_folder, scheme)
+        if key not in self.norms:
+            if scheme[2] != "c": # no normalization
+                norms = array('d', [1]) * index.manifest["documents_n"]
+            else:
+                norms = index.load_norms(scheme)
+                if norms is None:
+                    norms = self.calc_doc_norms(index, scheme)
+                    index.save_norms(scheme, norms)
+            self.norms[key] = (norms, min(norms, default=1))
+        return self.norms[key]
+
+    def calc_doc_norms(self, index, scheme):
+        '''cosine norms of a scheme that was not precomputed by the indexer, a single pass over every postings list'''
+        print(f"Computing the {scheme} document norms of {index.path_to_folder}...")
+        tf_weight = self.tf_weight_function(scheme[0])
+        sums = array('d', [0]) * index.manifest["documents_n"]
+        for t in index.lexicon:
+            idf = self.idf_weight(scheme[1], index.N, index.get_df(t))
+            for docno, dictionary in index.get_postings(t).items():
+                sums[docno] += (tf_weight(dictionary["w"]) * idf)**2
+        return array('d', [sqrt(s) or 1 for s in sums])
+
+    def idf_weight(self, letter, N, df):
+        if letter == "t":
+            return self.log(N/df)
+        if letter == "p":
             x = (N-df)/df
-
             if x >= 1:
-                t = self.log(x)
-            else:
-                t = 0.0000000001 # avoid division by zero error
+                return self.log(x)
+            return 0.0000000001 # avoid division by zero error
+        return 1
+
+    def calc_tfidf_weight(self, tf, N, df):
+        '''weight of a query token, with the SMART query scheme (the part after the dot)'''
+        scheme = self.smart.split(".")[1]
+        l = self.tf_weight_function(scheme[0])(tf)
+        t = self.idf_weight(scheme[1], N, df)
 
         w = l*t
         return w
 
-    def calc_normalized_weights(self, N, tokens, index, index_folder):
+    def calc_normalized_weights(self, N, tokens, index):
         '''Calculate normalized token weights'''
         weights = {}
         w_sum = 0
         for t in tokens:
-            df, _ = extract_data_from_index(t, index, index_folder)
+            df = index.get_df(t)
             tf = tokens.count(t)
             w = self.calc_tfidf_weight(tf, N, df)
             weights[t] = w
             w_sum += w**2
 
+        if self.smart.split(".")[1][2] != "c" or w_sum == 0: # no cosine normalization, or every token has idf 0
+            return weights
+
         denominator = sqrt(w_sum)
 
         for k in weights: # after calculating sqrt(w_sum) we can store the normalized weight
@@ -114,51 +370,252 @@ class BM25Ranking(BaseSearcher):
         super().__init__(**kwargs)
         self.k1 = k1
         self.b = b
+        self.norms = {} # (index folder, k1, b) -> (k1*(1-b+b*dl/avdl) of each docno, min value)
         print("init BM25Ranking|", f"{k1=}", f"{b=}")
-        if kwargs:
-            print(f"{self.__class__.__name__} also caught the following additional arguments {kwargs}")
-
-    def search(self, tokenizer, index_folder, top_k, reader):
-        with open("document_N.txt", "r") as f:
-            N = int(f.readline())
-        index = load_from_disk(index_folder, filename="index.pkl")
-        
-        for question in reader.read():
-            print(question)
-            tokens = [t for t in tokenizer.tokenize(question["query_text"]) if t in index]
-            query_weights = self.calc_weights(N, tokens, index, index_folder)
-            ranked_results = ranked_retrieval(index, tokens, query_weights, top_k, index_folder)
-            precision, recall, average_precision = calculate_precision_and_recall(ranked_results, question["documents_pmid"], k = 10)
-            f_measure = calculate_fmeasure(precision, recall)
-            print(f'\nPrecision -> {precision}')
-            print(f'Recall -> {recall}')
-            print(f'Avg-Precision -> {average_precision}')
-            print(f'F-Measure -> {f_measure}\n')
-            display_results(ranked_results)
-            
-
+        if self.unused_kwargs:
+            print(f"{self.__class__.__name__} also caught the following additional arguments {self.unused_kwargs}")
+
+    def calc_query_weights(self, index, tokens):
+        return self.calc_weights(index.N, tokens, index)
+
+    def doc_weighting(self, index, terms):
+        '''bm25 term frequency component, the idf is part of the query weights'''
+        norms, min_norm = self.get_norms(index)
+        k1 = self.k1
+        weigh = lambda docno, posting: (k1+1)*posting["w"] / (norms[docno] + posting["w"])
+        return {t: (weigh, (k1+1)*index.get_max_weight(t) / (min_norm + index.get_max_weight(t))) for t in terms}
+
+    def get_norms(self, index):
+        '''document length normalization of each document, computed once per index and parameter set'''
+        key = (index.path_to_folder, self.k1, self.b)
+        if key not in self.norms:
+            k1, b, avdl = self.k1, self.b, index.avdl
+            norms = array('d', [k1*(1-b+b*dl/avdl) for dl in index.get_lengths()])
+            self.norms[key] = (norms, min(norms, default=0))
+        return self.norms[key]
     
-    def calc_weights(self, N, tokens, index, index_folder):
+    def calc_weights(self, N, tokens, index):
         weights = {}
 
         for t in tokens:
             tf = tokens.count(t)
-            df, _ = extract_data_from_index(t, index, index_folder)
+            df = index.get_df(t)
             w = log10(N/df) * (((self.k1+1)*tf) / (self.k1*tf))
             weights[t] = w
 
         return weights
 
+class BM25FRanking(BaseSearcher):
+    """
+    BM25F over the title and abstract fields of an index built with
+    --indexer.fields and the tf ranking schema. The tf of each field
+    is weighted and normalized by the length of the field, and their
+    sum is saturated once with k1. The title tokens come first in each
+    document, so the title tf of a posting is the number of its
+    positions before the title length: both fields are scored in the
+    same traversal of the postings.
+
+    """
+    def __init__(self, k1, weights, b, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.k1 = k1
+        self.weights = weights # title, abstract
+        self.b = b
+        self.norms = {} # (index folder, weights, b) -> (title lengths, weight/normalization of a title and of an abstract tf of each docno, max factor)
+        print("init BM25FRanking|", f"{k1=}", f"{weights=}", f"{b=}")
+        if self.unused_kwargs:
+            print(f"{self.__class__.__name__} also caught the following additional arguments {self.unused_kwargs}")
+
+    def search(self, tokenizer, index, top_k, reader):
+        if index.get_ranking_schema() != "tf" or not index.has_fields():
+            print("ERROR: BM25F needs an index built with --indexer.fields and --indexer.ranking_schema tf")
+            return
+        super().search(tokenizer, index, top_k, reader)
+
+    def calc_query_weights(self, index, tokens):
+        '''bm25 idf of each token, repeated tokens add up'''
+        weights = {}
+        for t in tokens:
+            weights[t] = weights.get(t, 0) + log10(index.N/index.get_df(t))
+        return weights
+
+    def get_norms(self, index):
+        '''per document factors of the title and abstract tfs, computed once per index and parameter set'''
+        key = (index.path_to_folder, tuple(self.weights), tuple(self.b))
+        if key not in self.norms:
+            factors = []
+            for lengths, avg, w, b in zip(index.get_field_lengths(), index.manifest["fields"]["avg_lengths"], self.weights, self.b):
+                norm = lambda l: 1 - b + b * l/avg if avg else 1
+                factors.append(array('d', [w / norm(l) if norm(l) else 0 for l in lengths]))
+            self.norms[key] = (index.get_field_lengths()[0], factors[0], factors[1], max([max(f, default=0) for f in factors]))
+        return self.norms[key]
+
+    def doc_weighting(self, index, terms):
+        '''saturated sum of the weighted and normalized title and abstract tfs'''
+        title_lens, title_factors, abstract_factors, max_factor = self.get_norms(index)
+        k1 = self.k1
+        def weigh(docno, posting):
+            title_tf = bisect_left(posting["positions"], title_lens[docno])
+            tf = title_tf * title_factors[docno] + (posting["w"] - title_tf) * abstract_factors[docno]
+            return (k1+1)*tf / (k1 + tf)
+        bound = lambda max_tf: (k1+1)*max_tf*max_factor / (k1 + max_tf*max_factor)
+        return {t: (weigh, bound(index.get_max_weight(t))) for t in terms}
+
+class SweepRanking(BaseSearcher):
+    """
+    Ranking parameter sweep. Every question is scored with all the
+    settings of a grid of bm25 k1/b values and SMART notations: the
+    postings of each query token are decoded once and the scores of
+    all the settings are computed together with NumPy. Requires an
+    index with raw term frequencies (--indexer.ranking_schema tf).
+    The scoring is exhaustive (no accumulator limit nor token skipping).
+
+    """
+    def __init__(self, k1, b, smart, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.settings = [BM25Ranking(k1=k, b=b_, prefetch_threads=0) for k in k1 for b_ in b]
+        self.settings += [TFIDFRanking(smart=s, prefetch_threads=0) for s in smart]
+        print("init SweepRanking|", f"{k1=}", f"{b=}", f"{smart=}", f"settings={len(self.settings)}")
+        if self.unused_kwargs:
+            print(f"{self.__class__.__name__} also caught the following additional arguments {self.unused_kwargs}")
+
+    def search(self, tokenizer, index, top_k, reader):
+        import numpy as np
+        if not hasattr(index, "stores_tf") or not index.stores_tf():
+            print("ERROR: the sweep needs an index built with --indexer.ranking_schema tf")
+            return
+
+        timer = Timer()
+        timer.start()
+        lengths = np.frombuffer(index.get_lengths(), dtype=np.uint32).astype(np.float64)
+        k1 = np.array([s.k1 for s in self.settings if isinstance(s, BM25Ranking)])[:, None]
+        b = np.array([s.b for s in self.settings if isinstance(s, BM25Ranking)])[:, None]
+        tfidf_settings = [s for s in self.settings if isinstance(s, TFIDFRanking)]
+        norms = [np.frombuffer(s.get_norms(index, s.smart.split(".")[0])[0], dtype=np.float64) for s in tfidf_settings]
+        deleted = np.array(sorted(index.get_deleted()), dtype=np.int64)
+
+        metrics = np.zeros((len(self.settings), 4)) # precision, recall, average precision, f-measure
+        questions_n = 0
+        for question in reader.read():
+            tokens, _, query_index = self.tokenize_query(tokenizer, index, question["query_text"])
+            if not tokens or not question.get("documents_pmid"):
+                continue
+            questions_n += 1
+
+            terms = sorted(set(tokens))
+            postings = [query_index.get_postings(t) for t in terms] # decoded once for every setting
+            docnos = [np.fromiter(p.keys(), dtype=np.int64, count=len(p)) for p in postings]
+            tfs = [np.fromiter([d["w"] for d in p.values()], dtype=np.float64, count=len(p)) for p in postings]
+            if deleted.size:
+                kept = [~np.isin(d, deleted) for d in docnos]
+                docnos = [d[k] for d, k in zip(docnos, kept)]
+                tfs = [tf[k] for tf, k in zip(tfs, kept)]
+            candidates, positions = np.unique(np.concatenate(docnos), return_inverse=True)
+
+            scores = np.zeros((len(self.settings), len(candidates)))
+            query_weights = [s.calc_query_weights(query_index, tokens) for s in self.settings]
+            ptr = 0
+            for n, t in enumerate(terms):
+                columns = positions[ptr:ptr+len(docnos[n])]
+                ptr += len(docnos[n])
+                qw = np.array([w[t] for w in query_weights])[:, None]
+
+                # bm25 settings: one row per (k1, b)
+                doc_norms = k1 * (1 - b + b * lengths[docnos[n]] / index.avdl)
+                rows = (k1 + 1) * tfs[n] / (doc_norms + tfs[n])
+                # tf-idf settings
+                for setting, setting_norms in zip(tfidf_settings, norms):
+                    scheme = setting.smart.split(".")[0]
+                    tf_weight = np.ones_like(tfs[n]) if scheme[0] == "b" else 1 + np.log10(tfs[n]) if scheme[0] == "l" else tfs[n]
+                    idf = setting.idf_weight(scheme[1], index.N, query_index.get_df(t))
+                    rows = np.vstack([rows, tf_weight * idf / setting_norms[docnos[n]]])
+
+                scores[:, columns] += qw * rows
+
+            relevant = question["documents_pmid"]
+            tops = np.argsort(-scores, axis=1, kind="stable")[:, :top_k] if len(candidates) <= top_k else \
+                   np.argpartition(-scores, top_k-1, axis=1)[:, :top_k] # top_k of every setting at once, sorted below
+            for s in range(len(self.settings)):
+                top = sorted(tops[s], key=lambda c: -scores[s, c])
+                ranked_results = [(index.get_pmid(int(candidates[c])), scores[s, c]) for c in top]
+                precision, recall, average_precision = calculate_precision_and_recall(ranked_results, relevant, k=min(10, len(ranked_results)))
+                metrics[s] += [precision, recall, average_precision, calculate_fmeasure(precision, recall)]
+
+        print(f"\n{questions_n} questions, {len(self.settings)} settings in {timer.stop():.2f}s\n")
+        print(f"{'setting':<24}{'P@10':>10}{'R@10':>10}{'AP@10':>10}{'F@10':>10}")
+        for setting, row in sorted(zip(self.settings, metrics / max(questions_n, 1)), key=lambda item: -item[1][2]):
+            name = f"bm25 k1={setting.k1} b={setting.b}" if isinstance(setting, BM25Ranking) else f"tfidf {setting.smart}"
+            print(f"{name:<24}" + "".join([f"{m:>10.4f}" for m in row]))
+
 # ---------------------------------------------------------------------------- #
 #                                   Functions                                  #
 # ---------------------------------------------------------------------------- #
 
-def load_from_disk(index_folder, filename):
-    '''loads index/postings files from disk'''
-    with open(f'{index_folder}/{filename}', 'rb') as f:
-        index = pickle.load(f)
-    
-    return index
+class ShardCoordinator:
+    """
+    Scatter-gather search over the shards of a ShardedIndex. Each shard
+    is searched by a worker process (standing in for a search node)
+    that keeps the shard open, the coordinator sends every query to all
+    the workers and merges their top-k lists.
+
+    """
+    def __init__(self, index, searcher_kwargs):
+        self.connections = []
+        self.workers = []
+        for folder in index.get_shard_folders():
+            connection, worker_connection = Pipe()
+            worker = Process(target=shard_worker, args=(worker_connection, folder, index.global_stats, searcher_kwargs), daemon=True)
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+        self.lock = Lock() # one query at a time goes through the pipes
+        print("init ShardCoordinator|", f"shards={len(self.workers)}")
+
+    def rank(self, tokens, query_weights, top_k, deadline=None):
+        '''
+        returns the top_k ((shard, docno), doc_data) of the query over all the shards. The workers get the
+        time left of the deadline, which is marked approximate if any shard ran out of it
+        '''
+        with self.lock:
+            budget_ms = deadline.remaining_ms() if deadline else None
+            for connection in self.connections: # scatter
+                connection.send((tokens, query_weights, top_k, budget_ms))
+
+            results = []
+            for shard, connection in enumerate(self.connections): # gather
+                shard_results, approximate = connection.recv()
+                results.extend([((shard, docno), doc_data) for docno, doc_data in shard_results])
+                if approximate:
+                    deadline.approximate = True
+        return heapq.nlargest(top_k, results, key=lambda item: item[1]["score"])
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def shard_worker(connection, shard_folder, global_stats, searcher_kwargs):
+    '''serves the queries of the coordinator over one shard until it receives None'''
+    from index import InvertedIndex
+    index = InvertedIndex.load_from_disk(shard_folder)
+    index.set_global_stats(global_stats)
+    ranker = dynamically_init_searcher(**searcher_kwargs)
+    if ranker.tiered and index.has_champions():
+        index.load_champions()
+    else:
+        ranker.tiered = False
+
+    while True:
+        query = connection.recv()
+        if query is None:
+            return
+        tokens, query_weights, top_k, budget_ms = query
+        tokens = [t for t in tokens if t in index] # the token may not occur in this shard
+        deadline = Deadline(budget_ms) if budget_ms is not None else None
+        results = ranker.rank(index, tokens, top_k, query_weights, deadline=deadline)
+        connection.send((results, bool(deadline and deadline.approximate)))
 
 
 def clear():
@@ -166,51 +623,283 @@ def clear():
     os.system('cls' if os.name == 'nt' else 'clear')
 
 
-def ranked_retrieval(index, search_tokens, query_weights, top_k, index_folder):
+def split_wildcards(text):
+    '''splits a query text into the text without the wildcard patterns and the patterns (words with a *)'''
+    patterns = re.findall(r"[\w*]*\*[\w*]*", text)
+    patterns = [p for p in patterns if p.strip("*")] # a lone * would match every token
+    return re.sub(r"[\w*]*\*[\w*]*", " ", text), patterns
+
+
+def ranked_retrieval(index, search_tokens, query_weights, top_k, max_accumulators=None, accumulator_strategy="continue", executor=None, get_postings=None, weighting=None, trace=None, deadline=None, prefetch_window=4):
+    '''
+    Term-at-a-time retrieval. The terms are processed by increasing df, so the rare (high weight) terms
+    create the accumulators and the frequent ones mostly update them. At most max_accumulators documents
+    are scored: after the limit is reached the query stops (quit) or only the existing accumulators are
+    updated (continue). Once no other document can reach the top-k, the remaining terms only update the
+    scores of the top-k documents, so the scores and their order are the same as with exhaustive scoring.
+    If an executor is given, the postings of the next prefetch_window terms are read in the background while
+    a term is scored, so at most prefetch_window + 1 postings lists of the query are in memory. get_postings reads the postings of a term (default: the full postings).
+    If the index stores raw tfs, weighting {term: (weight(docno, posting), max weight)} gives the document weights.
+    The deleted documents of the index are skipped.
+    A QueryTrace records the time of each stage and the work done, if given. If a Deadline expires the
+    scoring stops (between terms and every few thousand postings) and the best top-k found so far is returned.
+    '''
     documents = {}
-    prev_fp = None
-
-    for t in search_tokens:
-        _, fp = extract_data_from_index(t, index, index_folder)
-
-        if prev_fp != fp:
-            postings = load_from_disk(index_folder, filename=f"postings{fp}.pkl")
-            prev_fp = fp
+    with QueryTrace.stage(trace, "lexicon"):
+        terms = sorted(set(search_tokens), key=index.get_df) # query weights already account for repeated tokens
+        max_weight = (lambda t: weighting[t][1]) if weighting else index.get_max_weight
+        remaining_max_score = sum([query_weights[t] * max_weight(t) for t in terms])
+        deleted = index.get_deleted() # never get an accumulator
+
+    get_postings = get_postings or index.get_postings
+    if trace:
+        get_postings = trace.traced_postings(index, get_postings)
+    postings_stream = iter_postings(terms, get_postings, executor, prefetch_window)
+    scored_n = 0
+    top_docs = None # docnos of the top-k, once no other document can reach it
+    for t, postings in postings_stream:
+        if top_docs is None and len(documents) > top_k and remaining_max_score + 1e-9 < top_k_margin(documents, top_k): # float rounding could hide a tie
+            top_docs = heapq.nlargest(top_k, documents, key=lambda docno: documents[docno]["score"])
+        if deadline and scored_n and deadline.expired(): # the rarest term is always scored, so there are some results
+            deadline.cut()
+            break
 
-        for pmid, dictionary in postings[t].items():
-            wt = dictionary["w"]
+        if trace:
+            scoring_start = timer()
+            trace.count("postings_touched", len(postings) if top_docs is None else len(top_docs))
+        scored_n += 1
+        remaining_max_score -= query_weights[t] * max_weight(t)
+        weigh = weighting[t][0] if weighting else None
+        quit = False
+        if top_docs is not None: # the top-k documents are looked up instead of going through the postings
+            postings = {docno: postings[docno] for docno in top_docs if docno in postings}
+        for docno, dictionary in (deadline.bounded(postings.items()) if deadline and scored_n > 1 else postings.items()): # the rarest term is scored in full
+            wt = dictionary["w"] if weigh is None else weigh(docno, dictionary)
             score = query_weights[t] * wt
-            if pmid in documents:
-                documents[pmid]["score"] += score
-                documents[pmid]["num_search_terms"] += 1
-                documents[pmid]["token_positions"].append(postings[t][pmid]["positions"])
-            else:
-                documents[pmid] = {
+            if docno in documents:
+                documents[docno]["score"] += score
+                documents[docno]["num_search_terms"] += 1
+                documents[docno]["token_positions"].append(dictionary["positions"])
+            elif docno in deleted:
+                continue
+            elif max_accumulators is None or len(documents) < max_accumulators:
+                documents[docno] = {
                     "score": score,
                     "num_search_terms": 1,
-                    "token_positions": [postings[t][pmid]["positions"]]
+                    "token_positions": [dictionary["positions"]]
                     }
+            elif accumulator_strategy == "quit":
+                quit = True
+                break
+
+        if trace:
+            trace.add_time("scoring", timer() - scoring_start)
+        if quit:
+            break
+    postings_stream.close() # cancels the reads that were not needed
+    if trace:
+        trace.count("terms", len(terms))
+        trace.count("terms_skipped", len(terms) - scored_n)
+        trace.record["accumulators"] = max(trace.record["accumulators"], len(documents))
 
 
     # -------- boost the scores of documents using the minimum window size ------- #
-    num_distinct_terms = len(set(search_tokens))
-    for pmid, doc_data in documents.items():
-        if num_distinct_terms == len(doc_data["token_positions"]):
-            min_window_size = find_min_window_size(doc_data["token_positions"])
-            boost = boost_factor(min_window_size, num_distinct_terms)
-        else:
-            boost = 1
+    with QueryTrace.stage(trace, "proximity"):
+        num_distinct_terms = len(set(search_tokens))
+        for docno, doc_data in ({} if deadline and deadline.approximate else documents).items():
+            if num_distinct_terms == len(doc_data["token_positions"]):
+                min_window_size = find_min_window_size(doc_data["token_positions"])
+                boost = boost_factor(min_window_size, num_distinct_terms)
+            else:
+                boost = 1
 
-    sorted_top_k_scores = sorted(documents.items(), key=lambda item: item[1]["score"], reverse=True)[:top_k]
+    with QueryTrace.stage(trace, "top_k"):
+        sorted_top_k_scores = sorted(documents.items(), key=lambda item: item[1]["score"], reverse=True)[:top_k]
     return sorted_top_k_scores
 
 
-def display_results(results):
+class Deadline:
+    """
+    Time budget of a query (--searcher.time_budget_ms). The retrieval
+    checks it between terms and every few thousand postings, and stops
+    once it has expired; the results are then marked approximate.
+
+    """
+    def __init__(self, budget_ms):
+        self.end = timer() + budget_ms / 1e3
+        self.approximate = False # set when the budget cut the scoring short
+
+    def remaining_ms(self):
+        return max(0, (self.end - timer()) * 1e3)
+
+    def expired(self):
+        return timer() >= self.end
+
+    def cut(self):
+        '''the work left was skipped because the budget ran out'''
+        self.approximate = True
+
+    def bounded(self, items, every=4096):
+        '''yields the items until the deadline expires, the time is only checked every few items'''
+        for n, item in enumerate(items):
+            if n % every == 0 and n and self.expired():
+                self.cut()
+                return
+            yield item
+
+
+class QueryTrace:
+    """
+    Instrumentation of a single query, enabled with --searcher.trace.
+    The record holds the time of each stage (tokenize, lexicon lookups,
+    postings I/O, decode, scoring, proximity, top-k selection), the
+    postings bytes read, the postings lists read and scored, the
+    postings touched, the largest accumulators table and the cache
+    hits of the index. The stages run by the prefetch threads (io,
+    decode) add up the time of every thread, so they can exceed the
+    latency of the query.
+
+    """
+    def __init__(self, query_id, index):
+        self.index = index
+        self.lock = Lock() # the prefetch threads add their io and decode times
+        self.cache_stats = dict(getattr(index, "cache_stats", {})) # index cache counters before the query
+        self.record = {"query_id": query_id, "latency_ms": 0, "stages_ms": Counter(), "bytes_read": 0, "postings_lists_read": 0,
+                       "postings_touched": 0, "terms": 0, "terms_skipped": 0, "accumulators": 0, "results": 0, "cache": {}}
+        self.omitted = set() # fields that the query could not measure, left out of the record
+        self.start = timer()
+
+    @staticmethod
+    @contextmanager
+    def stage(trace, name):
+        '''times a block as stage name of trace, does nothing if trace is None'''
+        if trace is None:
+            yield
+            return
+        start = timer()
+        try:
+            yield
+        finally:
+            trace.add_time(name, timer() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.record["stages_ms"][name] += seconds * 1e3
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.record[name] += n
+
+    def omit(self, name):
+        '''leaves a field that this query can not measure out of the record'''
+        self.omitted.add(name)
+
+    def traced_postings(self, index, get_postings):
+        '''wraps a postings getter, timing the read and the decode of the encoded postings separately when they can be told apart'''
+        if get_postings == index.get_postings:
+            read_postings = getattr(index, "read_postings", None)
+        elif get_postings == getattr(index, "get_champion_postings", None):
+            read_postings = getattr(index, "read_champion_postings", None)
+        else:
+            read_postings = None
+        if read_postings is None: # read and decoded together, the bytes are unknown
+            self.omit("bytes_read")
+            def traced(t):
+                with QueryTrace.stage(self, "postings_io"):
+                    postings = get_postings(t)
+                self.count("postings_lists_read")
+                return postings
+            return traced
+
+        def traced(t):
+            if t in index.virtual_terms: # wildcard, its postings were merged when the query was parsed
+                return get_postings(t)
+            with QueryTrace.stage(self, "postings_io"):
+                data = read_postings(t)
+            with QueryTrace.stage(self, "decode"):
+                postings = index.codec.decode_postings(data)
+            self.count("bytes_read", len(data))
+            self.count("postings_lists_read")
+            return postings
+        return traced
+
+    def stop(self, results_n):
+        '''ends the query, returns its latency in ms'''
+        self.record["latency_ms"] = (timer() - self.start) * 1e3
+        self.record["results"] = results_n
+        return self.record["latency_ms"]
+
+    def finish(self):
+        '''the record of the query, with the cache hits of the index since the query started'''
+        self.record["stages_ms"] = {name: round(ms, 3) for name, ms in self.record["stages_ms"].items()}
+        for name in self.omitted:
+            self.record.pop(name, None)
+        cache_stats = getattr(self.index, "cache_stats", {})
+        self.record["cache"] = {name: n - self.cache_stats.get(name, 0) for name, n in cache_stats.items()}
+        return self.record
+
+
+def latency_histogram(latencies, buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)):
+    '''text histogram of query latencies (ms) over logarithmic buckets, with the p50, p95 and p99 latencies'''
+    if not latencies:
+        return "no queries"
+    counts = Counter([bisect_left(buckets, l) for l in latencies])
+    lines = []
+    for n in range(min(counts), max(counts) + 1): # from the first to the last non-empty bucket
+        low = buckets[n-1] if n else 0
+        label = f"{low}-{buckets[n]} ms" if n < len(buckets) else f">{low} ms"
+        lines.append(f"{label:>14} | {'#' * round(40 * counts[n] / len(latencies)):<40} {counts[n]}")
+    ordered = sorted(latencies)
+    percentile = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+    lines.append(f"p50 {percentile(0.5):.2f} ms, p95 {percentile(0.95):.2f} ms, p99 {percentile(0.99):.2f} ms, max {ordered[-1]:.2f} ms")
+    return "\n".join(lines)
+
+
+def iter_postings(terms, get_postings, executor=None, window=4):
+    '''
+    yields (term, postings) in the given order. If an executor is given, the reads of the next window terms run
+    ahead of the scoring: a read is submitted each time a postings list is consumed
+    '''
+    if executor is None or window < 1:
+        for t in terms:
+            yield t, get_postings(t)
+        return
+
+    terms = iter(terms)
+    futures = deque([(t, executor.submit(get_postings, t)) for t in islice(terms, window)])
+    try:
+        while futures: # in df order, which the accumulator limit and the top-k cut-off rely on
+            t, future = futures.popleft()
+            postings = future.result()
+            for next_t in islice(terms, 1):
+                futures.append((next_t, executor.submit(get_postings, next_t)))
+            yield t, postings
+    finally:
+        for _, future in futures:
+            future.cancel()
+
+
+def top_k_margin(documents, top_k):
+    '''difference between the k-th and the (k+1)-th best scores'''
+    scores = heapq.nlargest(top_k+1, [doc_data["score"] for doc_data in documents.values()])
+    return scores[top_k-1] - scores[top_k]
+
+
+def display_results(results, snippet=None):
+    '''
+    shows the results, 10 per page. snippet(n) returns the title and the highlighted text of the n-th result.
+    Without a terminal (scripts, batch jobs) only the first page is shown and nothing is asked.
+    '''
     results_per_page = 10
+    interactive = sys.stdin.isatty()
     for i in range(0,len(results),results_per_page):
-        for j in range(results_per_page):
+        for j in range(min(results_per_page, len(results)-i)):
             print(f"{j+1:>2}. PMID {results[i+j][0]} (score: {results[i+j][1]})")
+            if snippet:
+                print(snippet(i+j))
 
+        if not interactive:
+            break
         cmd = input(f"\n\nPress [ENTER] to Show more results\nWrite 'n' for New query\n\n-> ")
         clear()
 
@@ -218,6 +907,26 @@ def display_results(results):
             break
 
 
+def make_snippet(document, tokenizer, query_tokens, window=30):
+    '''title and the window of the abstract with most query tokens, with those tokens highlighted'''
+    highlight = "\033[1m{}\033[0m" if sys.stdout.isatty() else "*{}*"
+    words = document["abstract"].split()
+    matches = [any([t in query_tokens for t in tokenizer.tokenize(w)]) for w in words]
+
+    best_start = best_count = count = 0
+    for n in range(len(words)): # sliding window over the number of matches
+        count += matches[n]
+        if n >= window:
+            count -= matches[n-window]
+        if count > best_count:
+            best_count, best_start = count, max(0, n-window+1)
+
+    snippet = [highlight.format(w) if m else w for w, m in zip(words[best_start:best_start+window], matches[best_start:best_start+window])]
+    prefix = "... " if best_start > 0 else ""
+    suffix = " ..." if best_start+window < len(words) else ""
+    return f"    {document['title']}\n    {prefix}{' '.join(snippet)}{suffix}\n"
+
+
 def exponential_decay(x, A, lambd):
     return A * math.exp(-lambd * x)
 
@@ -230,14 +939,24 @@ def boost_factor(min_window_size, num_distinct_terms, max_boost=2.0, lambd=0.007
 
 
 def find_min_window_size(token_positions):
+    '''
+    smallest max - min over one occurrence of each token. The positions of every token are swept in order,
+    the window ends at the latest of the current occurrences and starts at the earliest, which is moved next
+    '''
+    if not all(token_positions):
+        return float("inf")
+    heap = [(positions[0], n, 0) for n, positions in enumerate(token_positions)]
+    heapq.heapify(heap)
+    window_end = max([position for position, _, _ in heap])
     min_window_size = float("inf")
-
-    # Iterate over all combinations of occurrences of the tokens
-    for indices in itertools.product(*token_positions):
-        window_size = max(indices) - min(indices)
-        min_window_size = min(min_window_size, window_size)
-    
-    return min_window_size
+    while True:
+        window_start, n, i = heapq.heappop(heap)
+        min_window_size = min(min_window_size, window_end - window_start)
+        if i + 1 == len(token_positions[n]): # the window can not start later without losing this token
+            return min_window_size
+        position = token_positions[n][i + 1]
+        window_end = max(window_end, position)
+        heapq.heappush(heap, (position, n, i + 1))
 
 def calculate_precision_and_recall(ranked_results, relevant_results, k):
     # Precision and Recal vars
@@ -263,11 +982,13 @@ def calculate_precision_and_recall(ranked_results, relevant_results, k):
     if tp != len(relevant_results):
         fn = len(relevant_results) - tp
     
-    precision = tp/(tp + fp)
-    recall = tp/(tp + fn)
-    average_precision = average_sum/len(relevant_results)
+    precision = tp/(tp + fp) if tp + fp else 0 # no results, the time budget can run out before any term is scored
+    recall = tp/(tp + fn) if tp + fn else 0 # a question without relevant documents
+    average_precision = average_sum/len(relevant_results) if relevant_results else 0
     
     return precision, recall, average_precision
 
 def calculate_fmeasure(precision, recall):
+    if recall + precision == 0:
+        return 0
     return (2*recall*precision)/(recall + precision)
\ No newline at end of file
@@ -0,0 +1,68 @@
+"""
+Startup benchmark
+
+Measures the time-to-first-result of the searcher CLI: a new
+process is started for a single question, as in a scripted
+one-shot query, and the wall time until it exits is measured.
+The import time of the searcher modules is reported separately.
+The exit code is 1 if the median time is over --budget seconds,
+so the benchmark can be used as a check.
+
+python3 startup_benchmark.py pubmedSPIMIindex questions.jsonl --budget 1.0
+
+"""
+import argparse, os, sys, json, subprocess, tempfile
+from statistics import median
+from utils import Timer
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(REPO, "main.py")
+
+
+def time_command(command, runs):
+    '''wall time of each run of command, with no terminal attached'''
+    timer = Timer()
+    times = []
+    for _ in range(runs):
+        timer.start()
+        subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True, env=dict(os.environ, PYTHONPATH=REPO))
+        times.append(timer.stop())
+    return times
+
+
+def main(index_folder, path_to_questions, runs, budget):
+    with open(f"{index_folder}/manifest.json") as f:
+        ranking = json.load(f)["ranking"]["schema"]
+
+    with open(path_to_questions) as f:
+        question = f.readline()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        one_question = f"{tmp}/question.jsonl"
+        with open(one_question, "w") as f:
+            f.write(question)
+
+        imports = time_command([sys.executable, "-c", "import core, index, searcher"], runs)
+        first_result = time_command([sys.executable, MAIN, "searcher", index_folder, one_question, os.devnull,
+                                     "--top_k", "10", f"ranking.{ranking}"], runs)
+
+    print(f"{'':<20}{'min (s)':>10}{'median (s)':>12}")
+    print(f"{'imports':<20}{min(imports):>10.3f}{median(imports):>12.3f}")
+    print(f"{'time-to-first-result':<20}{min(first_result):>10.3f}{median(first_result):>12.3f}")
+
+    if median(first_result) > budget:
+        print(f"FAIL: the median time-to-first-result is over the {budget}s budget")
+        return 1
+    print(f"OK: within the {budget}s budget")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the startup time of the searcher")
+    parser.add_argument("index_folder", type=str, help="Folder of the index to be searched.")
+    parser.add_argument("path_to_questions", type=str, help="Questions file, only its first question is used.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs. (default=5).")
+    parser.add_argument("--budget", type=float, default=1.0, help="Maximum median time-to-first-result in seconds. (default=1.0).")
+    args = parser.parse_args()
+
+    sys.exit(main(args.index_folder, args.path_to_questions, args.runs, args.budget))
@@ -0,0 +1,119 @@
+"""
+Synthetic collection generator
+
+Writes a PubMed-like collection (pubmed_<name>.jsonl.gz) and a
+matching questions file, for measuring the indexer and the searcher
+without the real PubMed dumps. The words of the titles and abstracts
+follow a Zipf distribution over a pseudo-word vocabulary (the most
+frequent ranks are English stopwords), and the title and abstract
+lengths follow log-normal distributions around the PubMed medians.
+
+Each question is a few mid-frequency topic words. Some documents are
+about a question: its words are added to their title and abstract,
+and these documents are the relevant pmids of the question. Every
+question has at least one, the questions that can not have one
+(more questions than documents) are not written. The
+output only depends on the arguments, the same seed gives the same
+bytes.
+
+python3 synthetic_collection.py collections --documents 100000 --questions 100
+
+"""
+import argparse, os, json, gzip, random
+from itertools import accumulate
+
+STOPWORDS = ["the", "of", "and", "in", "to", "a", "with", "for", "was", "were", "is", "by", "on", "that", "as", "at", "from", "this", "are", "be"]
+SYLLABLES = ["im", "mu", "no", "ther", "a", "py", "cy", "to", "ki", "ne", "gen", "o", "mic", "ro", "bi", "al", "ca", "di", "vas", "cu",
+             "lar", "neu", "ral", "pe", "tho", "lo", "gy", "he", "pa", "tic", "re", "nal", "pul", "mo", "na", "ry", "on", "co", "sis", "tri"]
+TITLE_MEDIAN, TITLE_SIGMA = 12, 0.35 # words
+ABSTRACT_MEDIAN, ABSTRACT_SIGMA = 200, 0.45
+NO_ABSTRACT_RATE = 0.1 # PubMed records without an abstract
+
+
+def make_vocabulary(rng, size):
+    '''size distinct pseudo-words of 2 to 4 syllables, in frequency rank order after the stopwords'''
+    words = list(STOPWORDS)
+    seen = set(words)
+    while len(words) < size:
+        word = "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def lognormal_length(rng, median, sigma):
+    return max(1, round(rng.lognormvariate(0, sigma) * median))
+
+
+def sentence_text(words, sentence_length=20):
+    '''words as capitalized sentences'''
+    sentences = [words[i:i+sentence_length] for i in range(0, len(words), sentence_length)]
+    return " ".join([" ".join([s[0].capitalize()] + s[1:]) + "." for s in sentences])
+
+
+def make_questions(rng, vocabulary, questions_n, topic_words):
+    '''topic words of each question, drawn from the mid-frequency ranks'''
+    low, high = min(200, len(vocabulary) // 4), min(2000, len(vocabulary))
+    return [rng.sample(vocabulary[low:high], topic_words) for _ in range(questions_n)]
+
+
+def generate(output_folder, name, documents_n, questions_n, vocabulary_size, zipf, topic_rate, topic_words, seed):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng, vocabulary_size)
+    cum_weights = list(accumulate([1 / (rank + 1)**zipf for rank in range(vocabulary_size)]))
+    topics = make_questions(rng, vocabulary, questions_n, topic_words)
+    relevant = [[] for _ in topics]
+    seeded = dict(zip(rng.sample(range(documents_n), min(questions_n, documents_n)), range(questions_n))) # docno -> question, one per question
+
+    os.makedirs(output_folder, exist_ok=True)
+    collection_path = f"{output_folder}/pubmed_{name}.jsonl.gz"
+    with open(collection_path, "wb") as raw, gzip.GzipFile(filename="", fileobj=raw, mode="wb", mtime=0) as f:
+        for n in range(documents_n):
+            pmid = str(10000000 + n)
+            title = rng.choices(vocabulary, cum_weights=cum_weights, k=lognormal_length(rng, TITLE_MEDIAN, TITLE_SIGMA))
+            abstract = []
+            if rng.random() >= NO_ABSTRACT_RATE:
+                abstract = rng.choices(vocabulary, cum_weights=cum_weights, k=lognormal_length(rng, ABSTRACT_MEDIAN, ABSTRACT_SIGMA))
+
+            question = seeded.get(n)
+            if question is None and topics and rng.random() < topic_rate: # the document is about a question
+                question = rng.randrange(len(topics))
+            if question is not None:
+                relevant[question].append(pmid)
+                for word in rng.sample(topics[question], rng.randint(1, topic_words)):
+                    title.insert(rng.randrange(len(title) + 1), word)
+                for word in topics[question] * (rng.randint(1, 3) if abstract else 0):
+                    abstract.insert(rng.randrange(len(abstract) + 1), word)
+
+            doc = {"pmid": pmid, "title": sentence_text(title), "abstract": sentence_text(abstract)}
+            f.write((json.dumps(doc) + "\n").encode("utf-8"))
+
+    questions_path = f"{output_folder}/questions_{name}.jsonl"
+    questions = [(str(n), words, pmids) for n, (words, pmids) in enumerate(zip(topics, relevant)) if pmids]
+    with open(questions_path, "w") as f:
+        for query_id, words, pmids in questions:
+            f.write(json.dumps({"query_id": query_id, "query_text": " ".join(words), "documents_pmid": pmids}) + "\n")
+
+    print(f"Wrote {documents_n} documents to {collection_path} ({os.path.getsize(collection_path)*1e-6:.1f} MB)")
+    print(f"Wrote {len(questions)} questions to {questions_path} ({sum([len(p) for p in relevant])} relevant documents)")
+    return collection_path, questions_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic PubMed-like collection and its questions")
+    parser.add_argument("output_folder", type=str, help="Folder where the collection and the questions are written.")
+    parser.add_argument("--documents", type=int, default=10000, help="Number of documents. (default=10000).")
+    parser.add_argument("--questions", type=int, default=50, help="Number of questions. (default=50).")
+    parser.add_argument("--name", type=str, default=None, help="Name of the files, pubmed_<name>.jsonl.gz and questions_<name>.jsonl. (default=synthetic_<documents>).")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="Number of distinct words. (default=50000).")
+    parser.add_argument("--zipf", type=float, default=1.0, help="Exponent of the Zipf distribution of the words. (default=1.0).")
+    parser.add_argument("--topic_rate", type=float, default=0.02, help="Fraction of the documents that are relevant to a question. (default=0.02).")
+    parser.add_argument("--topic_words", type=int, default=3, help="Number of words of each question. (default=3).")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed, the output only depends on it and on the other arguments. (default=42).")
+    args = parser.parse_args()
+
+    if args.vocabulary <= len(STOPWORDS) + args.topic_words:
+        parser.error(f"--vocabulary must be over {len(STOPWORDS) + args.topic_words}")
+    generate(args.output_folder, args.name or f"synthetic_{args.documents}", args.documents, args.questions,
+             args.vocabulary, args.zipf, args.topic_rate, args.topic_words, args.seed)
@@ -10,8 +10,6 @@ tokens.
 
 """
 
-from nltk.stem import PorterStemmer
-from nltk.stem.snowball import SnowballStemmer
 import re
 from utils import dynamically_init_class
 
@@ -47,6 +45,14 @@ class Tokenizer:
     """
     def __init__(self, **kwargs):
         super().__init__()
+
+    def get_kwargs(self):
+        """
+        Arguments that allow to rebuild this tokenizer
+        through `dynamically_init_tokenizer`, these are
+        stored in the index manifest.
+        """
+        return {"class": self.__class__.__name__}
     
     def tokenize(self, text):
         """
@@ -74,24 +80,30 @@ class PubMedTokenizer(Tokenizer):
     tokenization of articles from the PubMed.
 
     """
-    def __init__(self, minL, stopwords_path, stemmer, case_folding, allow_numbers, *args, **kwargs):
+    def __init__(self, minL, stopwords_path, stemmer, case_folding, allow_numbers, *args, stopwords=None, **kwargs):
         super().__init__(**kwargs)
         self.minL = minL
         self.stopwords_path = stopwords_path
         self.case_folding = case_folding
         self.allow_numbers = allow_numbers
+        self.stemmer_name = stemmer
         self.regex_pattern = re.compile(r'\W')
 
+        # nltk takes a good part of the startup time, so it is only imported if a stemmer is used
         if stemmer == None:
             self.stemmer = None
         elif ("snow") in stemmer.lower():
+            from nltk.stem.snowball import SnowballStemmer
             self.stemmer = SnowballStemmer(language='english')
         else:
+            from nltk.stem import PorterStemmer
             self.stemmer = PorterStemmer()
 
 
-        with open(self.stopwords_path, 'r') as f:
-            stop_words = f.readlines()
+        stop_words = stopwords or [] # the list stored in the index manifest, a stopwords file takes precedence
+        if self.stopwords_path:
+            with open(self.stopwords_path, 'r') as f:
+                stop_words = f.read().split() # readlines() kept the newlines, so no stopword ever matched
 
         self.stop_words = set(stop_words)
 
@@ -100,6 +112,16 @@ class PubMedTokenizer(Tokenizer):
         if kwargs:
             print(f"{self.__class__.__name__} also caught the following additional arguments {kwargs}")
 
+    def get_kwargs(self):
+        '''arguments needed to rebuild this tokenizer through dynamically_init_tokenizer (saved in the index manifest)'''
+        return {"class": self.__class__.__name__,
+                "minL": self.minL,
+                "stopwords_path": None, # the list itself is stored, the file may not be found from where the index is searched
+                "stopwords": sorted(self.stop_words),
+                "stemmer": self.stemmer_name,
+                "case_folding": self.case_folding,
+                "allow_numbers": self.allow_numbers}
+
     def tokenize(self, text: str):
         tokens = []
 
@@ -0,0 +1,55 @@
+"""
+Query trace report
+
+Aggregates the query traces written by the searcher with
+--searcher.trace: the latency histogram of the queries, the
+mean time of each stage and the mean work per query. The
+slowest queries are listed with their stage timings, to tell
+where their time went.
+
+python3 trace_report.py traces.jsonl --slowest 5
+
+"""
+import argparse, json
+from statistics import mean
+from searcher import latency_histogram
+
+COUNTERS = ["bytes_read", "postings_lists_read", "postings_touched", "terms", "terms_skipped", "accumulators"]
+
+
+def main(path_to_traces, slowest):
+    with open(path_to_traces) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records:
+        print(f"No traces in {path_to_traces}")
+        return
+
+    print(f"Latency histogram ({len(records)} queries):")
+    print(latency_histogram([r["latency_ms"] for r in records]))
+
+    stages = sorted(set([stage for r in records for stage in r["stages_ms"]]))
+    print(f"\n{'stage':<14}{'mean (ms)':>12}{'max (ms)':>12}")
+    for stage in stages:
+        times = [r["stages_ms"].get(stage, 0) for r in records]
+        print(f"{stage:<14}{mean(times):>12.3f}{max(times):>12.3f}")
+
+    print(f"\n{'counter':<20}{'mean':>12}{'max':>12}")
+    for counter in COUNTERS:
+        values = [r[counter] for r in records if counter in r] # bytes_read is left out of the sharded queries
+        if not values:
+            continue
+        print(f"{counter:<20}{mean(values):>12.1f}{max(values):>12}")
+
+    print(f"\nSlowest {slowest} queries:")
+    for r in sorted(records, key=lambda r: r["latency_ms"], reverse=True)[:slowest]:
+        timings = ", ".join([f"{stage} {ms:.1f}" for stage, ms in sorted(r["stages_ms"].items(), key=lambda item: -item[1])])
+        print(f"  query {r['query_id']}: {r['latency_ms']:.1f} ms ({timings}), {r['postings_touched']} postings, {r['accumulators']} accumulators")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregates the query traces of the searcher")
+    parser.add_argument("path_to_traces", type=str, help="Traces file written with --searcher.trace.")
+    parser.add_argument("--slowest", type=int, default=5, help="Number of slowest queries listed. (default=5).")
+    args = parser.parse_args()
+
+    main(args.path_to_traces, args.slowest)
@@ -9,7 +9,7 @@ Holds utility code that can be reused by several modules.
 """
 
 
-import sys, ctypes, os, glob
+import ctypes, os, hashlib, importlib, threading
 from timeit import default_timer as timer
 
 '''class added by us students'''
@@ -26,13 +26,98 @@ class Timer:
         self.stop_ts = timer()
         return self.stop_ts - self.start_ts
 
-class Block:
-    def __init__(self, token, postings):
-        self.token = token
-        self.postings = postings # {token : # {pmid1: {'w': norm_w1, 'positions': [pos1,pos2]}, pmid2: {'w': norm_w2, 'positions': [pos1,pos2]}}}
-
-    def __repr__(self):
-        return f"token={self.token} | postings={self.postings} | df={self.df}"
+class StageTimer:
+    '''accumulates the time spent on each named stage, using one Timer per stage'''
+    def __init__(self):
+        self.timers = {}
+        self.totals = {}
+
+    def start(self, stage):
+        if stage not in self.timers:
+            self.timers[stage] = Timer()
+            self.totals[stage] = 0
+        return self.timers[stage].start()
+
+    def stop(self, stage):
+        elapsed = self.timers[stage].stop()
+        self.totals[stage] += elapsed
+        return elapsed
+
+class ResourceMonitor:
+    '''
+    Samples the resident memory and the disk I/O of the current process and of its worker processes (the merge
+    pool) through psutil. A background thread samples the memory every interval seconds, so the peaks between
+    the explicit samples are seen, and the peak RSS that the OS recorded for the process and its finished
+    children is a lower bound of the result
+    '''
+    def __init__(self, interval=0.05):
+        import psutil # only the indexer uses it, so the searcher startup does not pay for it
+        self.psutil = psutil
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self.io_start = self.io_counters()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(interval,), daemon=True)
+        self.thread.start()
+
+    def processes(self):
+        '''the process and its live children'''
+        try:
+            return [self.process] + self.process.children(recursive=True)
+        except self.psutil.Error:
+            return [self.process]
+
+    def io_counters(self):
+        '''
+        read and written bytes of the process and its live children. On linux the counters of the children that
+        finished were already added to the process ones when they were reaped
+        '''
+        if not hasattr(self.process, "io_counters"): # not available on macOS
+            return None
+        read_bytes = write_bytes = 0
+        for process in self.processes():
+            try:
+                counters = process.io_counters()
+            except self.psutil.Error: # the child finished meanwhile
+                continue
+            read_bytes += counters.read_bytes
+            write_bytes += counters.write_bytes
+        return read_bytes, write_bytes
+
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            self.sample()
+
+    def sample(self):
+        '''resident memory of the process and its live children now, the peak is kept'''
+        rss = 0
+        for process in self.processes():
+            try:
+                rss += process.memory_info().rss
+            except self.psutil.Error:
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+        return self.peak_rss
+
+    def max_rss(self):
+        '''peak RSS recorded by the OS for the process and for the largest of its finished children'''
+        try:
+            import resource
+        except ImportError: # windows
+            return 0
+        unit = 1 if os.uname().sysname == "Darwin" else 1024 # bytes on macOS, kilobytes elsewhere
+        return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * unit
+
+    def get_statistics(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+        stats = {"peak_rss_bytes": max(self.peak_rss, self.max_rss()), "bytes_read": None, "bytes_written": None}
+        io_end = self.io_counters()
+        if io_end is not None and self.io_start is not None:
+            stats["bytes_read"] = io_end[0] - self.io_start[0]
+            stats["bytes_written"] = io_end[1] - self.io_start[1]
+        return stats
 
 def dynamically_init_class(module_name, **kwargs):
     """Dynamically initializes a python object based
@@ -40,7 +125,10 @@ def dynamically_init_class(module_name, **kwargs):
     specified by the `module_name`.
     
     The `class` name must be specified as an additional argument,
-    this argument will be caught under kwargs variable.
+    this argument will be caught under kwargs variable. A dotted
+    name (`module.Class`) loads the class from another module.
+    The modules are only imported when a class is requested, so
+    the startup does not pay for the ones that are not used.
     
     The reason for not directly specifying the class as argument is 
     because `class` is a reserved keyword in python, which may be
@@ -66,23 +154,26 @@ def dynamically_init_class(module_name, **kwargs):
     """
 
     class_name = kwargs.pop("class")
-    return getattr(sys.modules[module_name], class_name)(**kwargs)
+    if "." in class_name:
+        module_name, class_name = class_name.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), class_name)(**kwargs)
 
 def malloc_trim():
     if os.name == "posix": # if Linux OS
         ctypes.CDLL('libc.so.6').malloc_trim(0) # force free malloc
 
-def are_postings_split(index_folder):
-    '''returns true if postings are split across more than one file'''
-    postings_paths = glob.glob(f"{index_folder}/postings*.pkl")
-
-    if len(postings_paths) == 1:
-        return False
-    return True
-
-def extract_data_from_index(token, index, index_folder):
+def extract_data_from_index(token, index):
     ''' returns document frequency and file pointer from index'''
-    if are_postings_split(index_folder): # several postings files, need to read file pointer from index
-        return index[token][0], index[token][1] # index {token : [df, filepointer]}
+    entry = index[token]
+    if isinstance(entry, list): # several postings files, need to read file pointer from index
+        return entry[0], entry[1] # index {token : [df, filepointer]}
         
-    return index[token], 0 # index {token : df} (fp=0)
+    return entry, 0 # index {token : df} (fp=0)
+
+def file_checksum(path, chunk_size=2**20):
+    '''sha1 of a file, read in chunks so that big postings files do not have to fit in memory'''
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()